@@ -3,9 +3,15 @@ from extensions import db, jwt, cors, limiter, mail
 from auth import auth_bp
 from products import products_bp
 from cart import carts_bp
+from guest_cart import guest_cart_bp
 from orders import order_bp
 from wishlist import wishlist_bp
 from checkout import checkout_bp
+from maintenance import maintenance_bp
+from wishlist_alerts import wishlist_alerts_bp
+from webhook_inbox import webhooks_bp, start_webhook_workers
+from stripe_prices import stripe_prices_bp
+from reconcile import reconcile_bp
 import os
 from dotenv import load_dotenv
 
@@ -31,6 +37,9 @@ def create_app():
     app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
     app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER', os.getenv('MAIL_USERNAME'))
 
+    # Rate limiting can be switched off for load tests
+    app.config['RATELIMIT_ENABLED'] = os.getenv('RATELIMIT_ENABLED', 'True').lower() == 'true'
+
     # Initialize extensions
     db.init_app(app)
     jwt.init_app(app)
@@ -43,7 +52,8 @@ def create_app():
         r"/api/*": {
             "origins": cors_origins,
             "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-            "allow_headers": ["Content-Type", "Authorization"],
+            "allow_headers": ["Content-Type", "Authorization", "If-Match", "If-None-Match", "Idempotency-Key"],
+            "expose_headers": ["ETag", "Idempotent-Replayed"],
             "supports_credentials": True
         }
     })
@@ -52,9 +62,15 @@ def create_app():
     app.register_blueprint(auth_bp)
     app.register_blueprint(products_bp)
     app.register_blueprint(carts_bp)
+    app.register_blueprint(guest_cart_bp)
     app.register_blueprint(order_bp)
     app.register_blueprint(wishlist_bp)
     app.register_blueprint(checkout_bp)
+    app.register_blueprint(maintenance_bp)
+    app.register_blueprint(wishlist_alerts_bp)
+    app.register_blueprint(webhooks_bp)
+    app.register_blueprint(stripe_prices_bp)
+    app.register_blueprint(reconcile_bp)
     
     # JWT error handlers
     @jwt.expired_token_loader
@@ -80,9 +96,11 @@ def create_app():
 
     return app
 
-# Create app instance for gunicorn
+# Create app instance for gunicorn (which starts webhook workers in gunicorn.conf.py)
 app = create_app()
 
 if __name__ == "__main__":
     # Running directly: python app.py
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':  # The reloader's serving process
+        start_webhook_workers(app)
     app.run(debug=True, port=5000)
\ No newline at end of file
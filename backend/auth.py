@@ -1,6 +1,7 @@
 from flask import Blueprint, jsonify, request, redirect
 from models import User, PasswordResetToken
 from extensions import db, limiter, mail
+from guest_cart import merge_guest_cart, forget_guest_cart
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_jwt_extended import (
     create_access_token, 
@@ -107,15 +108,19 @@ def register():
     db.session.add(new_user)
     db.session.commit()
 
+    # Fold any anonymous cart into the new account
+    merge_guest_cart(new_user.id)
+
     # Create tokens
     access_token, refresh_token = create_tokens(new_user)
 
-    return jsonify({
+    response = jsonify({
         'message': 'User registered successfully',
         'user': user_to_dict(new_user),
         'access_token': access_token,
         'refresh_token': refresh_token
-    }), 201
+    })
+    return forget_guest_cart(response), 201
 
 
 @auth_bp.route('/login', methods=['POST'])
@@ -150,15 +155,19 @@ def login():
     if not user.is_active:
         return jsonify({'error': 'This account has been deactivated'}), 401
 
+    # Fold any anonymous cart into the user's cart
+    merge_guest_cart(user.id)
+
     # Create tokens
     access_token, refresh_token = create_tokens(user)
 
-    return jsonify({
+    response = jsonify({
         'message': 'Login successful',
         'user': user_to_dict(user),
         'access_token': access_token,
         'refresh_token': refresh_token
-    }), 200
+    })
+    return forget_guest_cart(response), 200
 
 
 @auth_bp.route('/refresh', methods=['POST'])
@@ -296,24 +305,27 @@ def google_callback():
                 db.session.add(user)
                 db.session.commit()
         
+        # Fold any anonymous cart into the user's cart
+        merge_guest_cart(user.id)
+        
         # Create tokens
         jwt_access_token, jwt_refresh_token = create_tokens(user)
         
         # For GET requests (redirect from Google), redirect to frontend with tokens
         if request.method == 'GET':
             frontend_url = os.getenv('FRONTEND_URL', 'http://localhost:3000')
-            return redirect(
+            return forget_guest_cart(redirect(
                 f"{frontend_url}/auth/callback?"
                 f"access_token={jwt_access_token}&"
                 f"refresh_token={jwt_refresh_token}"
-            )
+            ))
         
-        return jsonify({
+        return forget_guest_cart(jsonify({
             'message': 'Google login successful',
             'user': user_to_dict(user),
             'access_token': jwt_access_token,
             'refresh_token': jwt_refresh_token
-        }), 200
+        })), 200
         
     except Exception as e:
         return jsonify({'error': f'OAuth error: {str(e)}'}), 500
@@ -426,22 +438,24 @@ def github_callback():
                 db.session.add(user)
                 db.session.commit()
         
+        merge_guest_cart(user.id)
+        
         jwt_access_token, jwt_refresh_token = create_tokens(user)
         
         if request.method == 'GET':
             frontend_url = os.getenv('FRONTEND_URL', 'http://localhost:3000')
-            return redirect(
+            return forget_guest_cart(redirect(
                 f"{frontend_url}/auth/callback?"
                 f"access_token={jwt_access_token}&"
                 f"refresh_token={jwt_refresh_token}"
-            )
+            ))
         
-        return jsonify({
+        return forget_guest_cart(jsonify({
             'message': 'GitHub login successful',
             'user': user_to_dict(user),
             'access_token': jwt_access_token,
             'refresh_token': jwt_refresh_token
-        }), 200
+        })), 200
         
     except Exception as e:
         return jsonify({'error': f'OAuth error: {str(e)}'}), 500
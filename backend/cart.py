@@ -1,20 +1,57 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, make_response
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from extensions import db, limiter
-from models import Cart, CartItem, Product, PromoCode
+from models import Product
+from pricing import quote_cart, unit_price_cents, TAX_RATE_PERCENT
+from promos import promo_codes
+from cart_store import get_cart_store, load_products, CartStoreError, StaleCart
+import zlib
 
 
 carts_bp = Blueprint('cart', __name__, url_prefix='/api/cart')
 
 
-def get_or_create_cart(user_id):
-    """Get user's cart or create one if it doesn't exist"""
-    cart = Cart.query.filter_by(user_id=user_id).first()
-    if not cart:
-        cart = Cart(user_id=user_id)
-        db.session.add(cart)
-        db.session.commit()
-    return cart
+def requested_cart_version():
+    """
+    Cart version named by the request's If-Match header, or None if it has none.
+    Takes a mutation's ETag ("<version>") or a cart view's ("<version>-<pricing>").
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    for tag in request.if_match.as_set():
+        version = tag.split('-', 1)[0]
+        if version.isdigit():
+            return int(version)
+    return -1  # Unparseable tags never match
+
+
+def stale_cart_response():
+    """412 response for a write based on an outdated cart version"""
+    return jsonify({
+        'error': 'Cart was changed elsewhere. Refresh and try again.',
+        'code': 'cart_version_mismatch'
+    }), 412
+
+
+def cart_response(payload, status, etag):
+    """JSON response with an ETag (the cart version for mutations, cart_etag for the cart view)"""
+    response = jsonify(payload)
+    response.set_etag(str(etag))
+    return response, status
+
+
+def cart_etag(version, promo_code, products):
+    """
+    ETag for the cart view: the cart version plus a checksum of what prices
+    it (prices, sales, stock and the promo discount), none of which bump the
+    version when they change.
+    """
+    pricing = sorted(
+        (product.id, product.price_cents, product.effective_sale_percent, product.stock)
+        for product in products if product and product.is_active
+    )
+    pricing.append(promo_codes.discount_percent(promo_code))
+    return f'{version}-{zlib.crc32(repr(pricing).encode()):08x}'
 
 
 def product_to_dict(product):
@@ -57,73 +94,90 @@ def product_to_dict(product):
 
 def get_effective_price(product):
     """Get the effective price (sale price if on sale, otherwise regular price)"""
-    if product.is_on_sale and product.sale_price_cents:
-        return product.sale_price_cents
-    return product.price_cents
+    return unit_price_cents(product)
+
+
+def cart_to_dict(cart_id, lines, promo_code=None):
+    """
+    Build the cart view from cart lines.
+    A line is anything with id, product_id, product, quantity and added_at
+    (a CartItem, or a guest cart entry). Totals come from the pricing engine,
+    including the discount of promo_code while it is still active.
+    """
+    discount_percent = promo_codes.discount_percent(promo_code)
+    lines = [item for item in lines if item.product and item.product.is_active]
+    quote = quote_cart(((item.product, item.quantity) for item in lines), discount_percent=discount_percent)
+    
+    items = []
+    for item, priced in zip(lines, quote.lines):
+        items.append({
+            'id': item.id,
+            'product_id': item.product_id,
+            'quantity': item.quantity,
+            'unit_price_cents': priced.unit_price_cents,
+            'original_price_cents': priced.original_unit_price_cents,
+            'line_total_cents': priced.line_total_cents,
+            'original_line_total_cents': priced.original_line_total_cents,
+            'added_at': item.added_at.isoformat() if item.added_at else None,
+            'product': product_to_dict(item.product)
+        })
+    
+    return {
+        'cart_id': cart_id,
+        'items': items,
+        'item_count': len(items),
+        'total_items': quote.total_items,
+        'subtotal_cents': quote.subtotal_cents,
+        'original_subtotal_cents': quote.original_subtotal_cents,
+        'sale_savings_cents': quote.sale_savings_cents,
+        'promo_code': promo_code if discount_percent else None,
+        'discount_percent': quote.discount_percent,
+        'discount_cents': quote.discount_cents,
+        'tax_cents': quote.tax_cents,
+        'tax_rate': TAX_RATE_PERCENT / 100,
+        'shipping_cents': quote.shipping_cents,
+        'total_cents': quote.total_cents,
+        'currency': quote.currency
+    }
+
+
+@carts_bp.errorhandler(CartStoreError)
+def cart_store_error(error):
+    """Turn cart store errors into JSON responses"""
+    if isinstance(error, StaleCart):
+        return stale_cart_response()
+    return jsonify({'error': str(error)}), error.status
 
 
 @carts_bp.route('', methods=['GET'])
 @jwt_required()
 def get_cart():
-    """Get all items in user's cart with full product details"""
+    """
+    Get all items in user's cart with full product details.
+    The ETag is the cart version plus a pricing checksum (cart_etag); a
+    matching If-None-Match gets a 304 after one lookup of the cart's version
+    and product prices, without building the cart.
+    """
     user_id = get_jwt_identity()
-    cart = get_or_create_cart(user_id)
+    store = get_cart_store()
     
-    items = []
-    subtotal_cents = 0
-    original_subtotal_cents = 0  # Track original price for showing savings
-    total_items = 0
-    
-    for item in cart.items:
-        if item.product and item.product.is_active:
-            # Use sale price if available
-            effective_price = get_effective_price(item.product)
-            line_total = effective_price * item.quantity
-            original_line_total = item.product.price_cents * item.quantity
-            
-            subtotal_cents += line_total
-            original_subtotal_cents += original_line_total
-            total_items += item.quantity
-            
-            items.append({
-                'id': item.id,
-                'product_id': item.product_id,
-                'quantity': item.quantity,
-                'unit_price_cents': effective_price,
-                'original_price_cents': item.product.price_cents,
-                'line_total_cents': line_total,
-                'original_line_total_cents': original_line_total,
-                'added_at': item.added_at.isoformat(),
-                'product': product_to_dict(item.product)
-            })
-    
-    # Calculate tax (13% HST for Ontario)
-    tax_rate = 0.13
-    tax_cents = int(subtotal_cents * tax_rate)
-    
-    # Shipping (free over $100, otherwise $9.99)
-    shipping_cents = 0 if subtotal_cents >= 10000 else 999
-    
-    # Total
-    total_cents = subtotal_cents + tax_cents + shipping_cents
-    
-    # Calculate savings from sales
-    sale_savings_cents = original_subtotal_cents - subtotal_cents
+    if request.if_none_match:
+        etag = cart_etag(*store.pricing_state(user_id))
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+            response.set_etag(etag)
+            return response
     
-    return jsonify({
-        'cart_id': cart.id,
-        'items': items,
-        'item_count': len(items),
-        'total_items': total_items,
-        'subtotal_cents': subtotal_cents,
-        'original_subtotal_cents': original_subtotal_cents,
-        'sale_savings_cents': sale_savings_cents,
-        'tax_cents': tax_cents,
-        'tax_rate': tax_rate,
-        'shipping_cents': shipping_cents,
-        'total_cents': total_cents,
-        'currency': 'CAD'
-    }), 200
+    # An empty cart is returned virtually (version 0) until the first add creates it
+    cart = store.load(user_id)
+    
+    if not cart:
+        return cart_response({**cart_to_dict(None, []), 'version': 0}, 200, cart_etag(0, None, []))
+    
+    return cart_response({
+        **cart_to_dict(cart.cart_id, cart.lines, cart.promo_code),
+        'version': cart.version
+    }, 200, cart_etag(cart.version, cart.promo_code, [line.product for line in cart.lines]))
 
 
 @carts_bp.route('/count', methods=['GET'])
@@ -132,14 +186,9 @@ def get_cart():
 def get_cart_count():
     """Get just the count of items in cart (for navbar badge)"""
     user_id = get_jwt_identity()
-    cart = Cart.query.filter_by(user_id=user_id).first()
-    
-    if not cart:
-        return jsonify({'count': 0, 'total_items': 0}), 200
     
     # Count unique items and total quantity
-    count = len(cart.items)
-    total_items = sum(item.quantity for item in cart.items)
+    count, total_items = get_cart_store().count(user_id)
     
     return jsonify({
         'count': count,
@@ -163,8 +212,8 @@ def add_to_cart():
     if quantity < 1:
         return jsonify({'error': 'Quantity must be at least 1'}), 400
     
-    # Check if product exists and is active
-    product = Product.query.filter_by(id=product_id, is_active=True).first()
+    # Check if product exists and is active (category is needed for its sale price)
+    product = load_products([product_id]).get(product_id)
     if not product:
         return jsonify({'error': 'Product not found'}), 404
     
@@ -172,52 +221,19 @@ def add_to_cart():
     if quantity > product.stock:
         return jsonify({'error': f'Only {product.stock} items available'}), 400
     
-    cart = get_or_create_cart(user_id)
-    
-    # Get effective price (sale price if on sale)
-    effective_price = get_effective_price(product)
-    
-    # Check if already in cart
-    existing = CartItem.query.filter_by(
-        cart_id=cart.id,
-        product_id=product_id
-    ).first()
-    
-    if existing:
-        # Update quantity
-        new_quantity = existing.quantity + quantity
-        if new_quantity > product.stock:
-            return jsonify({'error': f'Cannot add more. Only {product.stock} items available, you have {existing.quantity} in cart'}), 400
-        
-        existing.quantity = new_quantity
-        existing.unit_price_cents = effective_price  # Update to current sale price
-        db.session.commit()
-        
-        return jsonify({
-            'message': 'Cart updated',
-            'product_id': product_id,
-            'quantity': existing.quantity,
-            'item_id': existing.id,
-            'action': 'updated'
-        }), 200
-    else:
-        # Add new item
-        item = CartItem(
-            cart_id=cart.id,
-            product_id=product_id,
-            quantity=quantity,
-            unit_price_cents=effective_price
-        )
-        db.session.add(item)
-        db.session.commit()
-        
-        return jsonify({
-            'message': 'Added to cart',
-            'product_id': product_id,
-            'quantity': quantity,
-            'item_id': item.id,
-            'action': 'added'
-        }), 201
+    item = get_cart_store().add(user_id, product, quantity, requested_cart_version())
+    
+    # A fresh line holds exactly the requested quantity; an existing line holds more
+    added = item.quantity == quantity
+    
+    return cart_response({
+        'message': 'Added to cart' if added else 'Cart updated',
+        'product_id': product_id,
+        'quantity': item.quantity,
+        'item_id': item.item_id,
+        'action': 'added' if added else 'updated',
+        'version': item.version
+    }, 201 if added else 200, item.version)
 
 
 @carts_bp.route('/update', methods=['PUT'])
@@ -236,31 +252,17 @@ def update_cart_item():
     if quantity is None or quantity < 1:
         return jsonify({'error': 'Quantity must be at least 1'}), 400
     
-    cart = Cart.query.filter_by(user_id=user_id).first()
-    if not cart:
-        return jsonify({'error': 'Cart not found'}), 404
-    
-    item = CartItem.query.filter_by(
-        cart_id=cart.id,
-        product_id=product_id
-    ).first()
-    
-    if not item:
-        return jsonify({'error': 'Item not in cart'}), 404
-    
-    # Check stock
-    product = Product.query.get(product_id)
-    if quantity > product.stock:
-        return jsonify({'error': f'Only {product.stock} items available'}), 400
+    product = db.session.get(Product, product_id)
+    stock = product.stock if product else 0
     
-    item.quantity = quantity
-    db.session.commit()
+    version = get_cart_store().update(user_id, product_id, quantity, stock, requested_cart_version())
     
-    return jsonify({
+    return cart_response({
         'message': 'Cart updated',
         'product_id': product_id,
-        'quantity': quantity
-    }), 200
+        'quantity': quantity,
+        'version': version
+    }, 200, version)
 
 
 @carts_bp.route('/remove', methods=['DELETE'])
@@ -274,25 +276,13 @@ def remove_from_cart():
     if not product_id:
         return jsonify({'error': 'Product ID is required'}), 400
     
-    cart = Cart.query.filter_by(user_id=user_id).first()
-    if not cart:
-        return jsonify({'error': 'Cart not found'}), 404
-    
-    item = CartItem.query.filter_by(
-        cart_id=cart.id,
-        product_id=product_id
-    ).first()
-    
-    if not item:
-        return jsonify({'error': 'Item not in cart'}), 404
-    
-    db.session.delete(item)
-    db.session.commit()
+    version = get_cart_store().remove(user_id, product_id, requested_cart_version())
     
-    return jsonify({
+    return cart_response({
         'message': 'Removed from cart',
-        'product_id': product_id
-    }), 200
+        'product_id': product_id,
+        'version': version
+    }, 200, version)
 
 
 @carts_bp.route('/clear', methods=['DELETE'])
@@ -301,20 +291,60 @@ def clear_cart():
     """Remove all items from cart"""
     user_id = get_jwt_identity()
     
-    cart = Cart.query.filter_by(user_id=user_id).first()
-    if not cart:
+    version = get_cart_store().clear(user_id, requested_cart_version())
+    if version is None:
         return jsonify({'message': 'Cart already empty'}), 200
     
-    CartItem.query.filter_by(cart_id=cart.id).delete()
-    db.session.commit()
+    return cart_response({'message': 'Cart cleared', 'version': version}, 200, version)
+
+
+MAX_BATCH_OPERATIONS = 100
+
+
+@carts_bp.route('/batch', methods=['POST'])
+@jwt_required()
+def batch_update_cart():
+    """
+    Apply a list of add/update/remove operations to the cart in one write.
+    Products for every operation are validated with a single query, operations
+    run in order against the cart in memory and everything is saved once.
+    Each operation gets its own result; failed operations do not block the rest.
+    """
+    user_id = get_jwt_identity()
+    data = request.get_json() or {}
+    
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'error': 'Operations list is required'}), 400
+    
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return jsonify({'error': f'At most {MAX_BATCH_OPERATIONS} operations per batch'}), 400
+    
+    product_ids = {
+        op.get('product_id') for op in operations
+        if isinstance(op, dict) and isinstance(op.get('product_id'), int)
+    }
+    products = load_products(product_ids)
     
-    return jsonify({'message': 'Cart cleared'}), 200
+    results, applied, version = get_cart_store().batch(user_id, operations, products, requested_cart_version())
+    
+    return cart_response({
+        'message': 'Cart updated',
+        'applied': applied,
+        'failed': len(results) - applied,
+        'results': results,
+        'version': version
+    }, 200, version)
 
 
 @carts_bp.route('/apply-promo', methods=['POST'])
 @jwt_required()
 def apply_promo():
-    """Apply a promo code to cart"""
+    """
+    Apply a promo code to the user's cart.
+    The code is checked against the in-process promo table (no query) and
+    stored on the cart, so cart totals and checkout include the discount.
+    """
     user_id = get_jwt_identity()
     data = request.get_json()
     
@@ -323,20 +353,30 @@ def apply_promo():
     if not promo_code:
         return jsonify({'error': 'Promo code is required'}), 400
     
-    # Look up promo code in database
-    promo = PromoCode.query.filter_by(code=promo_code, is_active=True).first()
+    discount_percent = promo_codes.discount_percent(promo_code)
     
-    if not promo:
+    if discount_percent is None:
         return jsonify({'error': 'Invalid promo code'}), 400
     
-    return jsonify({
+    version = get_cart_store().set_promo(user_id, promo_code, requested_cart_version())
+    
+    return cart_response({
         'message': 'Promo code applied!',
-        'promo_code': promo.code,
-        'discount_percent': promo.discount_percent
-    }), 200
-
-
-
-
+        'promo_code': promo_code,
+        'discount_percent': discount_percent,
+        'version': version
+    }, 200, version)
 
 
+@carts_bp.route('/promo', methods=['DELETE'])
+@jwt_required()
+def remove_promo():
+    """Remove the applied promo code from the user's cart"""
+    user_id = get_jwt_identity()
+    
+    version = get_cart_store().set_promo(user_id, None, requested_cart_version())
+    
+    return cart_response({
+        'message': 'Promo code removed',
+        'version': version
+    }, 200, version)
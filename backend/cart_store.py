@@ -0,0 +1,854 @@
+"""
+Cart storage behind carts_bp.
+
+CART_STORE selects the backend:
+- sql (default): carts and cart_items in the database
+- redis: one compact hash per live cart on the Redis server at REDIS_URL,
+  written to the database only at checkout (see KeyValueCartStore)
+- memory: the key-value store on an in-process Redis stand-in, for tests
+  and single-process development
+
+Store methods raise CartStoreError subclasses, which carts_bp turns into
+JSON error responses. Every mutation bumps the cart version and honours
+expected_version (the request's If-Match) as a compare-and-swap.
+"""
+
+from flask import current_app
+from sqlalchemy import update, select, literal
+from sqlalchemy.orm import joinedload, selectinload, aliased
+from collections import namedtuple
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from extensions import db
+from models import Cart, CartItem, Product
+from pricing import unit_price_cents
+from dbutils import dialect_insert, supports_writable_ctes
+import threading
+import time
+import os
+
+try:
+    from redis.exceptions import WatchError
+except ImportError:  # redis is only needed for CART_STORE=redis
+    class WatchError(Exception):
+        pass
+
+
+class CartStoreError(Exception):
+    status = 400
+
+
+class CartNotFound(CartStoreError):
+    status = 404
+    
+    def __init__(self, message='Cart not found'):
+        super().__init__(message)
+
+
+class ItemNotInCart(CartStoreError):
+    status = 404
+    
+    def __init__(self, message='Item not in cart'):
+        super().__init__(message)
+
+
+class StaleCart(CartStoreError):
+    status = 412
+    
+    def __init__(self, message='Cart was changed elsewhere. Refresh and try again.'):
+        super().__init__(message)
+
+
+class NotEnoughStock(CartStoreError):
+    pass
+
+
+CartView = namedtuple('CartView', 'cart_id version promo_code lines')
+CartLine = namedtuple('CartLine', 'id product_id product quantity added_at')
+AddedItem = namedtuple('AddedItem', 'item_id quantity version')
+
+BATCH_OPERATIONS = ('add', 'update', 'remove')
+
+
+def load_products(product_ids, for_display=False):
+    """Active products by id in one query (brand and images too when they will be displayed)"""
+    if not product_ids:
+        return {}
+    
+    options = [joinedload(Product.category)]
+    if for_display:
+        options += [joinedload(Product.brand), selectinload(Product.images)]
+    
+    return {p.id: p for p in Product.query.options(*options).filter(
+        Product.id.in_(product_ids),
+        Product.is_active == True
+    ).all()}
+
+
+def plan_operations(quantities, operations, products):
+    """
+    Run batch operations in order against a cart's {product_id: quantity}.
+    products maps product id to the active Product for every operation.
+    Returns (new quantities, per-operation results, number applied); failed
+    operations are reported and skipped without blocking the rest.
+    """
+    quantities = dict(quantities)
+    results = []
+    applied = 0
+    
+    for index, op in enumerate(operations):
+        action = op.get('op') if isinstance(op, dict) else None
+        product_id = op.get('product_id') if isinstance(op, dict) else None
+        quantity = op.get('quantity', 1 if action == 'add' else None) if isinstance(op, dict) else None
+        result = {'index': index, 'op': action, 'product_id': product_id}
+        results.append(result)
+        
+        if action not in BATCH_OPERATIONS:
+            result['error'] = 'Operation must be one of add, update, remove'
+            continue
+        
+        if not isinstance(product_id, int):
+            result['error'] = 'Product ID is required'
+            continue
+        
+        existing = quantities.get(product_id)
+        
+        if action == 'remove':
+            if not existing:
+                result['error'] = 'Item not in cart'
+                continue
+            del quantities[product_id]
+            result['quantity'] = 0
+            applied += 1
+            continue
+        
+        if not isinstance(quantity, int) or quantity < 1:
+            result['error'] = 'Quantity must be at least 1'
+            continue
+        
+        product = products.get(product_id)
+        if not product:
+            result['error'] = 'Product not found'
+            continue
+        
+        if action == 'update' and not existing:
+            result['error'] = 'Item not in cart'
+            continue
+        
+        new_quantity = existing + quantity if action == 'add' and existing else quantity
+        if new_quantity > product.stock:
+            result['error'] = f'Only {product.stock} items available'
+            continue
+        
+        quantities[product_id] = new_quantity
+        result['quantity'] = new_quantity
+        applied += 1
+    
+    for result in results:
+        result['success'] = 'error' not in result
+    
+    return quantities, results, applied
+
+
+def merged_quantities(quantities, products, additions):
+    """Add {product_id: quantity} to a cart's quantities, capped at stock"""
+    merged = dict(quantities)
+    for product in products.values():
+        quantity = min(merged.get(product.id, 0) + additions[product.id], product.stock)
+        if quantity >= 1:
+            merged[product.id] = quantity
+    return merged
+
+
+def added_quantities(before, after, products):
+    """{product_id: quantity added} for products, between two {product_id: quantity} states of a cart"""
+    return {product_id: max(0, after.get(product_id, 0) - before.get(product_id, 0)) for product_id in products}
+
+
+class CartStore(ABC):
+    """Interface shared by the cart backends"""
+    
+    @abstractmethod
+    def version(self, user_id):
+        """Current cart version, 0 if the user has no cart"""
+    
+    @abstractmethod
+    def load(self, user_id):
+        """CartView with display-ready lines, or None if the user has no cart"""
+    
+    @abstractmethod
+    def pricing_state(self, user_id):
+        """(version, promo code, products of the lines with their categories), for the cart's ETag"""
+    
+    @abstractmethod
+    def count(self, user_id):
+        """(distinct products, total quantity) in the cart"""
+    
+    @abstractmethod
+    def add(self, user_id, product, quantity, expected_version=None):
+        """Add quantity of product, creating the cart if needed. Returns an AddedItem."""
+    
+    @abstractmethod
+    def update(self, user_id, product_id, quantity, stock, expected_version=None):
+        """Set the quantity of a product already in the cart. Returns the new version."""
+    
+    @abstractmethod
+    def remove(self, user_id, product_id, expected_version=None):
+        """Remove a product from the cart. Returns the new version."""
+    
+    @abstractmethod
+    def clear(self, user_id, expected_version=None):
+        """Remove every item. Returns the new version, or None if there is no cart."""
+    
+    @abstractmethod
+    def batch(self, user_id, operations, products, expected_version=None):
+        """Apply batch operations (see plan_operations). Returns (results, applied, version)."""
+    
+    @abstractmethod
+    def set_promo(self, user_id, promo_code, expected_version=None):
+        """Store or (with None) clear the applied promo code. Returns the new version."""
+    
+    @abstractmethod
+    def merge(self, user_id, products, quantities):
+        """
+        Fold {product_id: quantity} into the cart, capped at stock, and commit it
+        together with the session's pending database changes (all or nothing).
+        Returns {product_id: quantity added} for products, less than asked
+        where stock capped it.
+        """
+    
+    @abstractmethod
+    def persist(self, user_id):
+        """Make sure carts/cart_items hold the live cart, ready for checkout"""
+    
+    @abstractmethod
+    def forget(self, user_id, version=None):
+        """Drop the live cart after its order has been placed, unless it has moved past version since"""
+
+
+def bump_cart_version(cart_id, expected_version=None):
+    """
+    Atomically increment a cart's version. With expected_version the update only
+    applies while the cart is still at that version (compare-and-swap).
+    Returns the new version, or None if the cart has moved on.
+    """
+    stmt = update(Cart).where(Cart.id == cart_id)
+    if expected_version is not None:
+        stmt = stmt.where(Cart.version == expected_version)
+    return db.session.execute(
+        stmt.values(version=Cart.version + 1).returning(Cart.version)
+    ).scalar()
+
+
+def begin_cart_mutation(user_id, expected_version=None, create=False):
+    """
+    Start a cart write: bump the cart version first, honouring expected_version,
+    and create the cart if asked. The bump row-locks the cart so concurrent
+    writers to the same cart are serialized until commit.
+    Returns (cart_id, new_version).
+    """
+    cart_id = db.session.query(Cart.id).filter_by(user_id=user_id).scalar()
+    
+    if cart_id is None:
+        if not create:
+            raise CartNotFound()
+        if expected_version not in (None, 0):
+            raise StaleCart()
+        cart = Cart(user_id=user_id, version=1)
+        db.session.add(cart)
+        db.session.flush()
+        return cart.id, cart.version
+    
+    version = bump_cart_version(cart_id, expected_version)
+    if version is None:
+        raise StaleCart()
+    return cart_id, version
+
+
+def upsert_cart_item(user_id, product, quantity, expected_version=None):
+    """
+    Add quantity of product to the user's cart in a single write.
+    The cart row is written first: created (only without expected_version, or
+    with 0), or its version bumped while it is at expected_version and the new
+    total fits in stock. Then the item is upserted on (cart_id, product_id),
+    summing quantities only while the total fits in stock. On PostgreSQL both
+    writes run as one statement through a writable CTE; SQLite runs them back
+    to back. Returns a row of (id, quantity, version), or None if the version
+    check or the stock check failed.
+    """
+    price = unit_price_cents(product)
+    
+    owner = aliased(Cart)
+    in_cart = select(CartItem.quantity).join(owner, owner.id == CartItem.cart_id).where(
+        owner.user_id == user_id,
+        CartItem.product_id == product.id
+    ).scalar_subquery()
+    fits = db.func.coalesce(in_cart, 0) + quantity <= product.stock
+    bump = {'version': Cart.version + 1, 'updated_at': db.func.now()}  # ON CONFLICT skips onupdate
+    
+    if expected_version is None:
+        cart_upsert = dialect_insert(Cart).values(user_id=user_id, version=1)
+        cart_upsert = cart_upsert.on_conflict_do_update(index_elements=['user_id'], set_=bump, where=fits)
+    elif expected_version == 0:
+        # The client saw no cart; one existing now means it is stale
+        cart_upsert = dialect_insert(Cart).values(user_id=user_id, version=1).on_conflict_do_nothing(
+            index_elements=['user_id']
+        )
+    else:
+        cart_upsert = update(Cart).where(
+            Cart.user_id == user_id,
+            Cart.version == expected_version,
+            fits
+        ).values(bump)
+    cart_upsert = cart_upsert.returning(Cart.id, Cart.version)
+    
+    if supports_writable_ctes():
+        cart = cart_upsert.cte('upserted_cart')
+        cart_id, version = cart.c.id, select(cart.c.version).scalar_subquery()
+    else:
+        cart = db.session.execute(cart_upsert).first()
+        if cart is None:
+            return None
+        cart_id, version = literal(cart.id), literal(cart.version)
+    
+    item_upsert = dialect_insert(CartItem).from_select(
+        ['cart_id', 'product_id', 'quantity', 'unit_price_cents'],
+        select(cart_id, literal(product.id), literal(quantity), literal(price))
+    )
+    item_upsert = item_upsert.on_conflict_do_update(
+        index_elements=['cart_id', 'product_id'],
+        set_={
+            'quantity': CartItem.quantity + item_upsert.excluded.quantity,
+            'unit_price_cents': item_upsert.excluded.unit_price_cents  # Update to current sale price
+        },
+        where=CartItem.quantity + item_upsert.excluded.quantity <= product.stock
+    ).returning(CartItem.id, CartItem.quantity, version.label('version'))
+    
+    if supports_writable_ctes():
+        item_upsert = item_upsert.add_cte(cart)
+    
+    return db.session.execute(item_upsert).first()
+
+
+def write_cart_items(cart_id, products, quantities):
+    """Upsert {product_id: quantity} into a cart with one multi-row INSERT at current prices"""
+    rows = [{
+        'cart_id': cart_id,
+        'product_id': product_id,
+        'quantity': quantity,
+        'unit_price_cents': unit_price_cents(products[product_id])
+    } for product_id, quantity in quantities.items()]
+    
+    if not rows:
+        return
+    
+    stmt = dialect_insert(CartItem).values(rows)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['cart_id', 'product_id'],
+        set_={
+            'quantity': stmt.excluded.quantity,
+            'unit_price_cents': stmt.excluded.unit_price_cents
+        }
+    ))
+
+
+def load_cart(user_id):
+    """
+    Load user's cart for display without writing anything.
+    Items, products, brands and categories come back in one joined query and
+    product images in a second batched query. Returns None if no cart exists yet.
+    """
+    return Cart.query.options(
+        joinedload(Cart.items).joinedload(CartItem.product).options(
+            joinedload(Product.brand),
+            joinedload(Product.category),
+            selectinload(Product.images)
+        )
+    ).filter_by(user_id=user_id).first()
+
+
+class SqlCartStore(CartStore):
+    """Carts in the carts and cart_items tables; each call is one transaction"""
+    
+    def version(self, user_id):
+        return db.session.query(Cart.version).filter_by(user_id=user_id).scalar() or 0
+    
+    def load(self, user_id):
+        cart = load_cart(user_id)
+        if not cart:
+            return None
+        return CartView(cart.id, cart.version, cart.promo_code, cart.items)
+    
+    def pricing_state(self, user_id):
+        rows = db.session.query(Cart.version, Cart.promo_code, Product).outerjoin(
+            CartItem, CartItem.cart_id == Cart.id
+        ).outerjoin(Product, Product.id == CartItem.product_id).options(
+            joinedload(Product.category)
+        ).filter(Cart.user_id == user_id).all()
+        if not rows:
+            return 0, None, []
+        return rows[0][0], rows[0][1], [row[2] for row in rows if row[2] is not None]
+    
+    def count(self, user_id):
+        row = db.session.query(
+            db.func.count(CartItem.id),
+            db.func.coalesce(db.func.sum(CartItem.quantity), 0)
+        ).join(Cart).filter(Cart.user_id == user_id).one()
+        return row[0], row[1]
+    
+    def add(self, user_id, product, quantity, expected_version=None):
+        row = upsert_cart_item(user_id, product, quantity, expected_version)
+        
+        if row is None:
+            # Nothing was written; work out whether the version or the stock check failed
+            db.session.rollback()
+            cart = Cart.query.filter_by(user_id=user_id).first()
+            if expected_version is not None and (cart.version if cart else 0) != expected_version:
+                raise StaleCart()
+            in_cart = CartItem.query.filter_by(cart_id=cart.id, product_id=product.id).first() if cart else None
+            raise NotEnoughStock(
+                f'Cannot add more. Only {product.stock} items available, you have {in_cart.quantity if in_cart else 0} in cart'
+            )
+        
+        db.session.commit()
+        return AddedItem(row.id, row.quantity, row.version)
+    
+    def update(self, user_id, product_id, quantity, stock, expected_version=None):
+        try:
+            cart_id, version = begin_cart_mutation(user_id, expected_version)
+            item = CartItem.query.filter_by(cart_id=cart_id, product_id=product_id).first()
+            if not item:
+                raise ItemNotInCart()
+            if quantity > stock:
+                raise NotEnoughStock(f'Only {stock} items available')
+        except CartStoreError:
+            db.session.rollback()
+            raise
+        
+        item.quantity = quantity
+        db.session.commit()
+        return version
+    
+    def remove(self, user_id, product_id, expected_version=None):
+        try:
+            cart_id, version = begin_cart_mutation(user_id, expected_version)
+            deleted = CartItem.query.filter_by(cart_id=cart_id, product_id=product_id).delete()
+            if not deleted:
+                raise ItemNotInCart()
+        except CartStoreError:
+            db.session.rollback()
+            raise
+        
+        db.session.commit()
+        return version
+    
+    def clear(self, user_id, expected_version=None):
+        cart_id = db.session.query(Cart.id).filter_by(user_id=user_id).scalar()
+        if cart_id is None:
+            return None
+        
+        try:
+            cart_id, version = begin_cart_mutation(user_id, expected_version)
+        except CartStoreError:
+            db.session.rollback()
+            raise
+        
+        CartItem.query.filter_by(cart_id=cart_id).delete()
+        db.session.commit()
+        return version
+    
+    def batch(self, user_id, operations, products, expected_version=None):
+        try:
+            cart_id, version = begin_cart_mutation(user_id, expected_version, create=True)
+        except CartStoreError:
+            db.session.rollback()
+            raise
+        
+        current = dict(db.session.query(CartItem.product_id, CartItem.quantity).filter_by(cart_id=cart_id).all())
+        quantities, results, applied = plan_operations(current, operations, products)
+        
+        removed = current.keys() - quantities.keys()
+        if removed:
+            CartItem.query.filter(
+                CartItem.cart_id == cart_id,
+                CartItem.product_id.in_(removed)
+            ).delete(synchronize_session=False)
+        
+        changed = {
+            product_id: quantity for product_id, quantity in quantities.items()
+            if current.get(product_id) != quantity and product_id in products
+        }
+        write_cart_items(cart_id, products, changed)
+        
+        db.session.commit()
+        return results, applied, version
+    
+    def set_promo(self, user_id, promo_code, expected_version=None):
+        try:
+            cart_id, version = begin_cart_mutation(user_id, expected_version, create=promo_code is not None)
+        except CartStoreError:
+            db.session.rollback()
+            raise
+        
+        db.session.execute(update(Cart).where(Cart.id == cart_id).values(promo_code=promo_code))
+        db.session.commit()
+        return version
+    
+    def merge(self, user_id, products, quantities):
+        cart = Cart.query.filter_by(user_id=user_id).first()
+        if not cart:
+            cart = Cart(user_id=user_id)
+            db.session.add(cart)
+            db.session.flush()
+        else:
+            bump_cart_version(cart.id)
+        
+        existing = dict(
+            db.session.query(CartItem.product_id, CartItem.quantity).filter_by(cart_id=cart.id).all()
+        )
+        merged = merged_quantities(existing, products, quantities)
+        rows = {product_id: merged[product_id] for product_id in products if product_id in merged}
+        write_cart_items(cart.id, products, rows)
+        db.session.commit()
+        return added_quantities(existing, merged, products)
+    
+    def persist(self, user_id):
+        pass  # Already in the database
+    
+    def forget(self, user_id, version=None):
+        pass  # Order creation empties cart_items itself
+
+
+CART_TTL_SECONDS = 90 * 24 * 3600
+
+
+class KeyValueCartStore(CartStore):
+    """
+    Live carts as one Redis hash per user, key cart:<user_id>:
+    v -> version, p -> promo code, i:<product_id> -> "<quantity>:<added epoch>".
+    
+    Reads are a single HGETALL (plus one products query to display lines).
+    Writes read the hash under WATCH, apply the change in Python and write it
+    back in MULTI/EXEC, retrying if another writer got in first. A write that
+    goes with a database commit (merge) is undone if the commit fails. Idle carts
+    expire after CART_TTL_SECONDS. Checkout copies the hash into carts and
+    cart_items (persist) so order creation reads the database as before.
+    """
+    
+    def __init__(self, client, ttl=CART_TTL_SECONDS, max_retries=5):
+        self.client = client
+        self.ttl = ttl
+        self.max_retries = max_retries
+    
+    def _key(self, user_id):
+        return f'cart:{user_id}'
+    
+    def _decode(self, raw):
+        raw = {
+            (k.decode() if isinstance(k, bytes) else k): (v.decode() if isinstance(v, bytes) else v)
+            for k, v in raw.items()
+        }
+        items = {}
+        for field, value in raw.items():
+            if field.startswith('i:'):
+                quantity, added = value.split(':')
+                items[int(field[2:])] = (int(quantity), float(added))
+        return int(raw.get('v', 0)), raw.get('p') or None, items
+    
+    def _encode(self, version, promo_code, items):
+        fields = {'v': version}
+        if promo_code:
+            fields['p'] = promo_code
+        for product_id, (quantity, added) in items.items():
+            fields[f'i:{product_id}'] = f'{quantity}:{added:.0f}'
+        return fields
+    
+    def _read(self, user_id):
+        return self._decode(self.client.hgetall(self._key(user_id)))
+    
+    def _mutate(self, user_id, expected_version, change, create=True, then=None):
+        """
+        Apply change(items, promo_code) -> (items, promo_code, result) to the
+        cart atomically. then, if given, runs once the hash is written (a
+        database commit); if it raises, the hash is put back and the error
+        re-raised. Returns (new version, result).
+        """
+        key = self._key(user_id)
+        
+        for _ in range(self.max_retries):
+            with self.client.pipeline() as pipe:
+                try:
+                    pipe.watch(key)
+                    version, promo_code, items = self._decode(pipe.hgetall(key))
+                    
+                    if not version and not create:
+                        raise CartNotFound()
+                    if expected_version is not None and version != expected_version:
+                        raise StaleCart()
+                    previous = self._encode(version, promo_code, items) if version else None
+                    if not version:
+                        # A new live cart carries on from the database cart's version, so
+                        # versions (ETags, checkout idempotency keys) never repeat
+                        version = self._version_floor(user_id)
+                    
+                    items, promo_code, result = change(items, promo_code)
+                    version += 1
+                    
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.hset(key, mapping=self._encode(version, promo_code, items))
+                    pipe.expire(key, self.ttl)
+                    pipe.execute()
+                except WatchError:
+                    continue
+            
+            if then:
+                try:
+                    then()
+                except Exception:
+                    self._reset(key, version, previous)  # Unless the cart has moved past this write
+                    raise
+            return version, result
+        
+        raise StaleCart()  # Lost the race too many times
+    
+    def _reset(self, key, version, fields=None):
+        """Replace the hash with fields, or delete it, if the cart is still at version"""
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if int(pipe.hget(key, 'v') or 0) != version:
+                    return  # Written again since; keep the newer cart
+                pipe.multi()
+                pipe.delete(key)
+                if fields:
+                    pipe.hset(key, mapping=fields)
+                    pipe.expire(key, self.ttl)
+                pipe.execute()
+            except WatchError:
+                pass
+    
+    def _version_floor(self, user_id):
+        return db.session.query(Cart.version).filter_by(user_id=user_id).scalar() or 0
+    
+    def version(self, user_id):
+        return int(self.client.hget(self._key(user_id), 'v') or 0)
+    
+    def load(self, user_id):
+        version, promo_code, items = self._read(user_id)
+        if not version:
+            return None
+        
+        products = load_products(list(items), for_display=True)
+        lines = [
+            CartLine(product_id, product_id, products[product_id], quantity,
+                     datetime.fromtimestamp(added, timezone.utc))
+            for product_id, (quantity, added) in sorted(items.items(), key=lambda item: item[1][1])
+            if product_id in products
+        ]
+        return CartView(None, version, promo_code, lines)
+    
+    def pricing_state(self, user_id):
+        version, promo_code, items = self._read(user_id)
+        return version, promo_code, list(load_products(list(items)).values())
+    
+    def count(self, user_id):
+        _, _, items = self._read(user_id)
+        return len(items), sum(quantity for quantity, _ in items.values())
+    
+    def add(self, user_id, product, quantity, expected_version=None):
+        def change(items, promo_code):
+            in_cart, added = items.get(product.id, (0, time.time()))
+            if in_cart + quantity > product.stock:
+                raise NotEnoughStock(
+                    f'Cannot add more. Only {product.stock} items available, you have {in_cart} in cart'
+                )
+            items[product.id] = (in_cart + quantity, added)
+            return items, promo_code, in_cart + quantity
+        
+        version, new_quantity = self._mutate(user_id, expected_version, change)
+        return AddedItem(product.id, new_quantity, version)
+    
+    def update(self, user_id, product_id, quantity, stock, expected_version=None):
+        def change(items, promo_code):
+            if product_id not in items:
+                raise ItemNotInCart()
+            if quantity > stock:
+                raise NotEnoughStock(f'Only {stock} items available')
+            items[product_id] = (quantity, items[product_id][1])
+            return items, promo_code, None
+        
+        return self._mutate(user_id, expected_version, change, create=False)[0]
+    
+    def remove(self, user_id, product_id, expected_version=None):
+        def change(items, promo_code):
+            if items.pop(product_id, None) is None:
+                raise ItemNotInCart()
+            return items, promo_code, None
+        
+        return self._mutate(user_id, expected_version, change, create=False)[0]
+    
+    def clear(self, user_id, expected_version=None):
+        try:
+            return self._mutate(user_id, expected_version, lambda items, promo_code: ({}, promo_code, None), create=False)[0]
+        except CartNotFound:
+            return None
+    
+    def batch(self, user_id, operations, products, expected_version=None):
+        def change(items, promo_code):
+            current = {product_id: quantity for product_id, (quantity, _) in items.items()}
+            quantities, results, applied = plan_operations(current, operations, products)
+            now = time.time()
+            items = {
+                product_id: (quantity, items[product_id][1] if product_id in items else now)
+                for product_id, quantity in quantities.items()
+            }
+            return items, promo_code, (results, applied)
+        
+        version, (results, applied) = self._mutate(user_id, expected_version, change)
+        return results, applied, version
+    
+    def set_promo(self, user_id, promo_code, expected_version=None):
+        return self._mutate(
+            user_id, expected_version,
+            lambda items, _: (items, promo_code, None),
+            create=promo_code is not None
+        )[0]
+    
+    def merge(self, user_id, products, quantities):
+        def change(items, promo_code):
+            current = {product_id: quantity for product_id, (quantity, _) in items.items()}
+            merged = merged_quantities(current, products, quantities)
+            now = time.time()
+            items = {
+                product_id: (quantity, items[product_id][1] if product_id in items else now)
+                for product_id, quantity in merged.items()
+            }
+            return items, promo_code, added_quantities(current, merged, products)
+        
+        return self._mutate(user_id, None, change, then=db.session.commit)[1]
+    
+    def persist(self, user_id):
+        version, promo_code, items = self._read(user_id)
+        
+        cart = Cart.query.filter_by(user_id=user_id).first()
+        if not cart:
+            cart = Cart(user_id=user_id)
+            db.session.add(cart)
+            db.session.flush()
+        
+        cart.version = max(cart.version or 1, version)  # Never lower it
+        cart.promo_code = promo_code
+        CartItem.query.filter_by(cart_id=cart.id).delete()
+        
+        products = load_products(list(items))
+        write_cart_items(cart.id, products, {
+            product_id: quantity for product_id, (quantity, _) in items.items() if product_id in products
+        })
+        db.session.commit()
+    
+    def forget(self, user_id, version=None):
+        if version is None:
+            self.client.delete(self._key(user_id))
+        else:
+            self._reset(self._key(user_id), version)
+
+
+class InProcessRedis:
+    """
+    Thread-safe stand-in for the few Redis commands KeyValueCartStore uses
+    (HGET, HGETALL, HSET, DELETE, EXPIRE and WATCH/MULTI/EXEC pipelines).
+    Keys never expire; data lives as long as the process.
+    """
+    
+    def __init__(self):
+        self._data = {}
+        self._writes = {}
+        self._lock = threading.Lock()
+    
+    def hget(self, key, field):
+        return self._data.get(key, {}).get(field)
+    
+    def hgetall(self, key):
+        return dict(self._data.get(key, {}))
+    
+    def delete(self, key):
+        with self._lock:
+            self._delete(key)
+    
+    def pipeline(self):
+        return InProcessPipeline(self)
+    
+    def _delete(self, key):
+        self._data.pop(key, None)
+        self._writes[key] = self._writes.get(key, 0) + 1
+    
+    def _hset(self, key, mapping):
+        self._data.setdefault(key, {}).update({field: str(value) for field, value in mapping.items()})
+        self._writes[key] = self._writes.get(key, 0) + 1
+
+
+class InProcessPipeline:
+    def __init__(self, client):
+        self.client = client
+        self.watched = {}
+        self.commands = []
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.watched, self.commands = {}, []
+    
+    def watch(self, key):
+        self.watched[key] = self.client._writes.get(key, 0)
+    
+    def hget(self, key, field):
+        return self.client.hget(key, field)
+    
+    def hgetall(self, key):
+        return self.client.hgetall(key)
+    
+    def multi(self):
+        self.commands = []
+    
+    def delete(self, key):
+        self.commands.append((self.client._delete, (key,)))
+    
+    def hset(self, key, mapping):
+        self.commands.append((self.client._hset, (key, mapping)))
+    
+    def expire(self, key, seconds):
+        pass
+    
+    def execute(self):
+        with self.client._lock:
+            if any(self.client._writes.get(key, 0) != seen for key, seen in self.watched.items()):
+                raise WatchError('Watched key changed')
+            for command, args in self.commands:
+                command(*args)
+        self.watched, self.commands = {}, []
+
+
+def make_cart_store(config):
+    """Build the cart store selected by CART_STORE"""
+    backend = config.get('CART_STORE') or os.getenv('CART_STORE', 'sql')
+    
+    if backend == 'sql':
+        return SqlCartStore()
+    if backend == 'memory':
+        return KeyValueCartStore(InProcessRedis())
+    if backend == 'redis':
+        import redis
+        url = config.get('REDIS_URL') or os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+        return KeyValueCartStore(redis.Redis.from_url(url, decode_responses=True))
+    
+    raise ValueError(f'Unknown CART_STORE: {backend}')
+
+
+def get_cart_store():
+    """The app's cart store, built on first use"""
+    store = current_app.extensions.get('cart_store')
+    if store is None:
+        store = current_app.extensions['cart_store'] = make_cart_store(current_app.config)
+    return store
@@ -2,44 +2,107 @@ from flask import Blueprint, jsonify, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from models import User, Cart, CartItem, Order, OrderItem, Payment, Product
 from extensions import db, mail
+from pricing import priced_lines, quote_priced_lines, standard_shipping_cents
+from promos import promo_codes
+from cart_store import get_cart_store, load_products
+from cache import TTLCache
+from dbutils import dialect_insert
+from stripe_gateway import get_stripe_gateway, GatewayUnavailable
+from auth import admin_required
+from stripe_prices import stripe_price_ids
+from orders import preview_image_select
+from webhook_inbox import store_event, wake_webhook_workers, webhook_handler, inbox_stats
 from flask_mail import Message
+from sqlalchemy import select, insert, update, delete, case
 import stripe
+import json
+import time
 import os
 
 checkout_bp = Blueprint("checkout", __name__, url_prefix="/api/checkout")
 
-# Configure Stripe
-stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+# Stripe sessions expire after this long; their URLs are cached per idempotency
+# key for slightly less, so a repeated checkout never gets an expired URL
+CHECKOUT_SESSION_TTL = max(1800, int(os.getenv('CHECKOUT_SESSION_TTL', 1800)))
+checkout_sessions = TTLCache(maxsize=10000, ttl=CHECKOUT_SESSION_TTL - 60)
+
+MAX_IDEMPOTENCY_KEY_LENGTH = 200
+
+# Stripe metadata values hold at most 500 characters
+METADATA_VALUE_LENGTH = 500
+
+
+@checkout_bp.errorhandler(GatewayUnavailable)
+def gateway_unavailable(error):
+    """Stripe's circuit breaker is open: fail fast instead of tying up a worker"""
+    response = jsonify({'error': str(error), 'code': 'payment_provider_unavailable'})
+    response.headers['Retry-After'] = str(max(1, round(error.retry_after)))
+    return response, 503
 
 
 @checkout_bp.route('/create-session', methods=['POST'])
 @jwt_required()
 def create_checkout_session():
-    """Create a Stripe checkout session from the user's cart"""
+    """
+    Create a Stripe checkout session from the user's cart.
+    Idempotent per Idempotency-Key header, or per cart version when the header
+    is absent: a repeat returns the cached session without calling
+    Stripe, and the key is forwarded to Stripe as its idempotency key.
+    """
     user_id = get_jwt_identity()
+    
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is not None:
+        if not idempotency_key or len(idempotency_key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+            return jsonify({'error': f'Idempotency-Key must be 1 to {MAX_IDEMPOTENCY_KEY_LENGTH} characters'}), 400
+        cached = cached_session(user_id, idempotency_key)
+        if cached:
+            return replayed_session_response(cached)
+    
     user = User.query.get(user_id)
     
     if not user:
         return jsonify({'error': 'User not found'}), 404
     
-    # Get user's cart
+    store = get_cart_store()
+    if idempotency_key is None:
+        # Read the version without writing, so a replay leaves the cart alone
+        idempotency_key = f'cart-v{store.version(user_id)}'
+        cached = cached_session(user_id, idempotency_key)
+        if cached:
+            return replayed_session_response(cached)
+    
+    # Get user's cart (a key-value cart store writes the live cart to the database first)
+    store.persist(user_id)
     cart = Cart.query.filter_by(user_id=user_id).first()
     
     if not cart or not cart.items:
         return jsonify({'error': 'Cart is empty'}), 400
     
-    # Build line items for Stripe
+    # Price the cart once; Stripe line items use the quoted unit prices
+    # less the promo discount, so the Stripe total matches the cart. The
+    # priced lines go in the session's metadata, so the order is made from
+    # what was paid for even if the cart changes before it is created.
+    discount_percent = promo_codes.discount_percent(cart.promo_code)
+    priced = priced_lines((item.product, item.quantity) for item in cart.items)
+    quote = quote_priced_lines(priced, discount_percent=discount_percent)
+    
+    # Build line items for Stripe, by synced price id where there is one
+    price_ids = stripe_price_ids([
+        (line.product_id, line.charged_unit_price_cents) for line in quote.lines
+    ])
     line_items = []
     for item in cart.items:
         product = item.product
         if not product or not product.is_active:
             continue
         
-        # Get the price (use sale price if on sale)
-        if product.is_on_sale and product.sale_price_cents:
-            unit_price = product.sale_price_cents
-        else:
-            unit_price = product.price_cents
+        unit_price = quote.line_for(product.id).charged_unit_price_cents
+        
+        price_id = price_ids.get((product.id, unit_price))
+        if price_id:
+            line_items.append({'price': price_id, 'quantity': item.quantity})
+            continue
         
         # Get product image
         image_url = None
@@ -72,10 +135,14 @@ def create_checkout_session():
         return jsonify({'error': 'No valid items in cart'}), 400
     
     frontend_url = os.getenv('FRONTEND_URL', 'http://localhost:3000')
+    standard_shipping = standard_shipping_cents(quote.subtotal_cents)
+    now = int(time.time())
     
     try:
         # Create Stripe checkout session
-        checkout_session = stripe.checkout.Session.create(
+        checkout_session = get_stripe_gateway().create_checkout_session(
+            idempotency_key=stripe_idempotency_key(user_id, idempotency_key, cart.version, now),
+            expires_at=now + CHECKOUT_SESSION_TTL,
             payment_method_types=['card'],
             line_items=line_items,
             mode='payment',
@@ -84,6 +151,11 @@ def create_checkout_session():
             customer_email=user.email,
             metadata={
                 'user_id': str(user_id),
+                'promo_code': cart.promo_code if discount_percent else '',
+                'discount_percent': str(discount_percent or 0),
+                'idempotency_key': idempotency_key,
+                'cart_version': str(cart.version),
+                **snapshot_metadata(priced),
             },
             shipping_address_collection={
                 'allowed_countries': ['CA', 'US'],
@@ -92,8 +164,8 @@ def create_checkout_session():
                 {
                     'shipping_rate_data': {
                         'type': 'fixed_amount',
-                        'fixed_amount': {'amount': 0, 'currency': 'cad'},
-                        'display_name': 'Free Shipping',
+                        'fixed_amount': {'amount': standard_shipping, 'currency': 'cad'},
+                        'display_name': 'Standard Shipping' if standard_shipping else 'Free Shipping',
                         'delivery_estimate': {
                             'minimum': {'unit': 'business_day', 'value': 5},
                             'maximum': {'unit': 'business_day', 'value': 7},
@@ -115,15 +187,75 @@ def create_checkout_session():
             automatic_tax={'enabled': False},
         )
         
-        return jsonify({
+        session_data = {
             'checkout_url': checkout_session.url,
             'session_id': checkout_session.id
-        }), 200
+        }
+        checkout_sessions.set((user_id, idempotency_key), session_data)
+        
+        return jsonify(session_data), 200
         
     except stripe.error.StripeError as e:
         return jsonify({'error': str(e)}), 500
 
 
+def stripe_idempotency_key(user_id, idempotency_key, cart_version, now):
+    """
+    Key forwarded to Stripe. Stripe replays a key for 24 hours, longer than a
+    session lives, so the key also names the session lifetime window it was
+    used in; a replay from Stripe is then always a session that is still open.
+    The cart version keeps a key reused after an order from replaying its
+    paid session.
+    """
+    return f'checkout-{user_id}-{idempotency_key}-v{cart_version}-{now // CHECKOUT_SESSION_TTL}'
+
+
+def snapshot_metadata(lines):
+    """Session metadata holding priced cart lines, split over cart_0, cart_1, ... to fit Stripe's value limit"""
+    text = ';'.join(':'.join(str(value) for value in line) for line in lines)
+    return {
+        f'cart_{index}': text[start:start + METADATA_VALUE_LENGTH]
+        for index, start in enumerate(range(0, len(text), METADATA_VALUE_LENGTH))
+    }
+
+
+def paid_lines(metadata):
+    """The priced cart lines a session was paid for, or None if it was created without them"""
+    chunks = []
+    while f'cart_{len(chunks)}' in metadata:
+        chunks.append(metadata[f'cart_{len(chunks)}'])
+    if not chunks:
+        return None
+    return [tuple(int(value) for value in line.split(':')) for line in ''.join(chunks).split(';')]
+
+
+def cached_session(user_id, idempotency_key):
+    """
+    The session cached for an idempotency key, unless it has been paid since.
+    Order creation evicts the entry in its own process; other workers learn
+    of the payment from the payments table.
+    """
+    cached = checkout_sessions.get((user_id, idempotency_key))
+    if cached and session_paid(cached['session_id']):
+        checkout_sessions.pop((user_id, idempotency_key))
+        return None
+    return cached
+
+
+def session_paid(session_id):
+    """Whether a payment has been recorded for a checkout session"""
+    return db.session.query(Payment.id).filter(
+        Payment.raw_response['session_id'].as_string() == session_id
+    ).first() is not None
+
+
+def replayed_session_response(session_data):
+    """The cached session for a repeated create-session call"""
+    response = jsonify(session_data)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response, 200
+
+
 @checkout_bp.route('/session/<session_id>', methods=['GET'])
 @jwt_required()
 def get_session_details(session_id):
@@ -132,7 +264,7 @@ def get_session_details(session_id):
     
     try:
         # Retrieve the session from Stripe
-        session = stripe.checkout.Session.retrieve(
+        session = get_stripe_gateway().retrieve_checkout_session(
             session_id,
             expand=['line_items', 'payment_intent']
         )
@@ -144,30 +276,14 @@ def get_session_details(session_id):
         if session.payment_status != 'paid':
             return jsonify({'error': 'Payment not completed'}), 400
         
-        # Get payment intent ID (it's an object when expanded, string otherwise)
-        payment_intent_id = session.payment_intent.id if hasattr(session.payment_intent, 'id') else session.payment_intent
-        
-        # Check if order already exists for this session
-        existing_payment = Payment.query.filter_by(provider_payment_id=payment_intent_id).first()
-        
-        if existing_payment:
-            # Order already created, return it
-            order = Order.query.filter_by(payment_id=existing_payment.id).first()
-            if order:
-                return jsonify({
-                    'success': True,
-                    'order_id': order.id,
-                    'already_processed': True
-                }), 200
-        
-        # Create order from session
-        order = create_order_from_session(session, user_id)
+        # Create the order, or get the one the webhook (or an earlier visit) created
+        order, created = create_order_from_session(session, user_id)
         
         if order:
             return jsonify({
                 'success': True,
                 'order_id': order.id,
-                'already_processed': False
+                'already_processed': not created
             }), 200
         else:
             return jsonify({'error': 'Failed to create order'}), 500
@@ -176,99 +292,164 @@ def get_session_details(session_id):
         return jsonify({'error': str(e)}), 500
 
 
+def payment_intent_id_of(session):
+    """Payment intent ID of a session (it's an object when expanded, string otherwise)"""
+    return session.payment_intent.id if hasattr(session.payment_intent, 'id') else session.payment_intent
+
+
+def order_for_payment(payment_intent_id):
+    """The order paid by a Stripe payment intent, if one has been created"""
+    return Order.query.join(Payment, Order.payment_id == Payment.id).filter(
+        Payment.provider_payment_id == payment_intent_id
+    ).first()
+
+
+def claim_payment(payment_intent_id, amount_cents, session_id):
+    """
+    Insert the payment row for a checkout session unless it already exists.
+    The insert is the claim on the session: the unique provider_payment_id
+    makes a concurrent claimer wait until the winner's transaction ends and
+    then insert nothing. Returns the new payment id, or None if another
+    request got there first.
+    """
+    stmt = dialect_insert(Payment).values(
+        provider='stripe',
+        provider_payment_id=payment_intent_id,
+        status='succeeded',
+        amount_cents=amount_cents,
+        currency='CAD',
+        raw_response={'session_id': session_id}
+    )
+    return db.session.execute(
+        stmt.on_conflict_do_nothing(index_elements=['provider_payment_id']).returning(Payment.id)
+    ).scalar()
+
+
 def create_order_from_session(session, user_id):
-    """Create an order from a completed Stripe checkout session"""
+    """
+    Create an order from a completed Stripe checkout session, exactly once.
+    The order has the lines and prices the session was paid for (see
+    paid_lines), however the cart or prices changed since; sessions created
+    without them order the cart. The success page, the webhook and the
+    reconcile job may all get here for the same session; whichever claims the
+    payment first creates the order and the others return it. The writes are
+    one short transaction with the same handful of statements however many
+    lines the order has. Returns (order, created); order is None if it failed.
+    """
+    payment_intent_id = payment_intent_id_of(session)
+    metadata = session.metadata or {}
+    cart_version = int(metadata['cart_version']) if metadata.get('cart_version') else None
+    
     try:
-        user = User.query.get(user_id)
-        cart = Cart.query.filter_by(user_id=user_id).first()
-        
-        if not cart or not cart.items:
-            return None
+        existing = order_for_payment(payment_intent_id)
+        if existing:
+            return existing, False
         
-        # Calculate totals
-        subtotal_cents = 0
-        order_items_data = []
+        paid = paid_lines(metadata)
+        if paid is None:
+            # Cart lines in one query and their products (with categories, for
+            # sale prices) in a second
+            lines = db.session.query(CartItem.product_id, CartItem.quantity).join(
+                Cart, Cart.id == CartItem.cart_id
+            ).filter(Cart.user_id == user_id).all()
+            cart_products = load_products([product_id for product_id, _ in lines])
+            paid = priced_lines((cart_products.get(product_id), quantity) for product_id, quantity in lines)
         
-        for item in cart.items:
-            product = item.product
-            if not product:
-                continue
-            
-            # Get the price used
-            if product.is_on_sale and product.sale_price_cents:
-                unit_price = product.sale_price_cents
-            else:
-                unit_price = product.price_cents
-            
-            line_total = unit_price * item.quantity
-            subtotal_cents += line_total
-            
-            order_items_data.append({
-                'product_id': product.id,
-                'title_snapshot': product.title,
-                'unit_price_cents': unit_price,
-                'quantity': item.quantity,
-                'line_total_cents': line_total
-            })
+        if not paid:
+            # Nothing to order, unless the other side just created it and emptied the cart
+            return order_for_payment(payment_intent_id), False
         
         # Get shipping cost from session
         shipping_cents = session.shipping_cost.amount_total if session.shipping_cost else 0
         
-        # Calculate tax (13% HST for Ontario)
-        tax_cents = int((subtotal_cents + shipping_cents) * 0.13)
-        
-        total_cents = subtotal_cents + shipping_cents + tax_cents
-        
-        # Get payment intent ID (it's an object when expanded, string otherwise)
-        payment_intent_id = session.payment_intent.id if hasattr(session.payment_intent, 'id') else session.payment_intent
-        
-        # Create payment record
-        payment = Payment(
-            provider='stripe',
-            provider_payment_id=payment_intent_id,
-            status='succeeded',
-            amount_cents=total_cents,
-            currency='CAD',
-            raw_response={'session_id': session.id}
+        # Price the paid lines with the shipping rate picked on Stripe and the
+        # promo discount the session was created with
+        quote = quote_priced_lines(
+            paid,
+            shipping_cents=shipping_cents,
+            discount_percent=int(metadata.get('discount_percent') or 0)
         )
-        db.session.add(payment)
-        db.session.flush()
+        quantities = {line.product_id: line.quantity for line in quote.lines}
+        products = {product.id: product for product in Product.query.filter(Product.id.in_(quantities))}
+        
+        # Claim the session by creating its payment record; everything before
+        # this only read, so a loser has written nothing
+        payment_id = claim_payment(payment_intent_id, quote.total_cents, session.id)
+        if payment_id is None:
+            db.session.rollback()
+            return order_for_payment(payment_intent_id), False
         
         # Create order
         order = Order(
             user_id=user_id,
-            subtotal_cents=subtotal_cents,
-            tax_cents=tax_cents,
+            subtotal_cents=quote.subtotal_cents,
+            discount_cents=quote.discount_cents,
+            promo_code=metadata.get('promo_code') or None,
+            tax_cents=quote.tax_cents,
             shipping_cents=shipping_cents,
-            total_cents=total_cents,
+            total_cents=quote.total_cents,
             currency='CAD',
-            payment_id=payment.id
+            payment_id=payment_id,
+            item_count=len(quote.lines),
+            first_item_name=products[quote.lines[0].product_id].title,
+            preview_image_url=db.session.execute(preview_image_select(quote.lines[0].product_id)).scalar()
         )
         db.session.add(order)
         db.session.flush()
         
-        # Create order items
-        for item_data in order_items_data:
-            order_item = OrderItem(
-                order_id=order.id,
-                **item_data
-            )
-            db.session.add(order_item)
+        # Lock the stock rows (in id order) to see what can be taken: never more
+        # than there is, as the payment is already taken. Each line records what
+        # it took, so a cancellation puts back exactly that.
+        stocks = dict(db.session.execute(
+            select(Product.id, Product.stock).where(Product.id.in_(quantities)).order_by(Product.id).with_for_update()
+        ).all())
+        taken = {
+            product_id: max(0, min(quantity, stocks.get(product_id, 0)))
+            for product_id, quantity in quantities.items()
+        }
         
-        # Clear the cart
-        CartItem.query.filter_by(cart_id=cart.id).delete()
+        # Order items in one multi-row INSERT
+        db.session.execute(insert(OrderItem).values([{
+            'order_id': order.id,
+            'product_id': line.product_id,
+            'title_snapshot': products[line.product_id].title,
+            'unit_price_cents': line.unit_price_cents,
+            'quantity': line.quantity,
+            'line_total_cents': line.line_total_cents,
+            'stock_taken': taken[line.product_id]
+        } for line in quote.lines]))
+        
+        # Take the stock in one UPDATE
+        db.session.execute(
+            update(Product).where(Product.id.in_(quantities)).values(
+                stock=Product.stock - case(taken, value=Product.id, else_=0)
+            ).execution_options(synchronize_session=False)
+        )
+        
+        # Clear the cart, unless it changed after checkout and now holds a new
+        # purchase; a promo code is used up by the order
+        clear = update(Cart).where(Cart.user_id == user_id)
+        if cart_version is not None:
+            clear = clear.where(Cart.version == cart_version)
+        cart_id = db.session.execute(
+            clear.values(promo_code=None, version=Cart.version + 1).returning(Cart.id)
+        ).scalar()
+        if cart_id is not None:
+            db.session.execute(delete(CartItem).where(CartItem.cart_id == cart_id))
         
         db.session.commit()
+        get_cart_store().forget(user_id, cart_version)
+        checkout_sessions.pop((str(user_id), metadata.get('idempotency_key')))
         
         # Send order confirmation email
-        send_order_confirmation_email(user, order)
+        send_order_confirmation_email(User.query.get(user_id), order)
         
-        return order
+        return order, True
         
     except Exception as e:
         db.session.rollback()
         print(f"Error creating order: {str(e)}")
-        return None
+        return None, False
 
 
 def send_order_confirmation_email(user, order):
@@ -290,6 +471,15 @@ def send_order_confirmation_email(user, order):
             </tr>
             """
         
+        discount_html = ""
+        if order.discount_cents:
+            discount_html = f"""
+                    <div style="display: flex; justify-content: space-between; margin-bottom: 8px;">
+                        <span style="color: #16a34a;">Promo ({order.promo_code}):</span>
+                        <span style="color: #16a34a;">-${order.discount_cents / 100:.2f}</span>
+                    </div>
+            """
+        
         msg = Message(
             subject=f'Order Confirmation - MDSRTech #{order.id}',
             recipients=[user.email],
@@ -328,6 +518,7 @@ def send_order_confirmation_email(user, order):
                         <span style="color: #6b7280;">Subtotal:</span>
                         <span style="color: #1f2937;">${order.subtotal_cents / 100:.2f}</span>
                     </div>
+                    {discount_html}
                     <div style="display: flex; justify-content: space-between; margin-bottom: 8px;">
                         <span style="color: #6b7280;">Shipping:</span>
                         <span style="color: #1f2937;">${order.shipping_cents / 100:.2f}</span>
@@ -361,7 +552,10 @@ def send_order_confirmation_email(user, order):
 
 @checkout_bp.route('/webhook', methods=['POST'])
 def stripe_webhook():
-    """Handle Stripe webhooks"""
+    """
+    Handle Stripe webhooks: verify, store in the inbox and acknowledge.
+    The webhook workers process the event afterwards (see webhook_inbox).
+    """
     payload = request.get_data()
     sig_header = request.headers.get('Stripe-Signature')
     webhook_secret = os.getenv('STRIPE_WEBHOOK_SECRET')
@@ -369,30 +563,57 @@ def stripe_webhook():
     # If no webhook secret configured, skip signature verification (for development)
     if webhook_secret:
         try:
-            event = stripe.Webhook.construct_event(
+            get_stripe_gateway().construct_event(
                 payload, sig_header, webhook_secret
             )
         except ValueError:
             return jsonify({'error': 'Invalid payload'}), 400
         except stripe.error.SignatureVerificationError:
             return jsonify({'error': 'Invalid signature'}), 400
-    else:
-        # Development mode - parse without verification
-        import json
+    
+    try:
         event = json.loads(payload)
+    except ValueError:
+        return jsonify({'error': 'Invalid payload'}), 400
     
-    # Handle the event
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        
-        # Payment was successful, create order
-        user_id = session.get('metadata', {}).get('user_id')
-        if user_id:
-            # Retrieve full session with expanded data
-            full_session = stripe.checkout.Session.retrieve(
-                session['id'],
-                expand=['line_items']
-            )
-            create_order_from_session(full_session, user_id)
+    if not isinstance(event, dict) or not event.get('id') or not event.get('type'):
+        return jsonify({'error': 'Invalid payload'}), 400
+    
+    stored = store_event(event)
+    if stored:
+        wake_webhook_workers()
     
-    return jsonify({'received': True}), 200
+    return jsonify({'received': True, 'duplicate': not stored}), 200
+
+
+@webhook_handler('checkout.session.completed')
+def handle_checkout_completed(event):
+    """Create the order for a paid checkout session, unless it already exists"""
+    session = event['data']['object']
+    
+    user_id = (session.get('metadata') or {}).get('user_id')
+    if not user_id:
+        return
+    
+    # Retrieve full session with expanded data
+    full_session = get_stripe_gateway().retrieve_checkout_session(
+        session['id'],
+        expand=['line_items']
+    )
+    
+    order, _ = create_order_from_session(full_session, user_id)
+    if order is None and (
+        paid_lines(full_session.metadata or {}) or CartItem.query.join(Cart).filter(Cart.user_id == user_id).first()
+    ):
+        raise RuntimeError('Order could not be created from the checkout session')
+
+
+@checkout_bp.route('/metrics', methods=['GET'])
+@jwt_required()
+@admin_required()
+def stripe_metrics():
+    """Stripe call latency, error counts and circuit breaker state for this worker, and webhook queue depth"""
+    return jsonify({
+        **get_stripe_gateway().status(),
+        'webhook_inbox': inbox_stats()
+    }), 200
@@ -0,0 +1,59 @@
+from sqlalchemy import select, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from extensions import db
+import time
+
+
+def dialect_insert(model):
+    """
+    Return an INSERT for model that supports ON CONFLICT clauses on the bound
+    database (PostgreSQL in production, SQLite in tests).
+    """
+    if db.session.get_bind().dialect.name == 'sqlite':
+        return sqlite.insert(model)
+    return postgresql.insert(model)
+
+
+def supports_writable_ctes():
+    """
+    Whether the bound database can run INSERT/DELETE inside a WITH clause, so
+    dependent writes can be chained into a single statement (PostgreSQL can,
+    SQLite cannot).
+    """
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def delete_in_batches(model, *criteria, batch_size=1000, pause=0, before_delete=None):
+    """
+    Delete rows of model matching criteria in primary-key chunks, committing
+    after each chunk so locks are held only briefly. Rows locked by live
+    transactions are skipped (FOR UPDATE SKIP LOCKED on PostgreSQL) and the
+    criteria are checked again by the DELETE, so a row touched mid-sweep
+    survives. before_delete(ids), if given, runs in each chunk's transaction
+    just before its DELETE. pause sleeps between chunks to throttle the job.
+    Returns (rows deleted, seconds taken).
+    """
+    started = time.monotonic()
+    deleted = 0
+    key = model.__mapper__.primary_key[0]
+    
+    while True:
+        ids = db.session.execute(
+            select(key).where(*criteria).order_by(key).limit(batch_size)
+            .with_for_update(skip_locked=True)
+        ).scalars().all()
+        if not ids:
+            break
+        
+        if before_delete:
+            before_delete(ids)
+        result = db.session.execute(
+            delete(model).where(key.in_(ids), *criteria).execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        deleted += result.rowcount
+        
+        if pause:
+            time.sleep(pause)
+    
+    return deleted, time.monotonic() - started
@@ -0,0 +1,326 @@
+"""
+Local stand-in for the parts of the Stripe API checkout uses, for load tests
+and offline development.
+
+    python fake_stripe.py --port 12111 \\
+        --webhook-url http://localhost:5000/api/checkout/webhook --webhook-secret whsec_fake
+
+Then run the backend with STRIPE_API_BASE=http://localhost:12111,
+STRIPE_SECRET_KEY=sk_test_fake and STRIPE_WEBHOOK_SECRET=whsec_fake.
+
+Serves checkout session create/retrieve/list, product, price and refund
+create, and honours Idempotency-Key. Paying a session (GET its url, or
+POST /_fake/sessions/<id>/pay) marks it paid and delivers a
+checkout.session.completed webhook signed like Stripe signs them.
+--latency-ms and --error-rate make it slow or flaky on purpose.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qsl
+import urllib.request
+import threading
+import argparse
+import secrets
+import random
+import hashlib
+import hmac
+import json
+import time
+import re
+
+
+API_VERSION = '2023-10-16'
+
+
+def parse_form(body):
+    """Decode Stripe's form encoding (a[b][0][c]=1) into nested dicts and lists"""
+    root = {}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        parts = re.findall(r'[^\[\]]+', key)
+        node = root
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return listify(root)
+
+
+def listify(node):
+    if not isinstance(node, dict):
+        return node
+    if node and all(key.isdigit() for key in node):
+        return [listify(node[key]) for key in sorted(node, key=int)]
+    return {key: listify(value) for key, value in node.items()}
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """Stripe-Signature header value for a webhook payload"""
+    timestamp = timestamp or int(time.time())
+    signed = f'{timestamp}.'.encode() + payload
+    signature = hmac.new(secret.encode(), signed, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+def new_id(prefix):
+    return f'{prefix}_fake_{secrets.token_hex(12)}'
+
+
+class FakeStripe:
+    """In-memory Stripe objects plus the HTTP server that serves them"""
+    
+    def __init__(self, webhook_url=None, webhook_secret='whsec_fake', latency_ms=0, error_rate=0.0):
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.url = None
+        self.sessions = {}
+        self.prices = {}
+        self.refunds = []
+        self.idempotent_replies = {}
+        self.webhooks_delivered = 0
+        self._lock = threading.Lock()
+        self._deliveries = ThreadPoolExecutor(max_workers=8)
+        self._server = None
+    
+    # Stripe objects
+    
+    def create_session(self, params):
+        line_items = params.get('line_items', [])
+        subtotal = 0
+        for line in line_items:
+            if 'price' in line:
+                unit_amount = self.prices.get(line['price'], {}).get('unit_amount', 0)
+            else:
+                unit_amount = int(line['price_data']['unit_amount'])
+            subtotal += unit_amount * int(line.get('quantity', 1))
+        
+        session_id = new_id('cs')
+        session = {
+            'id': session_id,
+            'object': 'checkout.session',
+            'url': f'{self.url}/pay/{session_id}',
+            'status': 'open',
+            'payment_status': 'unpaid',
+            'payment_intent': None,
+            'mode': params.get('mode', 'payment'),
+            'currency': 'cad',
+            'customer_email': params.get('customer_email'),
+            'metadata': params.get('metadata', {}),
+            'amount_subtotal': subtotal,
+            'amount_total': subtotal,
+            'shipping_cost': None,
+            'shipping_options': params.get('shipping_options', []),
+            'success_url': params.get('success_url'),
+            'created': int(time.time()),
+            'expires_at': int(params.get('expires_at') or time.time() + 86400)
+        }
+        with self._lock:
+            self.sessions[session_id] = session
+        return session
+    
+    def list_sessions(self, params):
+        """Newest first, filtered by status and created[gte/gt/lte/lt], paged by starting_after"""
+        created = params.get('created') or {}
+        bounds = {
+            'gte': lambda c, v: c >= v, 'gt': lambda c, v: c > v,
+            'lte': lambda c, v: c <= v, 'lt': lambda c, v: c < v
+        }
+        with self._lock:
+            sessions = [
+                session for session in reversed(list(self.sessions.values()))
+                if params.get('status') in (None, session['status'])
+                and all(bounds[op](session['created'], int(value)) for op, value in created.items())
+            ]
+        
+        if params.get('starting_after'):
+            ids = [session['id'] for session in sessions]
+            sessions = sessions[ids.index(params['starting_after']) + 1:] if params['starting_after'] in ids else []
+        limit = min(100, int(params.get('limit', 10)))
+        return {
+            'object': 'list',
+            'url': '/v1/checkout/sessions',
+            'data': sessions[:limit],
+            'has_more': len(sessions) > limit
+        }
+    
+    def create_price(self, params):
+        price = {
+            'id': new_id('price'),
+            'object': 'price',
+            'product': params.get('product'),
+            'unit_amount': int(params.get('unit_amount', 0)),
+            'currency': params.get('currency', 'cad')
+        }
+        with self._lock:
+            self.prices[price['id']] = price
+        return price
+    
+    def complete_session(self, session_id):
+        """
+        Pay a session: mark it paid with the first shipping option and build
+        its checkout.session.completed event. Returns (payload, signature header).
+        """
+        with self._lock:
+            session = self.sessions[session_id]
+            if session['payment_status'] != 'paid':
+                options = session['shipping_options']
+                shipping = int(options[0]['shipping_rate_data']['fixed_amount']['amount']) if options else 0
+                session.update({
+                    'status': 'complete',
+                    'payment_status': 'paid',
+                    'payment_intent': new_id('pi'),
+                    'shipping_cost': {'amount_total': shipping},
+                    'amount_total': session['amount_subtotal'] + shipping
+                })
+        
+        payload = json.dumps({
+            'id': new_id('evt'),
+            'object': 'event',
+            'api_version': API_VERSION,
+            'created': int(time.time()),
+            'type': 'checkout.session.completed',
+            'data': {'object': session}
+        }).encode()
+        return payload, sign_payload(payload, self.webhook_secret)
+    
+    def deliver_webhook(self, payload, signature, attempts=5):
+        """POST a signed event to webhook_url, retrying failures with backoff like Stripe does"""
+        for attempt in range(attempts):
+            request = urllib.request.Request(self.webhook_url, data=payload, method='POST', headers={
+                'Content-Type': 'application/json',
+                'Stripe-Signature': signature
+            })
+            try:
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    if response.status < 300:
+                        with self._lock:
+                            self.webhooks_delivered += 1
+                        return True
+            except Exception as e:
+                print(f"Webhook delivery failed (attempt {attempt + 1}): {str(e)}")
+            time.sleep(0.5 * 2 ** attempt)
+        return False
+    
+    def pay(self, session_id):
+        payload, signature = self.complete_session(session_id)
+        if self.webhook_url:
+            self._deliveries.submit(self.deliver_webhook, payload, signature)
+        return self.sessions[session_id]
+    
+    # HTTP
+    
+    def handle(self, method, path, headers, body):
+        """Route one request. Returns (status, JSON-able body) or (status, None, redirect location)."""
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        if path.startswith('/v1/') and self.error_rate and random.random() < self.error_rate:
+            return 500, {'error': {'type': 'api_error', 'message': 'Injected failure'}}
+        
+        idempotency_key = headers.get('Idempotency-Key')
+        if method == 'POST' and idempotency_key:
+            cached = self.idempotent_replies.get((path, idempotency_key))
+            if cached:
+                return cached
+        
+        reply = self.route(method, path, parse_form(body) if body else {})
+        
+        if method == 'POST' and idempotency_key and reply[0] < 500:
+            self.idempotent_replies[(path, idempotency_key)] = reply
+        return reply
+    
+    def route(self, method, path, params):
+        parts = [part for part in path.split('/') if part]
+        
+        if method == 'POST' and parts == ['v1', 'checkout', 'sessions']:
+            return 200, self.create_session(params)
+        if method == 'GET' and parts == ['v1', 'checkout', 'sessions']:
+            return 200, self.list_sessions(params)
+        if method == 'GET' and parts[:3] == ['v1', 'checkout', 'sessions'] and len(parts) == 4:
+            session = self.sessions.get(parts[3])
+            if session is None:
+                return 404, {'error': {'type': 'invalid_request_error', 'message': f'No such checkout.session: {parts[3]}'}}
+            return 200, session
+        if method == 'POST' and parts == ['v1', 'products']:
+            return 200, {'id': new_id('prod'), 'object': 'product', 'name': params.get('name')}
+        if method == 'POST' and parts == ['v1', 'prices']:
+            return 200, self.create_price(params)
+        if method == 'POST' and parts == ['v1', 'refunds']:
+            refund = {'id': new_id('re'), 'object': 'refund', 'status': 'succeeded', 'payment_intent': params.get('payment_intent')}
+            with self._lock:
+                self.refunds.append(refund)
+            return 200, refund
+        if parts[:2] == ['_fake', 'sessions'] and len(parts) == 4 and parts[3] == 'pay' and parts[2] in self.sessions:
+            return 200, self.pay(parts[2])
+        if method == 'GET' and parts[:1] == ['pay'] and len(parts) == 2 and parts[1] in self.sessions:
+            session = self.pay(parts[1])
+            return 303, None, (session['success_url'] or '/').replace('{CHECKOUT_SESSION_ID}', session['id'])
+        
+        return 404, {'error': {'type': 'invalid_request_error', 'message': f'Unrecognized request URL ({method}: {path})'}}
+    
+    def serve(self, host='127.0.0.1', port=12111):
+        """Start serving on a background thread. Returns self; url holds the base URL."""
+        fake = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def respond(self):
+                url = urlsplit(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode() if length else url.query
+                reply = fake.handle(self.command, url.path, self.headers, body)
+                
+                if reply[0] == 303:
+                    self.send_response(303)
+                    self.send_header('Location', reply[2])
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                
+                payload = json.dumps(reply[1]).encode()
+                self.send_response(reply[0])
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+            
+            do_GET = do_POST = respond
+            
+            def log_message(self, *args):
+                pass
+        
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.url = f'http://{host}:{self._server.server_address[1]}'
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+    
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._deliveries.shutdown(wait=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local fake Stripe API for checkout load testing')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12111)
+    parser.add_argument('--webhook-url', help='Where to deliver checkout.session.completed events')
+    parser.add_argument('--webhook-secret', default='whsec_fake', help='Secret webhooks are signed with')
+    parser.add_argument('--latency-ms', type=int, default=0, help='Added to every API reply')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of API calls answered with a 500')
+    args = parser.parse_args()
+    
+    fake = FakeStripe(args.webhook_url, args.webhook_secret, args.latency_ms, args.error_rate)
+    fake.serve(args.host, args.port)
+    print(f'Fake Stripe listening on {fake.url}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+GET /api/cart/guest: Get the anonymous shopper's cart
+POST /api/cart/guest/add: Add a product to the guest cart
+PUT /api/cart/guest/update: Update quantity of a guest cart item
+DELETE /api/cart/guest/remove: Remove a product from the guest cart
+
+Guest carts are keyed by a signed cookie and folded into the user's cart
+at login, registration or OAuth callback (see merge_guest_cart).
+"""
+
+from flask import Blueprint, jsonify, request, current_app
+from itsdangerous import URLSafeSerializer, BadSignature
+from sqlalchemy.exc import SQLAlchemyError
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from extensions import db
+from models import GuestCart, Product
+from cart import cart_to_dict
+from cart_store import get_cart_store, load_products, CartStoreError
+from dbutils import delete_in_batches
+import secrets
+import click
+
+
+guest_cart_bp = Blueprint('guest_cart', __name__, url_prefix='/api/cart/guest', cli_group='guest-cart')
+
+GUEST_CART_COOKIE = 'guest_cart'
+GUEST_CART_MAX_AGE = timedelta(days=30)
+MAX_GUEST_CART_ITEMS = 100
+
+GuestCartLine = namedtuple('GuestCartLine', 'id product_id product quantity added_at')
+
+
+def _serializer():
+    secret = current_app.config.get('SECRET_KEY') or current_app.config['JWT_SECRET_KEY']
+    return URLSafeSerializer(secret, salt='guest-cart')
+
+
+def get_guest_cart():
+    """Get the guest cart referenced by the request's signed cookie, if any"""
+    signed_token = request.cookies.get(GUEST_CART_COOKIE)
+    if not signed_token:
+        return None
+    
+    try:
+        token = _serializer().loads(signed_token)
+    except BadSignature:
+        return None
+    
+    return GuestCart.query.filter_by(token=token).first()
+
+
+def remember_guest_cart(response, guest_cart):
+    """Set the signed guest cart cookie on a response"""
+    response.set_cookie(
+        GUEST_CART_COOKIE,
+        _serializer().dumps(guest_cart.token),
+        max_age=int(GUEST_CART_MAX_AGE.total_seconds()),
+        httponly=True,
+        secure=request.is_secure,
+        samesite='None' if request.is_secure else 'Lax'
+    )
+    return response
+
+
+def forget_guest_cart(response):
+    """Remove the guest cart cookie from a response"""
+    response.delete_cookie(GUEST_CART_COOKIE)
+    return response
+
+
+def guest_cart_lines(guest_cart):
+    """Load products for a guest cart in one query and pair them with quantities"""
+    quantities = {int(product_id): quantity for product_id, quantity in guest_cart.items.items()}
+    if not quantities:
+        return []
+    
+    products = load_products(quantities, for_display=True)
+    
+    # Keep the order products were added in
+    return [
+        GuestCartLine(product_id, product_id, products[product_id], quantity, guest_cart.updated_at)
+        for product_id, quantity in quantities.items() if product_id in products
+    ]
+
+
+def merge_guest_cart(user_id):
+    """
+    Fold the requester's guest cart into the user's cart.
+    Quantities are summed with what the user already has and capped at
+    current stock (see CartStore.merge; the SQL store writes them with one
+    bulk upsert on (cart_id, product_id)), and the guest cart is deleted in
+    the same commit.
+    Returns the number of lines that added to the cart. Never raises, so login cannot fail on it.
+    """
+    guest_cart = get_guest_cart()
+    if not guest_cart:
+        return 0
+    
+    try:
+        quantities = {int(product_id): quantity for product_id, quantity in guest_cart.items.items()}
+        products = load_products(quantities)
+        
+        db.session.delete(guest_cart)
+        added = get_cart_store().merge(user_id, products, quantities)  # Commits the delete too
+        return sum(1 for quantity in added.values() if quantity)
+    except (SQLAlchemyError, CartStoreError) as e:
+        db.session.rollback()
+        print(f"Error merging guest cart: {str(e)}")
+        return 0
+
+
+def expire_guest_carts(max_age_days=30, batch_size=1000):
+    """Delete guest carts untouched for max_age_days, in batches. Returns rows deleted."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=max_age_days)
+    deleted, _ = delete_in_batches(GuestCart, GuestCart.updated_at < cutoff, batch_size=batch_size)
+    return deleted
+
+
+@guest_cart_bp.cli.command('expire')
+@click.option('--days', default=30, show_default=True, help='Delete guest carts idle for this many days.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows deleted per transaction.')
+def expire_guest_carts_command(days, batch_size):
+    """Delete abandoned guest carts."""
+    deleted = expire_guest_carts(days, batch_size)
+    click.echo(f'Expired {deleted} guest carts')
+
+
+@guest_cart_bp.route('', methods=['GET'])
+def get_cart():
+    """Get all items in the guest cart with full product details"""
+    guest_cart = get_guest_cart()
+    lines = guest_cart_lines(guest_cart) if guest_cart else []
+    
+    return jsonify(cart_to_dict(None, lines)), 200
+
+
+@guest_cart_bp.route('/add', methods=['POST'])
+def add_to_cart():
+    """Add a product to the guest cart or update quantity if already exists"""
+    data = request.get_json()
+    
+    product_id = data.get('product_id')
+    quantity = data.get('quantity', 1)
+    
+    if not product_id:
+        return jsonify({'error': 'Product ID is required'}), 400
+    
+    if quantity < 1:
+        return jsonify({'error': 'Quantity must be at least 1'}), 400
+    
+    product = Product.query.filter_by(id=product_id, is_active=True).first()
+    if not product:
+        return jsonify({'error': 'Product not found'}), 404
+    
+    guest_cart = get_guest_cart()
+    if not guest_cart:
+        guest_cart = GuestCart(token=secrets.token_urlsafe(32), items={})
+        db.session.add(guest_cart)
+    
+    items = dict(guest_cart.items)
+    key = str(product_id)
+    
+    if key not in items and len(items) >= MAX_GUEST_CART_ITEMS:
+        return jsonify({'error': f'Guest carts hold at most {MAX_GUEST_CART_ITEMS} products'}), 400
+    
+    new_quantity = items.get(key, 0) + quantity
+    if new_quantity > product.stock:
+        return jsonify({'error': f'Only {product.stock} items available'}), 400
+    
+    action = 'updated' if key in items else 'added'
+    items[key] = new_quantity
+    guest_cart.items = items
+    db.session.commit()
+    
+    response = jsonify({
+        'message': 'Cart updated' if action == 'updated' else 'Added to cart',
+        'product_id': product_id,
+        'quantity': new_quantity,
+        'action': action
+    })
+    remember_guest_cart(response, guest_cart)
+    return response, 200 if action == 'updated' else 201
+
+
+@guest_cart_bp.route('/update', methods=['PUT'])
+def update_cart_item():
+    """Update quantity of an item in the guest cart"""
+    data = request.get_json()
+    
+    product_id = data.get('product_id')
+    quantity = data.get('quantity')
+    
+    if not product_id:
+        return jsonify({'error': 'Product ID is required'}), 400
+    
+    if quantity is None or quantity < 1:
+        return jsonify({'error': 'Quantity must be at least 1'}), 400
+    
+    guest_cart = get_guest_cart()
+    if not guest_cart or str(product_id) not in guest_cart.items:
+        return jsonify({'error': 'Item not in cart'}), 404
+    
+    product = db.session.get(Product, product_id)
+    if not product or quantity > product.stock:
+        return jsonify({'error': f'Only {product.stock if product else 0} items available'}), 400
+    
+    guest_cart.items = {**guest_cart.items, str(product_id): quantity}
+    db.session.commit()
+    
+    return jsonify({
+        'message': 'Cart updated',
+        'product_id': product_id,
+        'quantity': quantity
+    }), 200
+
+
+@guest_cart_bp.route('/remove', methods=['DELETE'])
+def remove_from_cart():
+    """Remove a product from the guest cart"""
+    data = request.get_json()
+    
+    product_id = data.get('product_id')
+    if not product_id:
+        return jsonify({'error': 'Product ID is required'}), 400
+    
+    guest_cart = get_guest_cart()
+    if not guest_cart or str(product_id) not in guest_cart.items:
+        return jsonify({'error': 'Item not in cart'}), 404
+    
+    guest_cart.items = {key: value for key, value in guest_cart.items.items() if key != str(product_id)}
+    db.session.commit()
+    
+    return jsonify({
+        'message': 'Removed from cart',
+        'product_id': product_id
+    }), 200
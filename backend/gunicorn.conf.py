@@ -0,0 +1,12 @@
+"""
+Gunicorn settings, read from the working directory (see dockerfile).
+
+Each web worker drains the webhook inbox with its own WEBHOOK_WORKERS
+threads, started here once the worker has loaded the app. create_app never
+starts them, so `flask --app app ...` commands run no background workers.
+"""
+
+
+def post_worker_init(worker):
+    from webhook_inbox import start_webhook_workers
+    start_webhook_workers(worker.wsgi)
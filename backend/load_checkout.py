@@ -0,0 +1,119 @@
+"""
+Checkout load scenario against a backend pointed at fake_stripe.py.
+
+    python fake_stripe.py --webhook-url http://localhost:5000/api/checkout/webhook &
+    RATELIMIT_ENABLED=false STRIPE_API_BASE=http://127.0.0.1:12111 \\
+        STRIPE_SECRET_KEY=sk_test_fake STRIPE_WEBHOOK_SECRET=whsec_fake SKIP_EMAILS=1 python app.py &
+    python load_checkout.py --product-id 1 --users 200 --concurrency 20
+
+Each virtual user registers, adds the product to the cart, creates a
+checkout session, pays it on the fake (which delivers the signed
+checkout.session.completed webhook) and polls its orders until the order
+shows up. Prints checkout throughput and latency percentiles per step;
+webhook_to_order is from payment until the order is visible.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from stripe_gateway import percentile_ms
+import threading
+import argparse
+import secrets
+import httpx
+import time
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+    
+    def record(self, step, seconds):
+        with self._lock:
+            self.samples[step].append(seconds)
+    
+    def error(self, step):
+        with self._lock:
+            self.errors[step] += 1
+    
+    def timed(self, step, fn, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            response = fn(*args, **kwargs)
+            response.raise_for_status()
+        except Exception:
+            self.error(step)
+            raise
+        self.record(step, time.monotonic() - started)
+        return response
+
+
+def checkout_once(client, args, stats):
+    """One user's checkout, start to finish"""
+    email = f'load-{secrets.token_hex(6)}@example.com'
+    response = stats.timed('register', client.post, f'{args.api}/auth/register', json={
+        'email': email, 'full_name': 'Load Test', 'password': 'LoadTest123!'
+    })
+    headers = {'Authorization': f"Bearer {response.json()['access_token']}"}
+    
+    started = time.monotonic()
+    stats.timed('cart_add', client.post, f'{args.api}/cart/add', headers=headers, json={
+        'product_id': args.product_id, 'quantity': 1
+    })
+    session = stats.timed('create_session', client.post, f'{args.api}/checkout/create-session', headers=headers).json()
+    stats.timed('pay', client.post, f"{args.stripe}/_fake/sessions/{session['session_id']}/pay")
+    
+    paid = time.monotonic()
+    while time.monotonic() - paid < args.order_timeout:
+        orders = client.get(f'{args.api}/orders', headers=headers).json().get('orders', [])
+        if orders:
+            stats.record('webhook_to_order', time.monotonic() - paid)
+            stats.record('checkout_total', time.monotonic() - started)
+            return True
+        time.sleep(args.poll_interval)
+    
+    stats.error('webhook_to_order')
+    return False
+
+
+def run(args):
+    stats = Stats()
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    
+    def user(_):
+        try:
+            return checkout_once(client, args, stats)
+        except Exception as e:
+            print(f"Checkout failed: {str(e)}")
+            return False
+    
+    with httpx.Client(timeout=30, limits=limits) as client:
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            completed = sum(pool.map(user, range(args.users)))
+        elapsed = time.monotonic() - started
+    
+    print(f'{completed}/{args.users} checkouts in {elapsed:.1f}s ({completed / elapsed:.1f}/s, concurrency {args.concurrency})')
+    print(f"{'step':<18}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for step in ('register', 'cart_add', 'create_session', 'pay', 'webhook_to_order', 'checkout_total'):
+        samples = sorted(stats.samples[step])
+        print(f'{step:<18}{len(samples):>7}{stats.errors[step]:>8}'
+              f'{percentile_ms(samples, 50) or 0:>10}{percentile_ms(samples, 95) or 0:>10}'
+              f'{percentile_ms(samples, 99) or 0:>10}{percentile_ms(samples, 100) or 0:>10}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Checkout load scenario (run against fake_stripe.py)')
+    parser.add_argument('--api', default='http://localhost:5000/api', help='Backend API base URL')
+    parser.add_argument('--stripe', default='http://127.0.0.1:12111', help='Fake Stripe base URL')
+    parser.add_argument('--product-id', type=int, required=True, help='Active, in-stock product to buy')
+    parser.add_argument('--users', type=int, default=100, help='Checkouts to run')
+    parser.add_argument('--concurrency', type=int, default=10, help='Checkouts in flight at once')
+    parser.add_argument('--order-timeout', type=float, default=30.0, help='Seconds to wait for each order')
+    parser.add_argument('--poll-interval', type=float, default=0.05, help='Seconds between order polls')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
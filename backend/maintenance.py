@@ -0,0 +1,101 @@
+"""
+flask --app app maintenance sweep: Delete stale rows in small batches
+
+Abandoned cart items, empty idle carts, expired or used password reset
+tokens and processed webhook events past their retention are removed one
+short transaction at a time, so the sweep can run alongside production
+traffic (see dbutils.delete_in_batches). A cart emptied by the sweep has its
+version bumped; a user's next cart starts again at version 1, which is safe
+once the cart has been idle far longer than a checkout session or Stripe
+idempotency key lives.
+"""
+
+from flask import Blueprint
+from sqlalchemy import select, update, exists, or_
+from datetime import datetime, timedelta, timezone
+from extensions import db
+from models import Cart, CartItem, PasswordResetToken, WebhookEvent
+from dbutils import delete_in_batches
+import click
+
+
+maintenance_bp = Blueprint('maintenance', __name__, cli_group='maintenance')
+
+
+def bump_item_cart_versions(item_ids):
+    """Bump the version of the carts holding these items, leaving updated_at as it was"""
+    db.session.execute(
+        update(Cart).where(Cart.id.in_(select(CartItem.cart_id).where(CartItem.id.in_(item_ids))))
+        .values(version=Cart.version + 1, updated_at=Cart.updated_at)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def sweep_abandoned_cart_items(max_age_days=90, batch_size=1000, pause=0):
+    """
+    Delete items of carts untouched for max_age_days, bumping each emptied
+    cart's version in the same chunk so a cached cart is not revalidated.
+    Returns (rows, seconds).
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=max_age_days)
+    abandoned_carts = select(Cart.id).where(Cart.updated_at < cutoff)
+    return delete_in_batches(
+        CartItem,
+        CartItem.cart_id.in_(abandoned_carts),
+        batch_size=batch_size,
+        pause=pause,
+        before_delete=bump_item_cart_versions
+    )
+
+
+def sweep_empty_carts(max_age_days=30, batch_size=1000, pause=0):
+    """Delete carts with no items untouched for max_age_days. Returns (rows, seconds)."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=max_age_days)
+    return delete_in_batches(
+        Cart,
+        Cart.updated_at < cutoff,
+        ~exists().where(CartItem.cart_id == Cart.id),
+        batch_size=batch_size,
+        pause=pause
+    )
+
+
+def sweep_reset_tokens(batch_size=1000, pause=0):
+    """Delete password reset tokens that are used or expired. Returns (rows, seconds)."""
+    return delete_in_batches(
+        PasswordResetToken,
+        or_(PasswordResetToken.used == True, PasswordResetToken.expires_at < datetime.now(timezone.utc)),
+        batch_size=batch_size,
+        pause=pause
+    )
+
+
+def sweep_webhook_events(keep_days=30, batch_size=1000, pause=0):
+    """Delete webhook events processed more than keep_days ago. Returns (rows, seconds)."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=keep_days)
+    return delete_in_batches(
+        WebhookEvent,
+        WebhookEvent.status == 'done',
+        WebhookEvent.processed_at < cutoff,
+        batch_size=batch_size,
+        pause=pause
+    )
+
+
+def report(label, rows, seconds):
+    rate = rows / seconds if seconds > 0 else 0
+    click.echo(f'{label}: {rows} rows in {seconds:.2f}s ({rate:.0f} rows/s)')
+
+
+@maintenance_bp.cli.command('sweep')
+@click.option('--cart-days', default=90, show_default=True, help='Delete items of carts idle for this many days.')
+@click.option('--empty-cart-days', default=30, show_default=True, help='Delete empty carts idle for this many days.')
+@click.option('--webhook-days', default=30, show_default=True, help='Delete webhook events processed this many days ago.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows deleted per transaction.')
+@click.option('--pause', default=0.0, show_default=True, help='Seconds to sleep between batches.')
+def sweep_command(cart_days, empty_cart_days, webhook_days, batch_size, pause):
+    """Delete abandoned cart items, empty carts, stale reset tokens and old processed webhook events."""
+    report('Abandoned cart items', *sweep_abandoned_cart_items(cart_days, batch_size, pause))
+    report('Empty carts', *sweep_empty_carts(empty_cart_days, batch_size, pause))
+    report('Password reset tokens', *sweep_reset_tokens(batch_size, pause))
+    report('Webhook events', *sweep_webhook_events(webhook_days, batch_size, pause))
@@ -0,0 +1,24 @@
+-- Guest carts, merged into the user's cart at login (guest_cart.py)
+CREATE TABLE IF NOT EXISTS guest_carts (
+    id BIGSERIAL PRIMARY KEY,
+    token VARCHAR(64) NOT NULL UNIQUE,
+    items JSON NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS ix_guest_carts_updated_at ON guest_carts (updated_at);
+
+-- One line per product in a cart, so merges can upsert: fold duplicates into the oldest line
+UPDATE cart_items SET quantity = duplicates.quantity
+FROM (
+    SELECT MIN(id) AS id, SUM(quantity) AS quantity
+    FROM cart_items
+    GROUP BY cart_id, product_id
+    HAVING COUNT(*) > 1
+) AS duplicates
+WHERE cart_items.id = duplicates.id;
+DELETE FROM cart_items USING cart_items AS kept
+WHERE cart_items.cart_id = kept.cart_id
+  AND cart_items.product_id = kept.product_id
+  AND cart_items.id > kept.id;
+CREATE UNIQUE INDEX IF NOT EXISTS uq_cart_items_cart_product ON cart_items (cart_id, product_id);
@@ -0,0 +1,2 @@
+-- Cart version for ETags and If-Match, bumped by every cart mutation
+ALTER TABLE carts ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
@@ -0,0 +1,6 @@
+-- One entry per product in a wishlist, so adds can upsert
+DELETE FROM wishlist_items USING wishlist_items AS kept
+WHERE wishlist_items.wishlist_id = kept.wishlist_id
+  AND wishlist_items.product_id = kept.product_id
+  AND wishlist_items.id > kept.id;
+CREATE UNIQUE INDEX IF NOT EXISTS uq_wishlist_items_wishlist_product ON wishlist_items (wishlist_id, product_id);
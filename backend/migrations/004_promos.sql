@@ -0,0 +1,4 @@
+-- Promo applied to a cart, and the discount an order was placed with
+ALTER TABLE carts ADD COLUMN IF NOT EXISTS promo_code VARCHAR(50);
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS discount_cents INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS promo_code VARCHAR(50);
@@ -0,0 +1,3 @@
+-- When each cart last changed, for the abandoned cart sweeper
+ALTER TABLE carts ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now();
+CREATE INDEX IF NOT EXISTS ix_carts_updated_at ON carts (updated_at);
@@ -0,0 +1,23 @@
+-- Wishlist price-drop / back-in-stock alerts
+CREATE TABLE IF NOT EXISTS product_watch_states (
+    product_id BIGINT PRIMARY KEY REFERENCES products (id),
+    price_cents INTEGER NOT NULL,
+    stock INTEGER NOT NULL,
+    observed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+ALTER TABLE product_watch_states ADD COLUMN IF NOT EXISTS pending_price_cents INTEGER;
+ALTER TABLE product_watch_states ADD COLUMN IF NOT EXISTS pending_stock INTEGER;
+
+CREATE TABLE IF NOT EXISTS wishlist_notifications (
+    id BIGSERIAL PRIMARY KEY,
+    user_id UUID NOT NULL REFERENCES users (id),
+    product_id BIGINT NOT NULL REFERENCES products (id),
+    kind VARCHAR(20) NOT NULL,
+    old_price_cents INTEGER,
+    new_price_cents INTEGER NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    sent_at TIMESTAMP WITH TIME ZONE
+);
+CREATE UNIQUE INDEX IF NOT EXISTS uq_wishlist_notifications_pending
+    ON wishlist_notifications (user_id, product_id, kind) WHERE sent_at IS NULL;
+CREATE INDEX IF NOT EXISTS ix_wishlist_notifications_sent_at ON wishlist_notifications (sent_at);
@@ -0,0 +1,3 @@
+-- Checkout looks payments up by the session they paid for
+CREATE INDEX IF NOT EXISTS ix_payments_session_id
+    ON payments ((CAST(raw_response ->> 'session_id' AS VARCHAR)));
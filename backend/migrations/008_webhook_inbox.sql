@@ -0,0 +1,14 @@
+-- Inbox of received Stripe webhook events, drained by the webhook workers
+CREATE TABLE IF NOT EXISTS webhook_events (
+    event_id TEXT PRIMARY KEY,
+    type VARCHAR(100) NOT NULL,
+    payload JSON NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    attempts INTEGER NOT NULL,
+    next_attempt_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    last_error TEXT,
+    received_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    processed_at TIMESTAMP WITH TIME ZONE
+);
+CREATE INDEX IF NOT EXISTS ix_webhook_events_status_due ON webhook_events (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS ix_webhook_events_status_processed ON webhook_events (status, processed_at);
@@ -0,0 +1,11 @@
+-- Stripe Prices synced per product and unit amount, referenced by id at checkout
+CREATE TABLE IF NOT EXISTS stripe_prices (
+    id BIGSERIAL PRIMARY KEY,
+    product_id BIGINT NOT NULL REFERENCES products (id),
+    unit_amount_cents INTEGER NOT NULL,
+    currency VARCHAR(3) NOT NULL,
+    stripe_product_id TEXT NOT NULL,
+    stripe_price_id TEXT NOT NULL UNIQUE,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    CONSTRAINT uq_stripe_prices_product_amount UNIQUE (product_id, unit_amount_cents, currency)
+);
@@ -0,0 +1,2 @@
+-- Keyset pagination of a user's order history, newest first
+CREATE INDEX IF NOT EXISTS ix_orders_user_placed ON orders (user_id, placed_at, id);
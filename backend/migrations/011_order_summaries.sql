@@ -0,0 +1,4 @@
+-- List summary stored on each order when it is placed
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS item_count INTEGER;
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS first_item_name TEXT;
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS preview_image_url TEXT;
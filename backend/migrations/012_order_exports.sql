@@ -0,0 +1,2 @@
+-- Date-range exports across all users
+CREATE INDEX IF NOT EXISTS ix_orders_placed_at ON orders (placed_at);
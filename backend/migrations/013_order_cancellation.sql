@@ -0,0 +1,5 @@
+-- Soft cancellation, and the stock each order line took so a cancellation restocks exactly that
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS status VARCHAR(20) NOT NULL DEFAULT 'placed';
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS cancelled_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS restocked_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE order_items ADD COLUMN IF NOT EXISTS stock_taken INTEGER;
@@ -0,0 +1,28 @@
+-- Bring an existing database up to the current models (backend/models.py).
+--
+--     psql "$DATABASE_URL" -v ON_ERROR_STOP=1 -f backend/migrations/upgrade.sql
+--
+-- Runs the numbered steps below, in order, in one transaction. Every step is
+-- idempotent (each statement is a no-op once applied), so this is safe to run
+-- on every deploy, before the new code starts. A schema change ships as a new
+-- step file, included here. Indexes are built without CONCURRENTLY, which
+-- blocks writes to the table while each one builds; on large tables run it
+-- off-peak.
+
+BEGIN;
+
+\ir 001_guest_carts.sql
+\ir 002_cart_versions.sql
+\ir 003_wishlist_item_upserts.sql
+\ir 004_promos.sql
+\ir 005_cart_idle_tracking.sql
+\ir 006_wishlist_alerts.sql
+\ir 007_payments_by_session.sql
+\ir 008_webhook_inbox.sql
+\ir 009_stripe_prices.sql
+\ir 010_order_history.sql
+\ir 011_order_summaries.sql
+\ir 012_order_exports.sql
+\ir 013_order_cancellation.sql
+
+COMMIT;
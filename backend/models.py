@@ -1,4 +1,5 @@
 from extensions import db
+from pricing import sale_price_cents
 from sqlalchemy.dialects.postgresql import UUID
 import uuid
 
@@ -88,8 +89,7 @@ class Product(db.Model):
         """Calculate the sale price in cents"""
         percent = self.effective_sale_percent
         if percent:
-            discount = int(self.price_cents * percent / 100)
-            return self.price_cents - discount
+            return sale_price_cents(self.price_cents, percent)
         return None
 
 class ProductImage(db.Model):
@@ -130,6 +130,9 @@ class Wishlist(db.Model):
 
 class WishlistItem(db.Model):
     __tablename__ = 'wishlist_items'
+    __table_args__ = (
+        db.UniqueConstraint('wishlist_id', 'product_id', name='uq_wishlist_items_wishlist_product'),
+    )
     id = db.Column(db.BigInteger, primary_key=True)
     wishlist_id = db.Column(db.BigInteger, db.ForeignKey('wishlists.id'), nullable=False)
     product_id = db.Column(db.BigInteger, db.ForeignKey('products.id'), nullable=False)
@@ -142,13 +145,19 @@ class Cart(db.Model):
     __tablename__ = 'carts'
     id = db.Column(db.BigInteger, primary_key=True)
     user_id = db.Column(UUID(as_uuid=True), db.ForeignKey('users.id'), unique=True, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # Bumped by every cart mutation
+    promo_code = db.Column(db.String(50), nullable=True)  # Applied promo; priced through promos.promo_codes
     created_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now(), onupdate=db.func.now(), index=True)
     
     user = db.relationship('User', back_populates='carts')
     items = db.relationship('CartItem', back_populates='cart', order_by='CartItem.added_at')
 
 class CartItem(db.Model):
     __tablename__ = 'cart_items'
+    __table_args__ = (
+        db.UniqueConstraint('cart_id', 'product_id', name='uq_cart_items_cart_product'),
+    )
     id = db.Column(db.BigInteger, primary_key=True)
     cart_id = db.Column(db.BigInteger, db.ForeignKey('carts.id'), nullable=False)
     product_id = db.Column(db.BigInteger, db.ForeignKey('products.id'), nullable=False)
@@ -159,6 +168,48 @@ class CartItem(db.Model):
     cart = db.relationship('Cart', back_populates='items')
     product = db.relationship('Product')
 
+class GuestCart(db.Model):
+    __tablename__ = 'guest_carts'
+    id = db.Column(db.BigInteger, primary_key=True)
+    token = db.Column(db.String(64), unique=True, nullable=False)
+    items = db.Column(db.JSON, nullable=False, default=dict)  # {"<product_id>": quantity}
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now(), onupdate=db.func.now(), index=True)
+
+class ProductWatchState(db.Model):
+    """Price and stock of each product as last seen by the wishlist alerts job"""
+    __tablename__ = 'product_watch_states'
+    product_id = db.Column(db.BigInteger, db.ForeignKey('products.id'), primary_key=True)
+    price_cents = db.Column(db.Integer, nullable=False)  # Effective (sale) price
+    stock = db.Column(db.Integer, nullable=False)
+    # Read by the run in progress, NULL between runs
+    pending_price_cents = db.Column(db.Integer)
+    pending_stock = db.Column(db.Integer)
+    observed_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+
+class WishlistNotification(db.Model):
+    __tablename__ = 'wishlist_notifications'
+    id = db.Column(db.BigInteger, primary_key=True)
+    user_id = db.Column(UUID(as_uuid=True), db.ForeignKey('users.id'), nullable=False)
+    product_id = db.Column(db.BigInteger, db.ForeignKey('products.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # 'price_drop' or 'back_in_stock'
+    old_price_cents = db.Column(db.Integer)
+    new_price_cents = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+    sent_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    
+    __table_args__ = (
+        # At most one pending notification per user, product and kind
+        db.Index(
+            'uq_wishlist_notifications_pending', 'user_id', 'product_id', 'kind', unique=True,
+            postgresql_where=db.text('sent_at IS NULL'), sqlite_where=db.text('sent_at IS NULL')
+        ),
+        # Purge of sent notifications
+        db.Index('ix_wishlist_notifications_sent_at', 'sent_at'),
+    )
+    
+    product = db.relationship('Product')
+
 class Payment(db.Model):
     __tablename__ = 'payments'
     id = db.Column(db.BigInteger, primary_key=True)
@@ -169,12 +220,58 @@ class Payment(db.Model):
     currency = db.Column(db.String(3), nullable=False, default='CAD')
     raw_response = db.Column(db.JSON)
     created_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+    
+    __table_args__ = (
+        # Checkout looks payments up by the session they paid for
+        db.Index('ix_payments_session_id', raw_response['session_id'].as_string()),
+    )
+
+class StripePrice(db.Model):
+    """Stripe Price for a product at one unit amount, referenced by id at checkout"""
+    __tablename__ = 'stripe_prices'
+    __table_args__ = (
+        db.UniqueConstraint('product_id', 'unit_amount_cents', 'currency', name='uq_stripe_prices_product_amount'),
+    )
+    id = db.Column(db.BigInteger, primary_key=True)
+    product_id = db.Column(db.BigInteger, db.ForeignKey('products.id'), nullable=False)
+    unit_amount_cents = db.Column(db.Integer, nullable=False)
+    currency = db.Column(db.String(3), nullable=False, default='cad')
+    stripe_product_id = db.Column(db.Text, nullable=False)
+    stripe_price_id = db.Column(db.Text, unique=True, nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+
+class WebhookEvent(db.Model):
+    """Inbox of received Stripe webhook events, drained by the webhook workers"""
+    __tablename__ = 'webhook_events'
+    event_id = db.Column(db.Text, primary_key=True)  # Stripe event id, so retried deliveries dedupe
+    type = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, processing, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime(timezone=True), nullable=False)  # Due time, or lease expiry while processing
+    last_error = db.Column(db.Text)
+    received_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+    processed_at = db.Column(db.DateTime(timezone=True))
+    
+    __table_args__ = (
+        db.Index('ix_webhook_events_status_due', 'status', 'next_attempt_at'),
+        # Retention sweep of processed events
+        db.Index('ix_webhook_events_status_processed', 'status', 'processed_at'),
+    )
 
 class Order(db.Model):
     __tablename__ = 'orders'
+    __table_args__ = (
+        # Keyset pagination of a user's order history, newest first
+        db.Index('ix_orders_user_placed', 'user_id', 'placed_at', 'id'),
+        # Date-range exports across all users
+        db.Index('ix_orders_placed_at', 'placed_at'),
+    )
     id = db.Column(db.BigInteger, primary_key=True)
     user_id = db.Column(UUID(as_uuid=True), db.ForeignKey('users.id'), nullable=False)
     subtotal_cents = db.Column(db.Integer, nullable=False)
+    discount_cents = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Promo discount off subtotal
+    promo_code = db.Column(db.String(50), nullable=True)
     tax_cents = db.Column(db.Integer, nullable=False, default=0)
     shipping_cents = db.Column(db.Integer, nullable=False, default=0)
     total_cents = db.Column(db.Integer, nullable=False)
@@ -184,6 +281,13 @@ class Order(db.Model):
     billing_address_id = db.Column(db.BigInteger, db.ForeignKey('addresses.id'))
     placed_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
     created_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+    status = db.Column(db.String(20), nullable=False, default='placed', server_default='placed')  # placed, cancelled
+    cancelled_at = db.Column(db.DateTime(timezone=True))
+    restocked_at = db.Column(db.DateTime(timezone=True))  # Set once a cancellation's items are back in stock
+    # List summary, stored when the order is placed so the order list reads only this table
+    item_count = db.Column(db.Integer)
+    first_item_name = db.Column(db.Text)
+    preview_image_url = db.Column(db.Text)
     
     user = db.relationship('User', back_populates='orders')
     items = db.relationship('OrderItem', back_populates='order')
@@ -198,6 +302,7 @@ class OrderItem(db.Model):
     unit_price_cents = db.Column(db.Integer, nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     line_total_cents = db.Column(db.Integer, nullable=False)
+    stock_taken = db.Column(db.Integer)  # Units actually taken from stock (less than quantity if oversold)
     created_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
     
     order = db.relationship('Order', back_populates='items')
@@ -1,19 +1,48 @@
 from models import User, Order, OrderItem, Product, ProductImage
 from extensions import db, mail
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from flask_mail import Message
+from sqlalchemy import select, update, func, or_, and_, case
+from sqlalchemy.orm import aliased
+from datetime import datetime, timedelta
+from auth import admin_required
+from stripe_gateway import get_stripe_gateway
+from webhook_inbox import enqueue_event, wake_webhook_workers, webhook_handler
+import base64
+import json
+import csv
+import io
+import click
+import time
 import os
 
 
 """
-GET /api/orders: Get all orders for user
+GET /api/orders: Get the user's orders, newest first, a page at a time (?limit=&cursor=)
+GET /api/orders/export: Stream the user's orders as CSV or NDJSON (?format=&from=&to=)
+GET /api/orders/admin/export: Stream every user's orders (admin)
 GET /api/orders/:id: Get order details
-DELETE /api/orders/:id: Cancel order
+DELETE /api/orders/:id: Cancel order (refund, restock and email happen in the background)
 """
 
 
-order_bp = Blueprint("orders", __name__, url_prefix="/api/orders")
+order_bp = Blueprint("orders", __name__, url_prefix="/api/orders", cli_group="orders")
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Background jobs queued when an order is cancelled (see the order.cancelled.* handlers)
+CANCELLATION_JOBS = ('refund', 'restock', 'email')
+
+# Rows fetched from the server-side cursor at a time, and bytes buffered per chunk sent
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+EXPORT_COLUMNS = [
+    'order_id', 'placed_at', 'status', 'currency', 'subtotal_cents', 'discount_cents', 'promo_code', 'tax_cents',
+    'shipping_cents', 'total_cents', 'product_id', 'title', 'quantity', 'unit_price_cents', 'line_total_cents'
+]
 
 
 def get_product_image(product):
@@ -27,6 +56,174 @@ def get_product_image(product):
     return None
 
 
+def encode_cursor(order):
+    """Opaque cursor pointing just past an order in (placed_at, id) order"""
+    return base64.urlsafe_b64encode(f'{order.placed_at.isoformat()}|{order.id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(placed_at, id) from a cursor; ValueError if it is malformed"""
+    try:
+        placed_at, order_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(placed_at), int(order_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+
+def preview_image_select(product_id):
+    """A product's primary image URL, else its first (product_id may be a correlated subquery)"""
+    return select(ProductImage.url).where(ProductImage.product_id == product_id).order_by(
+        ProductImage.is_primary.desc(), ProductImage.id
+    ).limit(1)
+
+
+def order_summary_values():
+    """
+    Correlated subqueries computing an order's list summary from its items:
+    item count, first item's name and its product's preview image. Used for
+    orders placed before the summary was stored, until they are backfilled.
+    """
+    first = aliased(OrderItem)
+    first_item = select(first.product_id, first.title_snapshot).where(
+        first.order_id == Order.id
+    ).order_by(first.id).limit(1).correlate(Order)
+    
+    return {
+        'item_count': select(func.count(OrderItem.id)).where(OrderItem.order_id == Order.id).scalar_subquery(),
+        'first_item_name': first_item.with_only_columns(first.title_snapshot).scalar_subquery(),
+        'preview_image_url': preview_image_select(
+            first_item.with_only_columns(first.product_id).scalar_subquery()
+        ).scalar_subquery()
+    }
+
+
+def backfill_order_summaries(batch_size=1000):
+    """Store the list summary on orders that lack it, batch_size orders per UPDATE. Returns orders updated."""
+    updated = 0
+    last_id = 0
+    while True:
+        order_ids = db.session.execute(
+            select(Order.id).where(Order.item_count.is_(None), Order.id > last_id).order_by(Order.id).limit(batch_size)
+        ).scalars().all()
+        if not order_ids:
+            return updated
+        last_id = order_ids[-1]
+        
+        db.session.execute(
+            update(Order).where(Order.id.in_(order_ids)).values(**order_summary_values())
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        updated += len(order_ids)
+
+
+def computed_summaries(order_ids):
+    """{order_id: row with item_count, first_item_name, preview_image_url} computed from the items, in one query"""
+    if not order_ids:
+        return {}
+    columns = [value.label(name) for name, value in order_summary_values().items()]
+    rows = db.session.execute(select(Order.id, *columns).where(Order.id.in_(order_ids)))
+    return {row.id: row for row in rows}
+
+
+def orders_page_query(user_id, limit, after=None):
+    """A page of a user's orders, newest first; reads only the orders table"""
+    query = select(Order).where(Order.user_id == user_id)
+    
+    if after:
+        placed_at, order_id = after
+        query = query.where(or_(
+            Order.placed_at < placed_at,
+            and_(Order.placed_at == placed_at, Order.id < order_id)
+        ))
+    
+    return query.order_by(Order.placed_at.desc(), Order.id.desc()).limit(limit)
+
+
+def parse_export_range(args):
+    """
+    (from, to) datetimes from ?from=&to= ISO dates or datetimes; to is
+    exclusive, and a bare to date includes that whole day. ValueError if malformed.
+    """
+    start = end = None
+    if args.get('from'):
+        start = datetime.fromisoformat(args['from'])
+    if args.get('to'):
+        end = datetime.fromisoformat(args['to'])
+        if len(args['to']) == 10:
+            end += timedelta(days=1)
+    return start, end
+
+
+def export_rows_query(start=None, end=None, user_id=None):
+    """One row per order item, oldest orders first, optionally for a single user"""
+    columns = [
+        Order.id, Order.placed_at, Order.status, Order.currency, Order.subtotal_cents, Order.discount_cents, Order.promo_code,
+        Order.tax_cents, Order.shipping_cents, Order.total_cents, OrderItem.product_id, OrderItem.title_snapshot,
+        OrderItem.quantity, OrderItem.unit_price_cents, OrderItem.line_total_cents
+    ]
+    query = select(*columns).join(OrderItem, OrderItem.order_id == Order.id)
+    if user_id is None:
+        query = query.add_columns(User.email).join(User, User.id == Order.user_id)
+    else:
+        query = query.where(Order.user_id == user_id)
+    
+    if start:
+        query = query.where(Order.placed_at >= start)
+    if end:
+        query = query.where(Order.placed_at < end)
+    
+    return query.order_by(Order.placed_at, Order.id, OrderItem.id)
+
+
+def export_response(query, header, fmt, filename):
+    """
+    Stream the query's rows as CSV or NDJSON. Rows come off a server-side
+    cursor EXPORT_BATCH_SIZE at a time and go out in chunks of about
+    EXPORT_CHUNK_BYTES, so memory stays flat however many rows there are.
+    """
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if fmt == 'csv':
+            writer.writerow(header)
+        
+        for row in db.session.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE)):
+            values = [value.isoformat() if isinstance(value, datetime) else value for value in row]
+            if fmt == 'csv':
+                writer.writerow(values)
+            else:
+                buffer.write(json.dumps(dict(zip(header, values))) + '\n')
+            
+            if buffer.tell() >= EXPORT_CHUNK_BYTES:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        
+        yield buffer.getvalue()
+    
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename={filename}.{fmt}'
+    })
+
+
+def export_orders(user_id=None):
+    """Validate ?format=&from=&to= and stream the matching order rows"""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+    
+    try:
+        start, end = parse_export_range(request.args)
+    except ValueError:
+        return jsonify({'error': 'from and to must be ISO dates (YYYY-MM-DD) or datetimes'}), 400
+    
+    header = EXPORT_COLUMNS if user_id else EXPORT_COLUMNS + ['email']
+    filename = 'orders' if user_id else 'all-orders'
+    return export_response(export_rows_query(start, end, user_id), header, fmt, filename)
+
+
 def send_order_cancellation_email(user, order):
     """Send order cancellation email (skipped in production due to SMTP restrictions)"""
     # Skip email in production (Railway blocks SMTP)
@@ -111,38 +308,72 @@ def send_order_cancellation_email(user, order):
 @order_bp.route('', methods=["GET"])
 @jwt_required()
 def get_all_orders():
-    """Get all orders for the current user"""
+    """
+    Get the current user's orders, newest first. Keyset paginated: pass the
+    returned next_cursor as ?cursor= for the next page (null on the last).
+    """
     user_id = get_jwt_identity()
     user = User.query.get(user_id)
     
     if not user:
         return jsonify({'error': 'User not found'}), 404
     
-    orders = Order.query.filter_by(user_id=user_id).order_by(Order.placed_at.desc()).all()
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'limit must be a number'}), 400
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({'error': f'limit must be between 1 and {MAX_PAGE_SIZE}'}), 400
+    
+    after = None
+    if request.args.get('cursor'):
+        try:
+            after = decode_cursor(request.args['cursor'])
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    
+    # One row past the page tells whether there is another page
+    rows = db.session.execute(orders_page_query(user_id, limit + 1, after)).scalars().all()
+    page = rows[:limit]
+    # Orders placed before summaries were stored, if not backfilled yet
+    computed = computed_summaries([order.id for order in page if order.item_count is None])
     
     orders_list = []
-    for order in orders:
-        # Get first item image for preview
-        preview_image = None
-        if order.items:
-            first_item = order.items[0]
-            if first_item.product:
-                preview_image = get_product_image(first_item.product)
-        
+    for order in page:
+        summary = computed.get(order.id, order)
         orders_list.append({
             'id': order.id,
             'total_cents': order.total_cents,
             'subtotal_cents': order.subtotal_cents,
+            'discount_cents': order.discount_cents,
+            'promo_code': order.promo_code,
             'tax_cents': order.tax_cents,
             'shipping_cents': order.shipping_cents,
             'currency': order.currency,
             'placed_at': order.placed_at.isoformat() if order.placed_at else None,
-            'item_count': len(order.items),
-            'preview_image': preview_image,
-            'first_item_name': order.items[0].title_snapshot if order.items else None
+            'status': order.status,
+            'item_count': summary.item_count,
+            'preview_image': summary.preview_image_url,
+            'first_item_name': summary.first_item_name
         })
     
-    return jsonify({'orders': orders_list}), 200
+    next_cursor = encode_cursor(page[-1]) if len(rows) > limit else None
+    return jsonify({'orders': orders_list, 'next_cursor': next_cursor}), 200
+
+
+@order_bp.route('/export', methods=["GET"])
+@jwt_required()
+def export_my_orders():
+    """Download the current user's order history, one row per item"""
+    return export_orders(get_jwt_identity())
+
+
+@order_bp.route('/admin/export', methods=["GET"])
+@jwt_required()
+@admin_required()
+def export_all_orders():
+    """Download every order, one row per item, with the customer's email (for accounting)"""
+    return export_orders()
 
 
 @order_bp.route('/<int:order_id>', methods=["GET"])
@@ -180,11 +411,15 @@ def get_order_details(order_id):
     return jsonify({
         'id': order.id,
         'subtotal_cents': order.subtotal_cents,
+        'discount_cents': order.discount_cents,
+        'promo_code': order.promo_code,
         'tax_cents': order.tax_cents,
         'shipping_cents': order.shipping_cents,
         'total_cents': order.total_cents,
         'currency': order.currency,
         'placed_at': order.placed_at.isoformat() if order.placed_at else None,
+        'status': order.status,
+        'cancelled_at': order.cancelled_at.isoformat() if order.cancelled_at else None,
         'items': items
     }), 200
 
@@ -192,41 +427,93 @@ def get_order_details(order_id):
 @order_bp.route('/<int:order_id>', methods=["DELETE"])
 @jwt_required()
 def cancel_order(order_id):
-    """Cancel an order"""
+    """
+    Cancel an order. The order is kept and marked cancelled in one short
+    transaction that also queues its refund, restock and email for the
+    background workers.
+    """
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
-    
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
     
-    order = Order.query.filter_by(id=order_id, user_id=user_id).first()
+    cancelled = db.session.execute(
+        update(Order).where(Order.id == order_id, Order.user_id == user_id, Order.status == 'placed')
+        .values(status='cancelled', cancelled_at=func.now())
+        .execution_options(synchronize_session=False)
+    ).rowcount
     
-    if not order:
+    if not cancelled:
+        db.session.rollback()
+        if Order.query.filter_by(id=order_id, user_id=user_id).first():
+            return jsonify({'error': 'Order is already cancelled'}), 409
         return jsonify({'error': 'Order not found'}), 404
     
-    # Store order info for email before deleting
-    order_info = {
-        'id': order.id,
-        'total_cents': order.total_cents,
-        'items': [{
-            'title_snapshot': item.title_snapshot,
-            'quantity': item.quantity,
-            'line_total_cents': item.line_total_cents
-        } for item in order.items]
-    }
-    
-    # Send cancellation email before deleting
-    send_order_cancellation_email(user, order)
-    
-    # Delete order items first (they have foreign key to order)
-    for item in order.items:
-        db.session.delete(item)
-    
-    db.session.delete(order)
+    for job in CANCELLATION_JOBS:
+        enqueue_event({'id': f'order-{order_id}-{job}', 'type': f'order.cancelled.{job}', 'data': {'order_id': order_id}})
     db.session.commit()
+    wake_webhook_workers()
     
     return jsonify({
         "message": "Order has been cancelled",
-        "order_id": order_info['id']
+        "order_id": order_id,
+        "status": "cancelled"
     }), 200
 
+
+@webhook_handler('order.cancelled.refund')
+def refund_cancelled_order(event):
+    """Refund a cancelled order's payment in full; the idempotency key makes retries safe"""
+    order = db.session.get(Order, event['data']['order_id'])
+    payment = order.payment
+    if not payment or payment.status == 'refunded':
+        return
+    
+    get_stripe_gateway().create_refund(
+        idempotency_key=f'refund-order-{order.id}',
+        payment_intent=payment.provider_payment_id
+    )
+    payment.status = 'refunded'
+    db.session.commit()
+
+
+@webhook_handler('order.cancelled.restock')
+def restock_cancelled_order(event):
+    """
+    Put back the stock a cancelled order took, in one UPDATE, once (restocked_at
+    guards retries). Orders from before stock_taken was recorded put back
+    their full quantities.
+    """
+    order_id = event['data']['order_id']
+    claimed = db.session.execute(
+        update(Order).where(Order.id == order_id, Order.restocked_at.is_(None)).values(restocked_at=func.now())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not claimed:
+        return
+    
+    quantities = dict(db.session.query(
+        OrderItem.product_id, func.sum(func.coalesce(OrderItem.stock_taken, OrderItem.quantity))
+    ).filter(
+        OrderItem.order_id == order_id, OrderItem.product_id.isnot(None)
+    ).group_by(OrderItem.product_id).all())
+    if quantities:
+        db.session.execute(
+            update(Product).where(Product.id.in_(quantities)).values(
+                stock=Product.stock + case(quantities, value=Product.id, else_=0)
+            ).execution_options(synchronize_session=False)
+        )
+    db.session.commit()
+
+
+@webhook_handler('order.cancelled.email')
+def email_order_cancellation(event):
+    """Send the cancellation email"""
+    order = db.session.get(Order, event['data']['order_id'])
+    send_order_cancellation_email(order.user, order)
+
+
+@order_bp.cli.command('backfill-summaries')
+@click.option('--batch-size', default=1000, show_default=True, help='Orders per UPDATE.')
+def backfill_summaries_command(batch_size):
+    """Store item count, first item name and preview image on orders placed before they were kept."""
+    started = time.monotonic()
+    updated = backfill_order_summaries(batch_size)
+    click.echo(f'Backfilled {updated} orders in {time.monotonic() - started:.2f}s')
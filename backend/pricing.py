@@ -0,0 +1,156 @@
+"""
+Single source of truth for cart and checkout pricing.
+
+All arithmetic is done in integer cents. A promo code takes a percentage
+off each unit's (sale) price, so the discount splits exactly across Stripe
+line items. 13% Ontario HST applies to the discounted merchandise subtotal
+plus shipping. Standard shipping is free from $100 of merchandise before
+promo discounts, otherwise $9.99.
+"""
+
+from dataclasses import dataclass
+from functools import lru_cache
+
+
+TAX_RATE_PERCENT = 13
+FREE_SHIPPING_THRESHOLD_CENTS = 10000
+STANDARD_SHIPPING_CENTS = 999
+CURRENCY = 'CAD'
+
+
+@dataclass(frozen=True)
+class QuoteLine:
+    product_id: int
+    quantity: int
+    unit_price_cents: int
+    original_unit_price_cents: int
+    unit_discount_cents: int = 0
+    
+    @property
+    def line_total_cents(self):
+        return self.unit_price_cents * self.quantity
+    
+    @property
+    def charged_unit_price_cents(self):
+        return self.unit_price_cents - self.unit_discount_cents
+    
+    @property
+    def discount_cents(self):
+        return self.unit_discount_cents * self.quantity
+    
+    @property
+    def original_line_total_cents(self):
+        return self.original_unit_price_cents * self.quantity
+
+
+@dataclass(frozen=True)
+class Quote:
+    lines: tuple
+    subtotal_cents: int
+    original_subtotal_cents: int
+    discount_cents: int
+    discount_percent: int
+    shipping_cents: int
+    tax_cents: int
+    total_cents: int
+    currency: str = CURRENCY
+    
+    @property
+    def sale_savings_cents(self):
+        return self.original_subtotal_cents - self.subtotal_cents
+    
+    @property
+    def total_items(self):
+        return sum(line.quantity for line in self.lines)
+    
+    def line_for(self, product_id):
+        return next((line for line in self.lines if line.product_id == product_id), None)
+
+
+def percent_of(amount_cents, percent):
+    """Percentage of an amount in cents, rounded half up to a whole cent"""
+    return (amount_cents * percent + 50) // 100
+
+
+def sale_price_cents(price_cents, sale_percent):
+    """Price after a percentage sale; the discount is truncated like the storefront shows it"""
+    if not sale_percent:
+        return price_cents
+    return price_cents - price_cents * sale_percent // 100
+
+
+def unit_price_cents(product):
+    """Effective unit price of a product (sale price if on sale, otherwise regular price)"""
+    return sale_price_cents(product.price_cents, product.effective_sale_percent)
+
+
+def standard_shipping_cents(subtotal_cents):
+    """Standard shipping for a merchandise subtotal"""
+    return 0 if subtotal_cents >= FREE_SHIPPING_THRESHOLD_CENTS else STANDARD_SHIPPING_CENTS
+
+
+def quote_cart(lines, shipping_cents=None, discount_percent=0):
+    """
+    Price a cart. lines is an iterable of (product, quantity) pairs; inactive
+    or missing products are skipped. shipping_cents overrides the standard
+    shipping rule (e.g. the rate the customer picked on Stripe) and
+    discount_percent is the applied promo code's discount.
+    
+    Quotes are memoized on the priced inputs (products, prices, sales and
+    quantities), so re-reading an unchanged cart and pricing it again at
+    checkout reuse the same Quote.
+    """
+    return _quote(priced_lines(lines), shipping_cents, discount_percent or 0)
+
+
+def priced_lines(lines):
+    """
+    Everything a quote depends on, per line: (product_id, quantity, price_cents,
+    sale_percent) for the active products in (product, quantity) pairs
+    """
+    return tuple(
+        (product.id, quantity, product.price_cents, product.effective_sale_percent or 0)
+        for product, quantity in lines
+        if product and product.is_active
+    )
+
+
+def quote_priced_lines(lines, shipping_cents=None, discount_percent=0):
+    """Price lines saved from priced_lines (e.g. when a checkout started), whatever the prices are now"""
+    return _quote(tuple(tuple(line) for line in lines), shipping_cents, discount_percent or 0)
+
+
+@lru_cache(maxsize=4096)
+def _quote(key, shipping_cents, discount_percent):
+    quote_lines = []
+    for product_id, quantity, price_cents, sale_percent in key:
+        unit_price = sale_price_cents(price_cents, sale_percent)
+        quote_lines.append(QuoteLine(
+            product_id=product_id,
+            quantity=quantity,
+            unit_price_cents=unit_price,
+            original_unit_price_cents=price_cents,
+            unit_discount_cents=percent_of(unit_price, discount_percent)
+        ))
+    quote_lines = tuple(quote_lines)
+    
+    subtotal_cents = sum(line.line_total_cents for line in quote_lines)
+    original_subtotal_cents = sum(line.original_line_total_cents for line in quote_lines)
+    discount_cents = sum(line.discount_cents for line in quote_lines)
+    
+    if shipping_cents is None:
+        shipping_cents = standard_shipping_cents(subtotal_cents) if quote_lines else 0
+    
+    taxable_cents = subtotal_cents - discount_cents + shipping_cents
+    tax_cents = percent_of(taxable_cents, TAX_RATE_PERCENT)
+    
+    return Quote(
+        lines=quote_lines,
+        subtotal_cents=subtotal_cents,
+        original_subtotal_cents=original_subtotal_cents,
+        discount_cents=discount_cents,
+        discount_percent=discount_percent,
+        shipping_cents=shipping_cents,
+        tax_cents=tax_cents,
+        total_cents=taxable_cents + tax_cents
+    )
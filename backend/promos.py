@@ -0,0 +1,64 @@
+"""
+In-process table of active promo codes.
+
+Validating a code is a dictionary lookup. The table is reloaded from the
+promo_codes table when it is older than PROMO_CACHE_TTL seconds, or on the
+next lookup after this process inserts, updates or deletes a PromoCode
+through the ORM. Changes made by other processes (or by bulk UPDATEs) are
+picked up within the TTL.
+"""
+
+from sqlalchemy import event
+from extensions import db
+from models import PromoCode
+import threading
+import time
+import os
+
+
+PROMO_CACHE_TTL = int(os.getenv('PROMO_CACHE_TTL', 60))
+
+
+class PromoCodeTable:
+    def __init__(self, ttl=PROMO_CACHE_TTL):
+        self.ttl = ttl
+        self._codes = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+    
+    def discount_percent(self, code):
+        """Discount of an active promo code, or None if the code is unknown or inactive"""
+        if not code:
+            return None
+        return self._table().get(code.strip().upper())
+    
+    def discount_percents(self):
+        """Distinct discounts of the active promo codes"""
+        return set(self._table().values())
+    
+    def invalidate(self):
+        """Force a reload on the next lookup"""
+        self._loaded_at = None
+    
+    def _table(self):
+        loaded_at = self._loaded_at
+        if loaded_at is not None and time.monotonic() - loaded_at < self.ttl:
+            return self._codes
+        
+        with self._lock:
+            # Another thread may have reloaded while we waited
+            if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.ttl:
+                rows = db.session.query(PromoCode.code, PromoCode.discount_percent).filter_by(is_active=True).all()
+                self._codes = {code.upper(): discount_percent for code, discount_percent in rows}
+                self._loaded_at = time.monotonic()
+            return self._codes
+
+
+promo_codes = PromoCodeTable()
+
+
+@event.listens_for(PromoCode, 'after_insert')
+@event.listens_for(PromoCode, 'after_update')
+@event.listens_for(PromoCode, 'after_delete')
+def _promo_code_changed(mapper, connection, target):
+    promo_codes.invalidate()
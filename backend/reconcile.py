@@ -0,0 +1,122 @@
+"""
+flask --app app reconcile checkouts: Create orders for paid sessions whose webhook never came
+
+Walks the completed Checkout Sessions created in the last few hours. The
+window is cut into slices whose pages are fetched concurrently (Stripe
+list pagination is a cursor, so one slice's pages are sequential). Each
+page is checked against payments.provider_payment_id with one query, and
+only the paid sessions without a payment get create_order_from_session,
+which is exactly-once, so a webhook arriving meanwhile is harmless.
+"""
+
+from flask import Blueprint
+from sqlalchemy import select
+from concurrent.futures import ThreadPoolExecutor
+from extensions import db
+from models import Payment
+from stripe_gateway import get_stripe_gateway
+from checkout import create_order_from_session, payment_intent_id_of
+import queue
+import click
+import time
+
+
+reconcile_bp = Blueprint('reconcile', __name__, cli_group='reconcile')
+
+PAGE_SIZE = 100
+
+
+def fetch_slice(gateway, created_gte, created_lt, pages, page_size=PAGE_SIZE):
+    """Put every page of completed sessions created in [created_gte, created_lt) on pages"""
+    starting_after = None
+    while True:
+        params = {'status': 'complete', 'created': {'gte': created_gte, 'lt': created_lt}, 'limit': page_size}
+        if starting_after:
+            params['starting_after'] = starting_after
+        page = gateway.list_checkout_sessions(**params)
+        if page.data:
+            pages.put(page.data)
+        if not page.has_more or not page.data:
+            return
+        starting_after = page.data[-1].id
+
+
+def completed_session_pages(gateway, created_gte, created_lt, workers=8, page_size=PAGE_SIZE):
+    """
+    Yield pages of completed sessions in [created_gte, created_lt) as they
+    arrive, fetched by workers threads over as many slices of the window.
+    """
+    step = max(1, -(-(created_lt - created_gte) // workers))
+    bounds = [(start, min(start + step, created_lt)) for start in range(created_gte, created_lt, step)]
+    pages = queue.Queue()
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        tasks = [pool.submit(fetch_slice, gateway, start, end, pages, page_size) for start, end in bounds]
+        pending = len(tasks)
+        for task in tasks:
+            task.add_done_callback(lambda _: pages.put(None))
+        
+        while pending:
+            page = pages.get()
+            if page is None:
+                pending -= 1
+            else:
+                yield page
+        
+        # Surface a slice that failed after its pages were used
+        for task in tasks:
+            task.result()
+
+
+def reconcile_page(sessions, dry_run=False):
+    """Create the missing orders for one page of sessions. Returns counts for the page."""
+    paid = {}
+    for session in sessions:
+        user_id = (session.metadata or {}).get('user_id')
+        payment_intent_id = payment_intent_id_of(session)
+        if session.payment_status == 'paid' and payment_intent_id and user_id:
+            paid[payment_intent_id] = (session, user_id)
+    
+    recorded = set(db.session.execute(
+        select(Payment.provider_payment_id).where(Payment.provider_payment_id.in_(list(paid)))
+    ).scalars()) if paid else set()
+    missing = [paid[payment_intent_id] for payment_intent_id in paid if payment_intent_id not in recorded]
+    
+    counts = {'sessions': len(sessions), 'paid': len(paid), 'missing': len(missing), 'created': 0, 'failed': 0}
+    if dry_run:
+        return counts
+    
+    for session, user_id in missing:
+        order, created = create_order_from_session(session, user_id)
+        if created:
+            counts['created'] += 1
+        elif order is None:
+            counts['failed'] += 1
+            print(f"Could not create an order for checkout session {session.id}")
+    return counts
+
+
+def reconcile_checkouts(hours=24, workers=8, page_size=PAGE_SIZE, dry_run=False, now=None):
+    """Reconcile the completed sessions of the last hours. Returns summed counts."""
+    created_lt = int(now or time.time()) + 1
+    created_gte = created_lt - int(hours * 3600)
+    totals = {'sessions': 0, 'paid': 0, 'missing': 0, 'created': 0, 'failed': 0}
+    
+    for sessions in completed_session_pages(get_stripe_gateway(), created_gte, created_lt, workers, page_size):
+        for name, value in reconcile_page(sessions, dry_run).items():
+            totals[name] += value
+    return totals
+
+
+@reconcile_bp.cli.command('checkouts')
+@click.option('--hours', default=24.0, show_default=True, help='How far back to look at sessions.')
+@click.option('--workers', default=8, show_default=True, help='Concurrent Stripe list requests.')
+@click.option('--dry-run', is_flag=True, help='Only count the sessions missing an order.')
+def reconcile_command(hours, workers, dry_run):
+    """Create orders for paid checkout sessions that have none."""
+    started = time.monotonic()
+    totals = reconcile_checkouts(hours, workers, dry_run=dry_run)
+    click.echo(
+        f"{totals['sessions']} completed sessions, {totals['paid']} paid, {totals['missing']} without an order; "
+        f"created {totals['created']} orders, {totals['failed']} failed in {time.monotonic() - started:.2f}s"
+    )
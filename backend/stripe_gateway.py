@@ -0,0 +1,287 @@
+"""
+Every call to Stripe goes through one StripeGateway per process.
+
+- Pooled: one requests.Session with a bounded connection pool shared by all
+  threads, so calls reuse TLS connections instead of opening new ones.
+- Bounded: strict connect/read timeouts keep a slow Stripe from pinning a
+  gunicorn worker for the SDK's default 80 seconds.
+- Retried: connection errors, rate limits and 5xx answers are retried a few
+  times with jittered exponential backoff, within a total time budget per
+  call. POSTs carry an idempotency key, the same on every attempt, so a
+  retry never creates a second object.
+- Guarded: a circuit breaker opens after repeated failed calls (one failure
+  per call, however many attempts it made) and fails calls fast
+  (GatewayUnavailable) until a trial call succeeds again.
+- Measured: per-operation call counts, errors and latency percentiles are
+  kept in process (status(), served by GET /api/checkout/metrics).
+
+STRIPE_API_BASE points the SDK at another server, such as stripe-mock or a
+local stub in tests.
+"""
+
+from flask import current_app
+from collections import deque
+from requests.adapters import HTTPAdapter
+import requests
+import stripe
+import threading
+import random
+import uuid
+import time
+import os
+
+
+class GatewayUnavailable(Exception):
+    """Stripe is failing and the circuit breaker is open; try again later"""
+    
+    def __init__(self, retry_after):
+        super().__init__('Payment provider is temporarily unavailable. Please try again shortly.')
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Thread-safe circuit breaker. Closed: calls pass. After failure_threshold
+    consecutive failures it opens and rejects calls for reset_timeout seconds,
+    then lets a single trial call through (half-open); its outcome closes or
+    re-opens the breaker.
+    """
+    
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+    
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+    
+    def retry_after(self):
+        if self.opened_at is None:
+            return 0
+        return max(0, self.reset_timeout - (time.monotonic() - self.opened_at))
+    
+    def allow(self):
+        """Whether a call may go out now"""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+    
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+class LatencyStats:
+    """Per-operation call counts, errors and latencies of the most recent calls"""
+    
+    def __init__(self, window=500):
+        self.window = window
+        self._operations = {}
+        self._lock = threading.Lock()
+    
+    def _stats(self, operation):
+        stats = self._operations.get(operation)
+        if stats is None:
+            stats = self._operations[operation] = {
+                'calls': 0, 'errors': 0, 'retries': 0, 'rejected': 0,
+                'samples': deque(maxlen=self.window)
+            }
+        return stats
+    
+    def record(self, operation, seconds, error=False):
+        """Record one completed call and how long it took"""
+        with self._lock:
+            stats = self._stats(operation)
+            stats['calls'] += 1
+            if error:
+                stats['errors'] += 1
+            stats['samples'].append(seconds)
+    
+    def count(self, operation, field):
+        """Bump a counter (retries, rejected) for an operation"""
+        with self._lock:
+            self._stats(operation)[field] += 1
+    
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for operation, stats in self._operations.items():
+                samples = sorted(stats['samples'])
+                result[operation] = {
+                    'calls': stats['calls'],
+                    'errors': stats['errors'],
+                    'retries': stats['retries'],
+                    'rejected': stats['rejected'],
+                    'p50_ms': percentile_ms(samples, 50),
+                    'p95_ms': percentile_ms(samples, 95),
+                    'max_ms': round(samples[-1] * 1000, 1) if samples else None
+                }
+            return result
+
+
+def percentile_ms(sorted_samples, percent):
+    if not sorted_samples:
+        return None
+    index = min(len(sorted_samples) - 1, int(len(sorted_samples) * percent / 100))
+    return round(sorted_samples[index] * 1000, 1)
+
+
+def is_retryable(error):
+    """Connection problems, rate limits and Stripe-side 5xx errors are worth retrying"""
+    if isinstance(error, (stripe.error.APIConnectionError, stripe.error.RateLimitError)):
+        return True
+    return isinstance(error, stripe.error.StripeError) and (error.http_status or 0) >= 500
+
+
+class StripeGateway:
+    """Stripe API calls with pooling, timeouts, retries, a circuit breaker and metrics"""
+    
+    def __init__(self, api_key=None, api_base=None, connect_timeout=3.0, read_timeout=10.0,
+                 max_retries=2, backoff=0.25, max_backoff=2.0, call_timeout=15.0, pool_size=10, breaker=None):
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.call_timeout = call_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.metrics = LatencyStats()
+        
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        
+        # The SDK's HTTP client and base URL are module-wide; the app has one gateway
+        stripe.default_http_client = stripe.http_client.RequestsClient(
+            timeout=(connect_timeout, read_timeout), session=session
+        )
+        stripe.max_network_retries = 0  # Retries happen here, where the breaker can see them
+        if api_base:
+            stripe.api_base = api_base
+    
+    def call(self, operation, fn, *args, **kwargs):
+        """
+        Run one Stripe SDK call under the breaker, with bounded jittered retries.
+        The breaker records the call's outcome once, after its retries; no retry
+        starts that would begin call_timeout seconds or more after the call did.
+        """
+        if not self.breaker.allow():
+            self.metrics.count(operation, 'rejected')
+            raise GatewayUnavailable(self.breaker.retry_after())
+        
+        deadline = time.monotonic() + self.call_timeout
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            try:
+                result = fn(*args, api_key=self.api_key, **kwargs)
+            except stripe.error.StripeError as e:
+                self.metrics.record(operation, time.monotonic() - started, error=True)
+                if not is_retryable(e):
+                    self.breaker.record_success()  # Stripe answered; the request itself was bad
+                    raise
+                
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                if attempt == self.max_retries or time.monotonic() + delay >= deadline:
+                    self.breaker.record_failure()
+                    raise
+                self.metrics.count(operation, 'retries')
+                time.sleep(delay)
+                continue
+            except BaseException:
+                # Anything else (a bug, an interrupt) is a failure too, so a
+                # half-open trial is always released
+                self.metrics.record(operation, time.monotonic() - started, error=True)
+                self.breaker.record_failure()
+                raise
+            
+            self.metrics.record(operation, time.monotonic() - started)
+            self.breaker.record_success()
+            return result
+    
+    def create_checkout_session(self, idempotency_key=None, **params):
+        return self.call(
+            'checkout.session.create', stripe.checkout.Session.create,
+            idempotency_key=idempotency_key or str(uuid.uuid4()), **params
+        )
+    
+    def retrieve_checkout_session(self, session_id, expand=None):
+        return self.call('checkout.session.retrieve', stripe.checkout.Session.retrieve, session_id, expand=expand)
+    
+    def list_checkout_sessions(self, **params):
+        return self.call('checkout.session.list', stripe.checkout.Session.list, **params)
+    
+    def create_product(self, idempotency_key=None, **params):
+        return self.call('product.create', stripe.Product.create, idempotency_key=idempotency_key or str(uuid.uuid4()), **params)
+    
+    def create_price(self, idempotency_key=None, **params):
+        return self.call('price.create', stripe.Price.create, idempotency_key=idempotency_key or str(uuid.uuid4()), **params)
+    
+    def create_refund(self, idempotency_key=None, **params):
+        return self.call('refund.create', stripe.Refund.create, idempotency_key=idempotency_key or str(uuid.uuid4()), **params)
+    
+    def construct_event(self, payload, sig_header, secret):
+        """Verify a webhook signature (local, no network call)"""
+        return stripe.Webhook.construct_event(payload, sig_header, secret)
+    
+    def status(self):
+        return {
+            'circuit': self.breaker.state,
+            'consecutive_failures': self.breaker.failures,
+            'operations': self.metrics.snapshot()
+        }
+
+
+def make_stripe_gateway(config):
+    """Build the gateway from STRIPE_* settings (app config first, then environment)"""
+    def setting(name, default=None):
+        return config.get(name) or os.getenv(name, default)
+    
+    return StripeGateway(
+        api_key=setting('STRIPE_SECRET_KEY'),
+        api_base=setting('STRIPE_API_BASE'),
+        connect_timeout=float(setting('STRIPE_CONNECT_TIMEOUT', 3)),
+        read_timeout=float(setting('STRIPE_READ_TIMEOUT', 10)),
+        max_retries=int(setting('STRIPE_MAX_RETRIES', 2)),
+        call_timeout=float(setting('STRIPE_CALL_TIMEOUT', 15)),
+        pool_size=int(setting('STRIPE_POOL_SIZE', 10)),
+        breaker=CircuitBreaker(
+            failure_threshold=int(setting('STRIPE_BREAKER_FAILURES', 5)),
+            reset_timeout=float(setting('STRIPE_BREAKER_RESET', 30))
+        )
+    )
+
+
+_gateway_lock = threading.Lock()
+
+
+def get_stripe_gateway():
+    """The app's Stripe gateway, built on first use by exactly one thread"""
+    gateway = current_app.extensions.get('stripe_gateway')
+    if gateway is None:
+        with _gateway_lock:
+            gateway = current_app.extensions.get('stripe_gateway')
+            if gateway is None:
+                gateway = current_app.extensions['stripe_gateway'] = make_stripe_gateway(current_app.config)
+    return gateway
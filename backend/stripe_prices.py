@@ -0,0 +1,161 @@
+"""
+flask --app app stripe-prices sync: Keep a Stripe Price for every price we charge
+
+Checkout references prices by id instead of sending inline price_data and
+product_data for each line, so the session request stays small whatever
+the product metadata. Prices are immutable in Stripe, so there is one per
+product and unit amount: the effective (sale) price and that price less
+each active promo discount. Lines without a synced price yet (a price
+changed since the last run) fall back to inline price_data.
+"""
+
+from flask import Blueprint
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, selectinload
+from concurrent.futures import ThreadPoolExecutor
+from extensions import db
+from models import Product, StripePrice
+from pricing import unit_price_cents, percent_of
+from promos import promo_codes
+from dbutils import dialect_insert
+from stripe_gateway import get_stripe_gateway
+import click
+import time
+
+
+stripe_prices_bp = Blueprint('stripe_prices', __name__, cli_group='stripe-prices')
+
+CURRENCY = 'cad'
+
+
+def stripe_price_ids(amounts):
+    """Map (product_id, unit amount) pairs to synced Stripe price ids, in one query"""
+    if not amounts:
+        return {}
+    
+    rows = db.session.query(
+        StripePrice.product_id, StripePrice.unit_amount_cents, StripePrice.stripe_price_id
+    ).filter(
+        StripePrice.product_id.in_({product_id for product_id, _ in amounts}),
+        StripePrice.currency == CURRENCY
+    ).all()
+    wanted = set(amounts)
+    return {(row[0], row[1]): row[2] for row in rows if (row[0], row[1]) in wanted}
+
+
+def chargeable_amounts(product, discount_percents):
+    """Unit amounts a product can be charged: its effective price, less each promo discount"""
+    unit_price = unit_price_cents(product)
+    return {unit_price} | {unit_price - percent_of(unit_price, percent) for percent in discount_percents}
+
+
+def stripe_product_params(product):
+    """What the Stripe Product shows on the checkout page"""
+    primary_image = next((img for img in product.images if img.is_primary), None) or (product.images[0] if product.images else None)
+    params = {
+        'name': product.title,
+        'metadata': {'product_id': str(product.id)}
+    }
+    if product.brand:
+        params['description'] = product.brand.name
+    if primary_image:
+        params['images'] = [primary_image.url]
+    return params
+
+
+def create_missing_prices(gateway, product, stripe_product_id, amounts):
+    """
+    Create the Stripe Product (if new) and Prices for one product.
+    Idempotency keys are derived from the product and amount, so overlapping
+    runs never create duplicates. Returns rows for stripe_prices.
+    """
+    if stripe_product_id is None:
+        stripe_product_id = gateway.create_product(
+            idempotency_key=f'product-{product.id}',
+            **stripe_product_params(product)
+        ).id
+    
+    rows = []
+    for amount in sorted(amounts):
+        price = gateway.create_price(
+            idempotency_key=f'price-{product.id}-{amount}-{CURRENCY}',
+            product=stripe_product_id,
+            unit_amount=amount,
+            currency=CURRENCY
+        )
+        rows.append({
+            'product_id': product.id,
+            'unit_amount_cents': amount,
+            'currency': CURRENCY,
+            'stripe_product_id': stripe_product_id,
+            'stripe_price_id': price.id
+        })
+    return rows
+
+
+def sync_stripe_prices(batch_size=200, workers=4):
+    """
+    Create Stripe Prices for every active product's chargeable amounts that
+    have none yet. Products are walked in id order batch_size at a time; the
+    Stripe calls of a batch run on a pool of workers threads and the new
+    mappings are stored with one INSERT per batch. Returns prices created.
+    """
+    gateway = get_stripe_gateway()
+    discount_percents = promo_codes.discount_percents()
+    created = 0
+    last_id = 0
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            products = Product.query.options(
+                joinedload(Product.category), joinedload(Product.brand), selectinload(Product.images)
+            ).filter(Product.is_active == True, Product.id > last_id).order_by(Product.id).limit(batch_size).all()
+            if not products:
+                break
+            last_id = products[-1].id
+            
+            synced = db.session.execute(select(
+                StripePrice.product_id, StripePrice.unit_amount_cents, StripePrice.stripe_product_id
+            ).where(
+                StripePrice.product_id.in_([product.id for product in products]),
+                StripePrice.currency == CURRENCY
+            )).all()
+            have = {(row[0], row[1]) for row in synced}
+            stripe_product_ids = {row[0]: row[2] for row in synced}
+            
+            tasks = []
+            for product in products:
+                missing = {
+                    amount for amount in chargeable_amounts(product, discount_percents)
+                    if (product.id, amount) not in have
+                }
+                if missing:
+                    tasks.append(pool.submit(
+                        create_missing_prices, gateway, product, stripe_product_ids.get(product.id), missing
+                    ))
+            
+            rows = []
+            for task in tasks:
+                try:
+                    rows.extend(task.result())
+                except Exception as e:
+                    print(f"Failed to sync Stripe prices: {str(e)}")
+            
+            if rows:
+                db.session.execute(dialect_insert(StripePrice).values(rows).on_conflict_do_nothing(
+                    index_elements=['product_id', 'unit_amount_cents', 'currency']
+                ))
+                created += len(rows)
+            db.session.commit()
+    
+    return created
+
+
+@stripe_prices_bp.cli.command('sync')
+@click.option('--batch-size', default=200, show_default=True, help='Products per batch.')
+@click.option('--workers', default=4, show_default=True, help='Concurrent Stripe requests.')
+def sync_command(batch_size, workers):
+    """Create Stripe Prices for new products, price changes and promo discounts."""
+    started = time.monotonic()
+    created = sync_stripe_prices(batch_size, workers)
+    click.echo(f'Created {created} Stripe prices in {time.monotonic() - started:.2f}s')
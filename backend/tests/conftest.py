@@ -10,9 +10,13 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from flask import Flask
 from flask_jwt_extended import JWTManager, create_access_token
-from sqlalchemy import String
+from sqlalchemy import String, BigInteger, Integer, event
+from contextlib import contextmanager
 from extensions import db
-from models import User, Product, Category, Brand, Cart, CartItem, Order, OrderItem, Wishlist, WishlistItem
+from models import User, Product, Category, Brand, Cart, CartItem, Order, OrderItem, Wishlist, WishlistItem, ProductImage, PasswordResetToken, WishlistNotification
+from promos import promo_codes
+from wishlist import wishlist_ids
+from checkout import checkout_sessions
 from werkzeug.security import generate_password_hash
 import uuid
 
@@ -37,14 +41,18 @@ def app():
     from auth import auth_bp
     from products import products_bp
     from cart import carts_bp
+    from guest_cart import guest_cart_bp
     from orders import order_bp
     from wishlist import wishlist_bp
+    from checkout import checkout_bp
     
     app.register_blueprint(auth_bp)
     app.register_blueprint(products_bp)
     app.register_blueprint(carts_bp)
+    app.register_blueprint(guest_cart_bp)
     app.register_blueprint(order_bp)
     app.register_blueprint(wishlist_bp)
+    app.register_blueprint(checkout_bp)
     
     # Patch UUID columns to use String for SQLite compatibility
     with app.app_context():
@@ -60,6 +68,14 @@ def app():
             Wishlist.__table__.c.user_id.type = String(36)
         if hasattr(Order.__table__.c, 'user_id'):
             Order.__table__.c.user_id.type = String(36)
+        PasswordResetToken.__table__.c.user_id.type = String(36)
+        WishlistNotification.__table__.c.user_id.type = String(36)
+        
+        # SQLite only auto-assigns INTEGER primary keys, so downgrade BIGINT ids
+        for table in db.metadata.tables.values():
+            for column in table.primary_key.columns:
+                if isinstance(column.type, BigInteger):
+                    column.type = Integer()
         
         db.create_all()
     
@@ -84,10 +100,126 @@ def db_session(app):
         for table in reversed(db.metadata.sorted_tables):
             db.session.execute(table.delete())
         db.session.commit()
+        promo_codes.invalidate()
+        wishlist_ids.clear()
+        checkout_sessions.clear()
         yield db.session
         db.session.rollback()
 
 
+@pytest.fixture
+def count_queries(app):
+    """Return a context manager that records the SQL statements executed inside it."""
+    @contextmanager
+    def counter():
+        statements = []
+        
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    
+    return counter
+
+
+@pytest.fixture
+def kv_cart_store(app):
+    """Serve carts from the key-value store on an in-process Redis stand-in."""
+    from cart_store import KeyValueCartStore, InProcessRedis
+    
+    store = KeyValueCartStore(InProcessRedis())
+    app.extensions['cart_store'] = store
+    yield store
+    app.extensions.pop('cart_store')
+
+
+@pytest.fixture
+def stripe_stub(app):
+    """
+    A local HTTP server standing in for the Stripe API, with a gateway pointed at it.
+    Queue (status, body, delay) replies on stub.replies; every request is kept in stub.requests.
+    """
+    import stripe
+    import threading
+    import json
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from stripe_gateway import StripeGateway, CircuitBreaker
+    
+    class Stub:
+        replies = []
+        requests = []
+    
+    class Handler(BaseHTTPRequestHandler):
+        def handle_one(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            Stub.requests.append({
+                'method': self.command,
+                'path': self.path,
+                'headers': dict(self.headers),
+                'body': self.rfile.read(length).decode()
+            })
+            status, body, delay = Stub.replies.pop(0) if Stub.replies else (
+                200, {'id': 'cs_test_stub', 'object': 'checkout.session', 'url': 'https://checkout.test/cs_test_stub'}, 0
+            )
+            time.sleep(delay)
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        
+        do_GET = do_POST = handle_one
+        
+        def log_message(self, *args):
+            pass
+    
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    
+    original_api_base = stripe.api_base
+    Stub.url = f'http://127.0.0.1:{server.server_address[1]}'
+    Stub.gateway = StripeGateway(
+        api_key='sk_test_stub', api_base=Stub.url, read_timeout=0.5,
+        backoff=0, breaker=CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    )
+    app.extensions['stripe_gateway'] = Stub.gateway
+    
+    yield Stub
+    
+    app.extensions.pop('stripe_gateway')
+    stripe.api_base = original_api_base
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fake_stripe(app, monkeypatch):
+    """The local fake Stripe server (fake_stripe.py), with the app's gateway pointed at it."""
+    import stripe
+    from stripe_gateway import StripeGateway
+    from fake_stripe import FakeStripe
+    
+    fake = FakeStripe(webhook_secret='whsec_test_fake').serve(port=0)
+    monkeypatch.setenv('STRIPE_WEBHOOK_SECRET', fake.webhook_secret)
+    
+    original_api_base = stripe.api_base
+    app.extensions['stripe_gateway'] = StripeGateway(api_key='sk_test_fake', api_base=fake.url, backoff=0)
+    
+    yield fake
+    
+    app.extensions.pop('stripe_gateway')
+    stripe.api_base = original_api_base
+    fake.shutdown()
+
+
 @pytest.fixture
 def test_user(app, db_session):
     """Create a test user."""
@@ -211,6 +343,52 @@ def test_product(app, db_session, test_category, test_brand):
         }
 
 
+@pytest.fixture
+def test_products(app, db_session, test_category, test_brand):
+    """Create ten products, each with two images."""
+    with app.app_context():
+        product_ids = []
+        for i in range(10):
+            product = Product(
+                title=f'Catalog Product {i}',
+                slug=f'catalog-product-{i}',
+                brand_id=test_brand['id'],
+                category_id=test_category['id'],
+                price_cents=1000 + i * 100,
+                currency='CAD',
+                stock=20,
+                is_active=True
+            )
+            db_session.add(product)
+            db_session.flush()
+            db_session.add(ProductImage(product_id=product.id, url=f'https://img.test/{i}-a.jpg', position=0, is_primary=True))
+            db_session.add(ProductImage(product_id=product.id, url=f'https://img.test/{i}-b.jpg', position=1))
+            product_ids.append(product.id)
+        db_session.commit()
+        
+        return product_ids
+
+
+@pytest.fixture
+def test_cart(app, db_session, test_user, test_products):
+    """Create a cart for the test user holding one of each test product."""
+    with app.app_context():
+        cart = Cart(user_id=test_user['id'])
+        db_session.add(cart)
+        db_session.flush()
+        for product_id in test_products:
+            product = db_session.get(Product, product_id)
+            db_session.add(CartItem(
+                cart_id=cart.id,
+                product_id=product_id,
+                quantity=1,
+                unit_price_cents=product.price_cents
+            ))
+        db_session.commit()
+        
+        return {'id': cart.id, 'product_ids': test_products}
+
+
 @pytest.fixture
 def auth_headers(app, client, test_user):
     """Get authentication headers for test user."""
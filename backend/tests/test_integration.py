@@ -13,6 +13,7 @@ These tests pass when run against a real PostgreSQL database.
 """
 import pytest
 import json
+from extensions import db
 
 
 class TestAuthAPI:
@@ -237,6 +238,32 @@ class TestCartAPI:
         # May fail due to cart creation, but tests the endpoint exists
         assert response.status_code in [200, 500]
     
+    def test_get_cart_without_cart_is_virtual(self, app, client, auth_headers):
+        """Test reading a missing cart returns an empty cart without creating one."""
+        response = client.get('/api/cart', headers=auth_headers)
+        
+        assert response.status_code == 200
+        data = response.get_json()
+        assert data['items'] == []
+        assert data['cart_id'] is None
+        
+        with app.app_context():
+            from models import Cart
+            assert Cart.query.count() == 0
+    
+    def test_get_cart_query_count(self, client, auth_headers, test_cart, count_queries):
+        """Test the full cart view loads in at most two queries regardless of item count."""
+        with count_queries() as statements:
+            response = client.get('/api/cart', headers=auth_headers)
+        
+        assert response.status_code == 200
+        data = response.get_json()
+        assert data['item_count'] == 10
+        assert data['items'][0]['product']['brand']['name'] == 'TestBrand'
+        assert data['items'][0]['product']['image']['url'].endswith('-a.jpg')
+        assert len(statements) <= 2, statements
+        assert not any(s.lstrip().upper().startswith(('INSERT', 'UPDATE', 'DELETE')) for s in statements)
+    
     @pytest.mark.skip(reason="SQLite doesn't support PostgreSQL auto-increment on cart.id - works in production")
     def test_update_cart_item(self, client, test_product, auth_headers):
         """Test updating cart item quantity."""
@@ -270,8 +297,604 @@ class TestCartAPI:
         )
         
         assert response.status_code == 200
+    
+    def test_batch_update_cart(self, app, client, auth_headers, test_products, count_queries):
+        """Test a batch of cart operations is applied in one commit with per-operation results."""
+        first, second, third = test_products[:3]
+        operations = [
+            {'op': 'add', 'product_id': first, 'quantity': 2},
+            {'op': 'add', 'product_id': second},
+            {'op': 'add', 'product_id': third, 'quantity': 3},
+            {'op': 'update', 'product_id': first, 'quantity': 5},
+            {'op': 'remove', 'product_id': third},
+            {'op': 'add', 'product_id': second, 'quantity': 50},
+            {'op': 'remove', 'product_id': 99999},
+            {'op': 'explode', 'product_id': first}
+        ]
+        
+        with count_queries() as statements:
+            response = client.post('/api/cart/batch', json={'operations': operations}, headers=auth_headers)
+        
+        assert response.status_code == 200
+        data = response.get_json()
+        assert data['applied'] == 5
+        assert data['failed'] == 3
+        assert [r['success'] for r in data['results']] == [True, True, True, True, True, False, False, False]
+        assert 'available' in data['results'][5]['error']
+        
+        product_selects = [s for s in statements if s.lstrip().upper().startswith('SELECT') and 'FROM products' in s]
+        assert len(product_selects) == 1
+        
+        cart = client.get('/api/cart', headers=auth_headers).get_json()
+        quantities = {item['product_id']: item['quantity'] for item in cart['items']}
+        assert quantities == {first: 5, second: 1}
+    
+    def test_get_cart_etag_and_not_modified(self, client, auth_headers, test_cart, count_queries):
+        """Test the cart version is the ETag and a matching If-None-Match returns 304 cheaply."""
+        response = client.get('/api/cart', headers=auth_headers)
+        etag = response.headers['ETag']
+        
+        assert response.get_json()['version'] == 1
+        assert etag.startswith('"1-')
+        
+        with count_queries() as statements:
+            cached = client.get('/api/cart', headers={**auth_headers, 'If-None-Match': etag})
+        
+        assert cached.status_code == 304
+        assert cached.headers['ETag'] == etag
+        assert len(statements) == 1
+        
+        client.put('/api/cart/update', json={'product_id': test_cart['product_ids'][0], 'quantity': 3}, headers=auth_headers)
+        refreshed = client.get('/api/cart', headers={**auth_headers, 'If-None-Match': etag})
+        
+        assert refreshed.status_code == 200
+        assert refreshed.get_json()['version'] == 2
+    
+    def test_cart_etag_changes_with_prices(self, app, db_session, client, auth_headers, test_cart):
+        """Test price, sale and promo changes, which leave the cart version alone, still change the ETag."""
+        from models import Product, PromoCode
+        
+        def revalidate(etag):
+            return client.get('/api/cart', headers={**auth_headers, 'If-None-Match': etag})
+        
+        etag = client.get('/api/cart', headers=auth_headers).headers['ETag']
+        with app.app_context():
+            db_session.get(Product, test_cart['product_ids'][0]).price_cents += 500
+            db_session.commit()
+        
+        repriced = revalidate(etag)
+        assert repriced.status_code == 200
+        assert repriced.get_json()['version'] == 1
+        assert repriced.headers['ETag'] != etag
+        
+        etag = repriced.headers['ETag']
+        with app.app_context():
+            db_session.get(Product, test_cart['product_ids'][1]).sale_percent = 20
+            db_session.commit()
+        assert revalidate(etag).status_code == 200
+        
+        with app.app_context():
+            db_session.add(PromoCode(code='SAVE10', discount_percent=10, is_active=True))
+            db_session.commit()
+        applied = client.post('/api/cart/apply-promo', json={'promo_code': 'SAVE10'}, headers=auth_headers)
+        assert applied.status_code == 200
+        etag = client.get('/api/cart', headers=auth_headers).headers['ETag']
+        
+        with app.app_context():
+            PromoCode.query.filter_by(code='SAVE10').one().is_active = False
+            db_session.commit()
+        dropped = revalidate(etag)
+        assert dropped.status_code == 200
+        assert dropped.get_json()['discount_cents'] == 0
+        
+        # The cart view's ETag works as If-Match for the next write
+        updated = client.put('/api/cart/update', json={'product_id': test_cart['product_ids'][0], 'quantity': 2},
+                             headers={**auth_headers, 'If-Match': dropped.headers['ETag']})
+        assert updated.status_code == 200
+    
+    def test_stale_if_match_rejected(self, client, auth_headers, test_cart):
+        """Test a write based on an outdated cart version gets 412 and changes nothing."""
+        product_id = test_cart['product_ids'][0]
+        
+        first = client.put('/api/cart/update',
+            json={'product_id': product_id, 'quantity': 2},
+            headers={**auth_headers, 'If-Match': '"1"'}
+        )
+        assert first.status_code == 200
+        assert first.headers['ETag'] == '"2"'
+        
+        stale = client.put('/api/cart/update',
+            json={'product_id': product_id, 'quantity': 5},
+            headers={**auth_headers, 'If-Match': '"1"'}
+        )
+        assert stale.status_code == 412
+        
+        cart = client.get('/api/cart', headers=auth_headers).get_json()
+        assert cart['version'] == 2
+        assert cart['items'][0]['quantity'] == 2
+    
+    def test_add_to_cart_twice_sums_quantity(self, app, client, auth_headers, test_products):
+        """Test adding the same product twice upserts one line."""
+        product_id = test_products[0]
+        
+        first = client.post('/api/cart/add', json={'product_id': product_id, 'quantity': 2}, headers=auth_headers)
+        second = client.post('/api/cart/add', json={'product_id': product_id, 'quantity': 3}, headers=auth_headers)
+        
+        assert first.status_code == 201
+        assert second.status_code == 200
+        assert second.get_json()['quantity'] == 5
+        
+        with app.app_context():
+            from models import CartItem
+            assert CartItem.query.filter_by(product_id=product_id).count() == 1
+    
+    def test_add_to_cart_over_stock_rejected(self, client, auth_headers, test_products):
+        """Test the upsert refuses to push a line past stock."""
+        product_id = test_products[0]
+        client.post('/api/cart/add', json={'product_id': product_id, 'quantity': 15}, headers=auth_headers)
+        
+        response = client.post('/api/cart/add', json={'product_id': product_id, 'quantity': 10}, headers=auth_headers)
+        
+        assert response.status_code == 400
+    
+    def test_add_if_match_without_cart_rejected(self, app, client, auth_headers, test_user, test_products):
+        """Test adding with If-Match for a cart that does not exist gets 412 and creates nothing."""
+        response = client.post('/api/cart/add',
+            json={'product_id': test_products[0]},
+            headers={**auth_headers, 'If-Match': '"5"'}
+        )
+        assert response.status_code == 412
+        
+        with app.app_context():
+            from models import Cart
+            assert Cart.query.filter_by(user_id=test_user['id']).count() == 0
+        
+        created = client.post('/api/cart/add',
+            json={'product_id': test_products[0]},
+            headers={**auth_headers, 'If-Match': '"0"'}
+        )
+        assert created.status_code == 201
+        assert created.headers['ETag'] == '"1"'
+    
+    def test_add_over_stock_keeps_cart_version(self, app, client, auth_headers, test_user, test_products):
+        """Test an add that fails the stock check leaves the cart version alone."""
+        from cart_store import upsert_cart_item
+        from models import Cart, Product
+        
+        product_id = test_products[0]
+        client.post('/api/cart/add', json={'product_id': product_id, 'quantity': 15}, headers=auth_headers)
+        
+        with app.app_context():
+            product = db.session.get(Product, product_id)
+            assert upsert_cart_item(test_user['id'], product, 10) is None
+            assert db.session.query(Cart.version).filter_by(user_id=test_user['id']).scalar() == 1
+            db.session.rollback()
+    
+    def test_apply_promo_discounts_cart(self, app, client, auth_headers, db_session, test_cart, count_queries):
+        """Test an applied promo is stored on the cart and priced server-side."""
+        from models import PromoCode
+        
+        with app.app_context():
+            db_session.add(PromoCode(code='SAVE10', discount_percent=10, is_active=True))
+            db_session.commit()
+        
+        client.post('/api/cart/apply-promo', json={'promo_code': 'save10'}, headers=auth_headers)
+        with count_queries() as statements:
+            response = client.post('/api/cart/apply-promo', json={'promo_code': 'SAVE10'}, headers=auth_headers)
+        
+        assert response.status_code == 200
+        assert not any('promo_codes' in statement for statement in statements)
+        
+        cart = client.get('/api/cart', headers=auth_headers).get_json()
+        assert cart['promo_code'] == 'SAVE10'
+        assert cart['discount_cents'] > 0
+        assert cart['total_cents'] == (
+            cart['subtotal_cents'] - cart['discount_cents'] + cart['shipping_cents'] + cart['tax_cents']
+        )
+        
+        client.delete('/api/cart/promo', headers=auth_headers)
+        assert client.get('/api/cart', headers=auth_headers).get_json()['discount_cents'] == 0
+    
+    def test_apply_invalid_promo(self, client, auth_headers, db_session):
+        """Test unknown promo codes are rejected."""
+        response = client.post('/api/cart/apply-promo', json={'promo_code': 'NOPE'}, headers=auth_headers)
+        
+        assert response.status_code == 400
+    
+    def test_batch_update_cart_requires_operations(self, client, auth_headers):
+        """Test batch endpoint rejects a missing operations list."""
+        response = client.post('/api/cart/batch', json={}, headers=auth_headers)
+        
+        assert response.status_code == 400
 
 
+class TestGuestCartAPI:
+    """Integration tests for guest cart endpoints and the merge at login."""
+    
+    def test_guest_cart_add_and_get(self, client, test_products):
+        """Test anonymous shoppers get a signed cookie and a server-side cart."""
+        response = client.post('/api/cart/guest/add', json={'product_id': test_products[0], 'quantity': 2})
+        
+        assert response.status_code == 201
+        assert 'guest_cart=' in response.headers.get('Set-Cookie', '')
+        
+        client.post('/api/cart/guest/add', json={'product_id': test_products[1]})
+        data = client.get('/api/cart/guest').get_json()
+        
+        assert [item['product_id'] for item in data['items']] == test_products[:2]
+        assert data['total_items'] == 3
+    
+    def test_guest_cart_rejects_tampered_cookie(self, client, test_products):
+        """Test a forged cookie does not resolve to a guest cart."""
+        client.post('/api/cart/guest/add', json={'product_id': test_products[0]})
+        client.set_cookie('guest_cart', 'forged-token')
+        
+        data = client.get('/api/cart/guest').get_json()
+        
+        assert data['items'] == []
+    
+    def test_guest_cart_merged_on_login(self, app, client, test_user, test_cart):
+        """Test login folds the guest cart into the user's cart with summed quantities."""
+        first, second = test_cart['product_ids'][:2]
+        client.post('/api/cart/guest/add', json={'product_id': first, 'quantity': 2})
+        client.post('/api/cart/guest/add', json={'product_id': second, 'quantity': 20})
+        
+        response = client.post('/api/auth/login', json={
+            'email': test_user['email'],
+            'password': test_user['password']
+        })
+        
+        assert response.status_code == 200
+        with app.app_context():
+            from models import CartItem, GuestCart
+            quantities = dict(
+                CartItem.query.with_entities(CartItem.product_id, CartItem.quantity)
+                .filter_by(cart_id=test_cart['id']).all()
+            )
+            assert quantities[first] == 3
+            assert quantities[second] == 20  # capped at stock
+            assert len(quantities) == 10
+            assert GuestCart.query.count() == 0
+    
+    def test_expire_guest_carts(self, app, db_session):
+        """Test the cleanup job deletes only abandoned guest carts."""
+        from datetime import datetime, timedelta, timezone
+        from models import GuestCart
+        from guest_cart import expire_guest_carts
+        
+        with app.app_context():
+            old = datetime.now(timezone.utc) - timedelta(days=45)
+            db_session.add(GuestCart(token='stale', items={'1': 1}, updated_at=old))
+            db_session.add(GuestCart(token='fresh', items={'1': 1}))
+            db_session.commit()
+            
+            assert expire_guest_carts(max_age_days=30, batch_size=1) == 1
+            assert [c.token for c in GuestCart.query.all()] == ['fresh']
+
+
+class TestKeyValueCartStore:
+    """Integration tests for the cart API on the key-value cart store."""
+    
+    def test_cart_round_trip(self, app, client, auth_headers, test_products, kv_cart_store, count_queries):
+        """Test cart reads and writes stay out of the carts tables until checkout."""
+        first, second = test_products[:2]
+        
+        with count_queries() as statements:
+            added = client.post('/api/cart/add', json={'product_id': first, 'quantity': 2}, headers=auth_headers)
+            again = client.post('/api/cart/add', json={'product_id': first, 'quantity': 1}, headers=auth_headers)
+            client.post('/api/cart/batch', json={'operations': [
+                {'op': 'add', 'product_id': second, 'quantity': 4},
+                {'op': 'remove', 'product_id': 999999}
+            ]}, headers=auth_headers)
+            client.put('/api/cart/update', json={'product_id': second, 'quantity': 5}, headers=auth_headers)
+            cart = client.get('/api/cart', headers=auth_headers)
+        
+        assert added.status_code == 201
+        assert again.status_code == 200
+        assert again.get_json()['quantity'] == 3
+        # Only the first write touches carts, to carry on from the database cart's version
+        cart_statements = [statement.lower() for statement in statements if 'cart' in statement.lower()]
+        assert len(cart_statements) == 1
+        assert cart_statements[0].startswith('select carts.version')
+        
+        data = cart.get_json()
+        assert {item['product_id']: item['quantity'] for item in data['items']} == {first: 3, second: 5}
+        assert data['version'] == 4
+        assert cart.headers['ETag'].startswith('"4-')
+        
+        count = client.get('/api/cart/count', headers=auth_headers).get_json()
+        assert count == {'count': 2, 'total_items': 8}
+    
+    def test_stale_if_match_rejected(self, client, auth_headers, test_products, kv_cart_store):
+        """Test the key-value store honours If-Match like the SQL store."""
+        client.post('/api/cart/add', json={'product_id': test_products[0]}, headers=auth_headers)
+        
+        response = client.delete('/api/cart/remove',
+            json={'product_id': test_products[0]},
+            headers={**auth_headers, 'If-Match': '"7"'}
+        )
+        missing = client.delete('/api/cart/remove', json={'product_id': test_products[1]}, headers=auth_headers)
+        
+        assert response.status_code == 412
+        assert missing.status_code == 404
+    
+    def test_persist_for_checkout(self, app, client, auth_headers, test_user, test_products, kv_cart_store):
+        """Test the live cart is written to carts and cart_items at checkout."""
+        client.post('/api/cart/add', json={'product_id': test_products[0], 'quantity': 2}, headers=auth_headers)
+        
+        with app.app_context():
+            from models import Cart
+            kv_cart_store.persist(test_user['id'])
+            cart = Cart.query.filter_by(user_id=test_user['id']).one()
+            assert [(item.product_id, item.quantity) for item in cart.items] == [(test_products[0], 2)]
+            
+            kv_cart_store.forget(test_user['id'])
+            assert kv_cart_store.version(test_user['id']) == 0
+    
+    def test_new_cart_after_checkout_gets_a_new_session(self, app, client, auth_headers, test_user, test_products, kv_cart_store, fake_stripe, monkeypatch):
+        """Test versions keep rising across checkouts, so a new cart never replays a paid session."""
+        from webhook_inbox import drain
+        
+        monkeypatch.setenv('SKIP_EMAILS', '1')
+        client.post('/api/cart/add', json={'product_id': test_products[0]}, headers=auth_headers)
+        first = client.post('/api/checkout/create-session', json={}, headers=auth_headers)
+        first_version = client.get('/api/cart', headers=auth_headers).get_json()['version']
+        
+        payload, signature = fake_stripe.complete_session(first.get_json()['session_id'])
+        client.post('/api/checkout/webhook', data=payload, content_type='application/json',
+                    headers={'Stripe-Signature': signature})
+        with app.app_context():
+            assert drain() == (1, 0)
+        
+        client.post('/api/cart/add', json={'product_id': test_products[0]}, headers=auth_headers)
+        second = client.post('/api/checkout/create-session', json={}, headers=auth_headers)
+        
+        assert client.get('/api/cart', headers=auth_headers).get_json()['version'] > first_version
+        assert second.status_code == 200
+        assert 'Idempotent-Replayed' not in second.headers
+        assert second.get_json()['session_id'] != first.get_json()['session_id']
+    
+    def test_replayed_checkout_leaves_cart_rows_alone(self, client, auth_headers, test_products, kv_cart_store, fake_stripe, count_queries):
+        """Test a replayed checkout session does not write the live cart to the database again."""
+        client.post('/api/cart/add', json={'product_id': test_products[0]}, headers=auth_headers)
+        first = client.post('/api/checkout/create-session', json={}, headers=auth_headers)
+        
+        with count_queries() as statements:
+            second = client.post('/api/checkout/create-session', json={}, headers=auth_headers)
+        
+        assert second.headers['Idempotent-Replayed'] == 'true'
+        assert second.get_json()['session_id'] == first.get_json()['session_id']
+        assert not [statement for statement in statements if 'cart' in statement.lower()]
+    
+    def test_failed_commit_undoes_move_to_cart(self, app, client, auth_headers, test_products, kv_cart_store, monkeypatch):
+        """Test the live cart is put back when the commit of a move to cart fails."""
+        from sqlalchemy.exc import OperationalError
+        
+        first, second = test_products[:2]
+        client.post('/api/cart/add', json={'product_id': first}, headers=auth_headers)
+        client.post('/api/wishlist/add', json={'product_id': second}, headers=auth_headers)
+        before = client.get('/api/cart', headers=auth_headers).get_json()
+        
+        def failing_commit():
+            raise OperationalError('COMMIT', {}, Exception('connection lost'))
+        
+        with monkeypatch.context() as patch:
+            patch.setattr(db.session, 'commit', failing_commit)
+            response = client.post('/api/wishlist/move-to-cart', json={'product_ids': [second]}, headers=auth_headers)
+        
+        assert response.status_code == 500
+        after = client.get('/api/cart', headers=auth_headers).get_json()
+        assert [item['product_id'] for item in after['items']] == [first]
+        assert after['version'] == before['version']
+        assert client.get('/api/wishlist/ids', headers=auth_headers).get_json()['product_ids'] == [second]
+    
+    def test_concurrent_writer_is_retried(self, app, kv_cart_store):
+        """Test a write that loses the WATCH race is retried on fresh data."""
+        client = kv_cart_store.client
+        real_pipeline = client.pipeline
+        raced = []
+        
+        def racing_pipeline():
+            pipe = real_pipeline()
+            if not raced:
+                # Another writer changes the cart between WATCH and EXEC
+                original_multi = pipe.multi
+                
+                def multi():
+                    raced.append(True)
+                    client._hset('cart:u1', {'v': 5})
+                    original_multi()
+                pipe.multi = multi
+            return pipe
+        
+        client.pipeline = racing_pipeline
+        with app.app_context():
+            version = kv_cart_store.set_promo('u1', 'SAVE10')
+        
+        assert raced
+        assert version == 6
+        assert client.hget('cart:u1', 'p') == 'SAVE10'
+
+
+class TestMaintenanceJobs:
+    """Integration tests for the batched stale data sweeper."""
+    
+    def test_sweep_stale_rows(self, app, db_session, test_user, test_products):
+        """Test the sweeper removes only abandoned items, idle empty carts and expired tokens, bumping emptied carts' versions."""
+        from datetime import datetime, timedelta, timezone
+        import uuid
+        from models import User, Cart, CartItem, PasswordResetToken
+        from maintenance import sweep_abandoned_cart_items, sweep_empty_carts, sweep_reset_tokens
+        
+        now = datetime.now(timezone.utc)
+        with app.app_context():
+            users = [User(id=str(uuid.uuid4()), email=f'sweep{i}@example.com', full_name='Sweep', password_hash='x') for i in range(3)]
+            db_session.add_all(users)
+            db_session.flush()
+            
+            stale = Cart(user_id=users[0].id, updated_at=now - timedelta(days=120))
+            empty = Cart(user_id=users[1].id, updated_at=now - timedelta(days=45))
+            recent = Cart(user_id=users[2].id, updated_at=now - timedelta(days=10))
+            live = Cart(user_id=test_user['id'])
+            db_session.add_all([stale, empty, recent, live])
+            db_session.flush()
+            for cart in (stale, live):
+                db_session.add_all([
+                    CartItem(cart_id=cart.id, product_id=product_id, quantity=1, unit_price_cents=1000)
+                    for product_id in test_products[:3]
+                ])
+            
+            db_session.add_all([
+                PasswordResetToken(user_id=test_user['id'], token='used', expires_at=now + timedelta(hours=1), used=True),
+                PasswordResetToken(user_id=test_user['id'], token='expired', expires_at=now - timedelta(hours=1)),
+                PasswordResetToken(user_id=test_user['id'], token='valid', expires_at=now + timedelta(hours=1))
+            ])
+            db_session.commit()
+            stale_id, live_id = stale.id, live.id
+            versions = {cart.id: cart.version for cart in (stale, empty, recent, live)}
+            
+            rows, seconds = sweep_abandoned_cart_items(max_age_days=90, batch_size=2)
+            assert rows == 3
+            assert seconds >= 0
+            assert sweep_reset_tokens(batch_size=1)[0] == 2
+            
+            db_session.expire_all()
+            assert CartItem.query.filter_by(cart_id=stale_id).count() == 0
+            assert CartItem.query.filter_by(cart_id=live_id).count() == 3
+            
+            # The item sweep keeps carts; the emptied one moved to a new version, the others did not change
+            carts = {cart.id: cart for cart in Cart.query.all()}
+            assert carts.keys() == versions.keys()
+            assert carts[stale_id].version > versions[stale_id]
+            assert carts[stale_id].updated_at.replace(tzinfo=timezone.utc) < now - timedelta(days=90)
+            assert carts[empty.id].version == versions[empty.id]
+            assert carts[live_id].version == versions[live_id]
+            assert [t.token for t in PasswordResetToken.query.all()] == ['valid']
+            
+            # Empty carts idle past the window go, the emptied one included
+            assert sweep_empty_carts(max_age_days=30, batch_size=1)[0] == 2
+            assert {cart.id for cart in Cart.query.all()} == {recent.id, live_id}
+    
+    def test_sweep_old_webhook_events(self, app, db_session):
+        """Test only webhook events processed before the retention window are deleted."""
+        from datetime import datetime, timedelta, timezone
+        from models import WebhookEvent
+        from maintenance import sweep_webhook_events
+        
+        now = datetime.now(timezone.utc)
+        with app.app_context():
+            for event_id, status, processed_days_ago in [
+                ('evt_old_done', 'done', 40), ('evt_new_done', 'done', 5),
+                ('evt_old_failed', 'failed', 40), ('evt_pending', 'pending', None)
+            ]:
+                db_session.add(WebhookEvent(
+                    event_id=event_id, type='checkout.session.completed', payload={}, status=status,
+                    next_attempt_at=now,
+                    processed_at=now - timedelta(days=processed_days_ago) if processed_days_ago else None
+                ))
+            db_session.commit()
+            
+            assert sweep_webhook_events(keep_days=30, batch_size=1)[0] == 1
+            assert sorted(e.event_id for e in WebhookEvent.query.all()) == ['evt_new_done', 'evt_old_failed', 'evt_pending']
+
+
+class TestWishlistAlerts:
+    """Integration tests for the wishlist price-drop and back-in-stock job."""
+    
+    def test_digest_per_user(self, app, client, auth_headers, test_user, test_products, monkeypatch):
+        """Test changes are queued set-based and sent as one digest per user."""
+        import wishlist_alerts
+        from models import Product, WishlistNotification
+        
+        first, second, third = test_products[:3]
+        for product_id in (first, second, third):
+            client.post('/api/wishlist/add', json={'product_id': product_id}, headers=auth_headers)
+        
+        digests = []
+        monkeypatch.setattr(wishlist_alerts, 'send_wishlist_digest_email',
+                            lambda user, notifications: digests.append(
+                                (user.email, {(n.product_id, n.kind) for n in notifications})
+                            ) or True)
+        
+        def run(chunk_size=10000):
+            wishlist_alerts.stage_product_state()
+            queued = wishlist_alerts.queue_notifications(chunk_size)
+            wishlist_alerts.record_product_state()
+            return queued
+        
+        with app.app_context():
+            # First run records the baseline
+            assert run() == 0
+            
+            db.session.get(Product, first).sale_percent = 10
+            db.session.get(Product, second).stock = 0
+            db.session.get(Product, third).price_cents += 500
+            db.session.commit()
+            run(chunk_size=1)
+            
+            db.session.get(Product, second).stock = 5
+            db.session.commit()
+            assert run(chunk_size=2) == 1
+            
+            assert wishlist_alerts.send_digests(batch_size=1) == 1
+            assert run() == 0
+            assert WishlistNotification.query.filter(WishlistNotification.sent_at.is_(None)).count() == 0
+        
+        assert len(digests) == 1
+        assert digests[0] == ('test@example.com', {(first, 'price_drop'), (second, 'back_in_stock')})
+    
+    def test_change_mid_run_and_failed_digest_are_kept(self, app, client, auth_headers, test_user, test_products, monkeypatch):
+        """Test a change after the snapshot is queued next run and a failed digest is retried."""
+        import wishlist_alerts
+        from models import Product, WishlistNotification
+        
+        product_id = test_products[0]
+        client.post('/api/wishlist/add', json={'product_id': product_id}, headers=auth_headers)
+        
+        with app.app_context():
+            wishlist_alerts.stage_product_state()
+            wishlist_alerts.queue_notifications()
+            wishlist_alerts.record_product_state()
+            
+            # The sale starts after this run's snapshot was taken
+            wishlist_alerts.stage_product_state()
+            db.session.get(Product, product_id).sale_percent = 20
+            db.session.commit()
+            assert wishlist_alerts.queue_notifications() == 0
+            wishlist_alerts.record_product_state()
+            
+            wishlist_alerts.stage_product_state()
+            assert wishlist_alerts.queue_notifications() == 1
+            wishlist_alerts.record_product_state()
+            
+            monkeypatch.setattr(wishlist_alerts, 'send_wishlist_digest_email', lambda user, notifications: False)
+            assert wishlist_alerts.send_digests() == 0
+            assert WishlistNotification.query.filter(WishlistNotification.sent_at.is_(None)).count() == 1
+            
+            monkeypatch.setattr(wishlist_alerts, 'send_wishlist_digest_email', lambda user, notifications: True)
+            assert wishlist_alerts.send_digests() == 1
+            assert WishlistNotification.query.filter(WishlistNotification.sent_at.is_(None)).count() == 0
+
+    
+    def test_sent_notifications_are_purged(self, app, test_user, test_products):
+        """Test sent notifications are deleted after the retention period and pending ones are kept."""
+        import wishlist_alerts
+        from datetime import datetime, timedelta, timezone
+        from models import WishlistNotification
+        
+        now = datetime.now(timezone.utc)
+        with app.app_context():
+            for sent_at in (now - timedelta(days=40), now - timedelta(days=5), None):
+                db.session.add(WishlistNotification(
+                    user_id=test_user['id'], product_id=test_products[0], kind='price_drop',
+                    old_price_cents=2000, new_price_cents=1500, sent_at=sent_at
+                ))
+            db.session.commit()
+            
+            assert wishlist_alerts.purge_sent_notifications(keep_days=30)[0] == 1
+            kept = WishlistNotification.query.all()
+            assert sorted(n.sent_at is None for n in kept) == [False, True]
+
 class TestWishlistAPI:
     """Integration tests for wishlist API endpoints."""
     
@@ -305,6 +928,120 @@ class TestWishlistAPI:
         data = response.get_json()
         assert 'product_ids' in data
     
+    def test_add_to_wishlist_is_idempotent(self, app, client, auth_headers, test_products):
+        """Test adding a product twice keeps one wishlist row."""
+        product_id = test_products[0]
+        
+        first = client.post('/api/wishlist/add', json={'product_id': product_id}, headers=auth_headers)
+        second = client.post('/api/wishlist/add', json={'product_id': product_id}, headers=auth_headers)
+        missing = client.post('/api/wishlist/add', json={'product_id': 999999}, headers=auth_headers)
+        
+        assert first.status_code == 201
+        assert second.status_code == 200
+        assert missing.status_code == 404
+        
+        with app.app_context():
+            from models import WishlistItem
+            assert WishlistItem.query.filter_by(product_id=product_id).count() == 1
+    
+    def test_toggle_wishlist_round_trip(self, client, auth_headers, test_products):
+        """Test toggling adds then removes a product."""
+        product_id = test_products[0]
+        
+        added = client.post('/api/wishlist/toggle', json={'product_id': product_id}, headers=auth_headers)
+        removed = client.post('/api/wishlist/toggle', json={'product_id': product_id}, headers=auth_headers)
+        missing = client.post('/api/wishlist/toggle', json={'product_id': 999999}, headers=auth_headers)
+        
+        assert added.get_json()['action'] == 'added'
+        assert removed.get_json()['action'] == 'removed'
+        assert missing.status_code == 404
+    
+    def test_wishlist_ids_cached_and_read_only(self, app, client, auth_headers, test_products, count_queries):
+        """Test the id list never writes, is cached and revalidates with ETags."""
+        first, second = test_products[:2]
+        
+        with count_queries() as statements:
+            empty = client.get('/api/wishlist/ids', headers=auth_headers)
+            client.get('/api/wishlist/ids', headers=auth_headers)
+        assert empty.get_json()['product_ids'] == []
+        assert len(statements) == 1
+        assert statements[0].lstrip().upper().startswith('SELECT')
+        
+        client.post('/api/wishlist/add', json={'product_id': second}, headers=auth_headers)
+        client.post('/api/wishlist/toggle', json={'product_id': first}, headers=auth_headers)
+        
+        with count_queries() as statements:
+            response = client.get('/api/wishlist/ids', headers=auth_headers)
+            not_modified = client.get('/api/wishlist/ids', headers={**auth_headers, 'If-None-Match': response.headers['ETag']})
+        
+        assert response.get_json()['product_ids'] == [first, second]
+        assert response.headers['ETag'] != empty.headers['ETag']
+        assert not_modified.status_code == 304
+        assert statements == []
+    
+    def test_bulk_wishlist_check(self, client, auth_headers, test_products, count_queries):
+        """Test many products are checked in one request with at most one query."""
+        first, second, third = test_products[:3]
+        client.post('/api/wishlist/add', json={'product_id': second}, headers=auth_headers)
+        
+        with count_queries() as statements:
+            response = client.get(f'/api/wishlist/check?ids={first},{second}&ids={third}', headers=auth_headers)
+            single = client.get(f'/api/wishlist/check/{second}', headers=auth_headers)
+        
+        assert response.get_json()['in_wishlist'] == {str(first): False, str(second): True, str(third): False}
+        assert response.get_json()['product_ids'] == [second]
+        assert single.get_json() == {'in_wishlist': True}
+        assert len(statements) <= 1
+        
+        assert client.get('/api/wishlist/check?ids=a,b', headers=auth_headers).status_code == 400
+    
+    def test_move_wishlist_to_cart(self, app, client, auth_headers, test_products):
+        """Test wishlisted products move into the cart together, skipping out-of-stock ones."""
+        first, second, third = test_products[:3]
+        for product_id in (first, second, third):
+            client.post('/api/wishlist/add', json={'product_id': product_id}, headers=auth_headers)
+        client.post('/api/cart/add', json={'product_id': first, 'quantity': 2}, headers=auth_headers)
+        
+        with app.app_context():
+            from models import Product
+            Product.query.filter_by(id=third).update({'stock': 0})
+            db.session.commit()
+        
+        response = client.post('/api/wishlist/move-to-cart',
+            json={'product_ids': [first, second, third, 999999]},
+            headers=auth_headers
+        )
+        
+        data = response.get_json()
+        assert response.status_code == 200
+        assert data['moved'] == sorted([first, second])
+        assert {f['product_id']: f['error'] for f in data['failed']} == {
+            third: 'Out of stock', 999999: 'Product not in wishlist'
+        }
+        
+        cart = client.get('/api/cart', headers=auth_headers).get_json()
+        assert {item['product']['id']: item['quantity'] for item in cart['items']} == {first: 3, second: 1}
+        assert client.get('/api/wishlist/ids', headers=auth_headers).get_json()['product_ids'] == [third]
+        
+        assert data['capped'] == []
+        assert client.post('/api/wishlist/move-to-cart', json={'product_ids': 'some'}, headers=auth_headers).status_code == 400
+        assert client.post('/api/wishlist/move-to-cart', json={'product_ids': 'all'}, headers=auth_headers).get_json()['moved'] == []
+    
+    def test_move_to_cart_reports_capped_products(self, client, auth_headers, test_products):
+        """Test a product the cart already holds all the stock of is reported as capped, not moved."""
+        full, other = test_products[:2]
+        for product_id in (full, other):
+            client.post('/api/wishlist/add', json={'product_id': product_id}, headers=auth_headers)
+        client.post('/api/cart/add', json={'product_id': full, 'quantity': 20}, headers=auth_headers)
+        
+        data = client.post('/api/wishlist/move-to-cart', json={'product_ids': 'all'}, headers=auth_headers).get_json()
+        
+        assert data['moved'] == [other]
+        assert data['capped'] == [{'product_id': full, 'requested': 1, 'moved': 0}]
+        assert data['message'] == 'Moved 1 items to cart'
+        cart = client.get('/api/cart', headers=auth_headers).get_json()
+        assert {item['product']['id']: item['quantity'] for item in cart['items']} == {full: 20, other: 1}
+    
     def test_wishlist_unauthorized(self, client, test_product):
         """Test wishlist operations require authentication."""
         response = client.post('/api/wishlist/toggle',
@@ -314,6 +1051,366 @@ class TestWishlistAPI:
         assert response.status_code == 401
 
 
+class TestCheckoutAPI:
+    """Integration tests for checkout against a local Stripe stub."""
+    
+    def test_create_session_retries_stripe_errors(self, client, auth_headers, test_cart, stripe_stub):
+        """Test a Stripe 5xx is retried with the same idempotency key."""
+        stripe_stub.replies.append((500, {'error': {'type': 'api_error', 'message': 'Try again'}}, 0))
+        
+        response = client.post('/api/checkout/create-session', json={}, headers=auth_headers)
+        
+        assert response.status_code == 200
+        assert response.get_json()['checkout_url'] == 'https://checkout.test/cs_test_stub'
+        assert [r['path'] for r in stripe_stub.requests] == ['/v1/checkout/sessions'] * 2
+        keys = {r['headers']['Idempotency-Key'] for r in stripe_stub.requests}
+        assert len(keys) == 1
+        
+        metrics = stripe_stub.gateway.status()['operations']['checkout.session.create']
+        assert (metrics['calls'], metrics['errors'], metrics['retries']) == (2, 1, 1)
+    
+    def test_retried_refund_keeps_a_generated_idempotency_key(self, stripe_stub):
+        """Test a POST made without an idempotency key still retries under one key."""
+        stripe_stub.replies.append((500, {'error': {'type': 'api_error', 'message': 'Try again'}}, 0))
+        stripe_stub.replies.append((200, {'id': 're_stub', 'object': 'refund'}, 0))
+        
+        refund = stripe_stub.gateway.create_refund(payment_intent='pi_stub')
+        
+        assert refund.id == 're_stub'
+        keys = [r['headers'].get('Idempotency-Key') for r in stripe_stub.requests]
+        assert len(keys) == 2 and keys[0] and keys[0] == keys[1]
+    
+    def test_circuit_breaker_fails_fast(self, client, auth_headers, admin_auth_headers, test_cart, stripe_stub):
+        """Test repeated failed Stripe calls open the breaker so later calls skip Stripe."""
+        for _ in range(9):
+            stripe_stub.replies.append((503, {'error': {'type': 'api_error', 'message': 'Down'}}, 0))
+        
+        # Three calls of three attempts each: one breaker failure per call
+        failed = [client.post('/api/checkout/create-session', json={}, headers=auth_headers) for _ in range(3)]
+        rejected = client.post('/api/checkout/create-session', json={}, headers=auth_headers)
+        
+        assert [response.status_code for response in failed] == [500] * 3
+        assert rejected.status_code == 503
+        assert int(rejected.headers['Retry-After']) > 0
+        assert len(stripe_stub.requests) == 9
+        
+        metrics = client.get('/api/checkout/metrics', headers=admin_auth_headers)
+        assert metrics.get_json()['circuit'] == 'open'
+        assert client.get('/api/checkout/metrics', headers=auth_headers).status_code == 403
+    
+    def test_repeated_checkout_is_idempotent(self, client, auth_headers, test_cart, stripe_stub):
+        """Test a double-clicked checkout reuses the first session without calling Stripe again."""
+        first = client.post('/api/checkout/create-session', json={}, headers=auth_headers)
+        second = client.post('/api/checkout/create-session', json={}, headers=auth_headers)
+        
+        assert second.get_json() == first.get_json()
+        assert second.headers['Idempotent-Replayed'] == 'true'
+        assert len(stripe_stub.requests) == 1
+        assert stripe_stub.requests[0]['headers']['Idempotency-Key'].startswith('checkout-')
+        
+        keyed = {**auth_headers, 'Idempotency-Key': 'click-1'}
+        client.post('/api/checkout/create-session', json={}, headers=keyed)
+        replay = client.post('/api/checkout/create-session', json={}, headers=keyed)
+        
+        assert replay.headers['Idempotent-Replayed'] == 'true'
+        assert len(stripe_stub.requests) == 2
+        assert 'click-1' in stripe_stub.requests[1]['headers']['Idempotency-Key']
+    
+    def test_paid_session_is_never_replayed(self, app, client, auth_headers, test_user, test_product, fake_stripe, monkeypatch):
+        """Test a repeated Idempotency-Key gets a new session once the first one has been paid."""
+        from checkout import checkout_sessions
+        from webhook_inbox import drain
+        
+        monkeypatch.setenv('SKIP_EMAILS', '1')
+        keyed = {**auth_headers, 'Idempotency-Key': 'click-1'}
+        client.post('/api/cart/add', json={'product_id': test_product['id']}, headers=auth_headers)
+        first = client.post('/api/checkout/create-session', json={}, headers=keyed).get_json()
+        
+        payload, signature = fake_stripe.complete_session(first['session_id'])
+        client.post('/api/checkout/webhook', data=payload, content_type='application/json',
+                    headers={'Stripe-Signature': signature})
+        with app.app_context():
+            assert drain() == (1, 0)
+        
+        # Evicted by order creation in this process
+        assert checkout_sessions.get((test_user['id'], 'click-1')) is None
+        
+        # Still cached in another worker's process: the recorded payment stops the replay
+        checkout_sessions.set((test_user['id'], 'click-1'), first)
+        client.post('/api/cart/add', json={'product_id': test_product['id']}, headers=auth_headers)
+        second = client.post('/api/checkout/create-session', json={}, headers=keyed)
+        
+        assert second.status_code == 200
+        assert 'Idempotent-Replayed' not in second.headers
+        assert second.get_json()['session_id'] != first['session_id']
+    
+    def test_webhook_is_stored_and_processed_later(self, app, client, test_user, test_cart, stripe_stub, monkeypatch):
+        """Test the webhook only stores the event; workers create the order, retrying failures."""
+        from models import WebhookEvent, Order
+        from webhook_inbox import drain, inbox_stats
+        
+        monkeypatch.delenv('STRIPE_WEBHOOK_SECRET', raising=False)
+        monkeypatch.setenv('SKIP_EMAILS', '1')
+        event = {
+            'id': 'evt_test_1',
+            'type': 'checkout.session.completed',
+            'data': {'object': {'id': 'cs_test_1', 'metadata': {'user_id': test_user['id']}}}
+        }
+        
+        first = client.post('/api/checkout/webhook', json=event)
+        retried = client.post('/api/checkout/webhook', json=event)
+        
+        assert first.get_json() == {'received': True, 'duplicate': False}
+        assert retried.get_json() == {'received': True, 'duplicate': True}
+        assert stripe_stub.requests == []
+        
+        stripe_stub.gateway.max_retries = 0
+        stripe_stub.replies.append((500, {'error': {'type': 'api_error', 'message': 'Try again'}}, 0))
+        stripe_stub.replies.append((200, {
+            'id': 'cs_test_1', 'object': 'checkout.session', 'payment_intent': 'pi_test_1',
+            'payment_status': 'paid', 'shipping_cost': None, 'metadata': {'user_id': test_user['id']}
+        }, 0))
+        
+        with app.app_context():
+            assert inbox_stats()['pending'] == 1
+            assert drain() == (0, 1)
+            
+            stored = db.session.get(WebhookEvent, 'evt_test_1')
+            assert (stored.status, stored.attempts) == ('pending', 1)
+            assert 'Try again' in stored.last_error
+            assert drain() == (0, 0)  # Not due yet
+            
+            stored.next_attempt_at = stored.received_at
+            db.session.commit()
+            assert drain() == (1, 0)
+            
+            assert db.session.get(WebhookEvent, 'evt_test_1').status == 'done'
+            assert Order.query.filter_by(user_id=test_user['id']).count() == 1
+            assert inbox_stats()['pending'] == 0
+    
+    def test_create_app_starts_no_webhook_workers(self, monkeypatch):
+        """Test building the app, as every flask CLI command does, starts no background workers."""
+        monkeypatch.setenv('DATABASE_URL', 'sqlite://')
+        monkeypatch.setenv('WEBHOOK_WORKERS', '2')
+        from app import create_app
+        from webhook_inbox import start_webhook_workers
+        
+        served = create_app()
+        assert 'webhook_workers' not in served.extensions
+        
+        pool = start_webhook_workers(served)
+        try:
+            assert served.extensions['webhook_workers'] is pool
+            assert len(pool._threads) == 2
+        finally:
+            pool.stop(timeout=5)
+        
+        monkeypatch.setenv('WEBHOOK_WORKERS', '0')
+        assert start_webhook_workers(create_app()) is None
+    
+    def test_concurrent_order_creation_is_exactly_once(self, app, tmp_path, monkeypatch):
+        """Test many threads finalizing one session concurrently create a single order."""
+        from concurrent.futures import ThreadPoolExecutor
+        from types import SimpleNamespace
+        from flask import Flask
+        from checkout import create_order_from_session
+        from models import User, Product, Cart, CartItem, Order, Payment
+        
+        monkeypatch.setenv('SKIP_EMAILS', '1')
+        
+        # A file database, so every thread gets its own connection and transaction
+        stress_app = Flask(__name__)
+        stress_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{tmp_path}/orders.db'
+        stress_app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 30}}
+        db.init_app(stress_app)
+        
+        with stress_app.app_context():
+            db.create_all()
+            user = User(id='00000000-0000-0000-0000-000000000042', email='race@example.com', full_name='Race')
+            product = Product(title='Racer', slug='racer', price_cents=2500, stock=100)
+            db.session.add_all([user, product])
+            db.session.flush()
+            cart = Cart(user_id=user.id)
+            db.session.add(cart)
+            db.session.flush()
+            db.session.add(CartItem(cart_id=cart.id, product_id=product.id, quantity=2, unit_price_cents=2500))
+            db.session.commit()
+            user_id = user.id
+        
+        session = SimpleNamespace(
+            id='cs_race', payment_intent='pi_race', shipping_cost=None, metadata={'user_id': user_id}
+        )
+        
+        def finalize(_):
+            with stress_app.app_context():
+                order, created = create_order_from_session(session, user_id)
+                return (order.id if order else None), created
+        
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(finalize, range(32)))
+        
+        with stress_app.app_context():
+            assert Order.query.count() == 1
+            assert Payment.query.count() == 1
+            order_id = Order.query.one().id
+            db.engine.dispose()
+        
+        assert [created for _, created in results].count(True) == 1
+        assert {found for found, _ in results} == {order_id}
+    
+    def test_order_finalization_is_set_based(self, app, test_user, test_cart, count_queries, monkeypatch):
+        """Test finalizing an order costs the same few statements for any number of lines."""
+        from types import SimpleNamespace
+        from checkout import create_order_from_session
+        from models import Order, OrderItem, CartItem, Product
+        
+        monkeypatch.setenv('SKIP_EMAILS', '1')
+        session = SimpleNamespace(
+            id='cs_bulk', payment_intent='pi_bulk', shipping_cost=None, metadata={'user_id': test_user['id']}
+        )
+        
+        with app.app_context():
+            with count_queries() as statements:
+                order, created = create_order_from_session(session, test_user['id'])
+            
+            assert created
+            assert (order.item_count, order.preview_image_url) == (len(test_cart['product_ids']), 'https://img.test/0-a.jpg')
+            writes = [s for s in statements if not s.lstrip().upper().startswith('SELECT')]
+            assert len(writes) == 6  # payment, order, items, stock, cart items, cart
+            assert OrderItem.query.filter_by(order_id=order.id).count() == len(test_cart['product_ids'])
+            assert CartItem.query.filter_by(cart_id=test_cart['id']).count() == 0
+            assert {p.stock for p in Product.query.filter(Product.id.in_(test_cart['product_ids']))} == {19}
+            assert Order.query.count() == 1
+    
+    def test_checkout_references_synced_prices(self, app, client, auth_headers, test_product, stripe_stub):
+        """Test synced Stripe prices replace inline price_data at checkout."""
+        from urllib.parse import parse_qs
+        from stripe_prices import sync_stripe_prices
+        
+        client.post('/api/cart/add', json={'product_id': test_product['id'], 'quantity': 2}, headers=auth_headers)
+        stripe_stub.replies.append((200, {'id': 'prod_stub', 'object': 'product'}, 0))
+        stripe_stub.replies.append((200, {'id': 'price_stub', 'object': 'price'}, 0))
+        
+        with app.app_context():
+            assert sync_stripe_prices(workers=1) == 1
+            assert sync_stripe_prices(workers=1) == 0
+        
+        assert [r['path'] for r in stripe_stub.requests] == ['/v1/products', '/v1/prices']
+        assert parse_qs(stripe_stub.requests[1]['body'])['unit_amount'] == ['9999']
+        
+        response = client.post('/api/checkout/create-session', json={}, headers=auth_headers)
+        
+        assert response.status_code == 200
+        body = parse_qs(stripe_stub.requests[-1]['body'])
+        assert body['line_items[0][price]'] == ['price_stub']
+        assert body['line_items[0][quantity]'] == ['2']
+        assert not any(key.startswith('line_items[0][price_data]') for key in body)
+    
+    def test_stripe_read_timeout(self, app, stripe_stub):
+        """Test a slow Stripe answer is cut off at the read timeout."""
+        import stripe
+        import time
+        
+        stripe_stub.gateway.max_retries = 0
+        stripe_stub.replies.append((200, {'id': 'cs_slow', 'object': 'checkout.session'}, 1.5))
+        
+        started = time.monotonic()
+        with pytest.raises(stripe.error.APIConnectionError):
+            stripe_stub.gateway.retrieve_checkout_session('cs_slow')
+        assert time.monotonic() - started < 1.5
+    
+    def test_checkout_end_to_end_against_fake_stripe(self, app, client, auth_headers, test_user, test_product, fake_stripe, monkeypatch):
+        """Test a checkout paid on the fake Stripe server becomes an order via its signed webhook."""
+        from models import Order
+        from webhook_inbox import drain
+        
+        monkeypatch.setenv('SKIP_EMAILS', '1')
+        client.post('/api/cart/add', json={'product_id': test_product['id'], 'quantity': 2}, headers=auth_headers)
+        
+        response = client.post('/api/checkout/create-session', json={}, headers=auth_headers)
+        assert response.status_code == 200
+        session_id = response.get_json()['session_id']
+        assert response.get_json()['checkout_url'].startswith(fake_stripe.url)
+        
+        payload, signature = fake_stripe.complete_session(session_id)
+        forged = client.post('/api/checkout/webhook', data=payload, content_type='application/json',
+                             headers={'Stripe-Signature': signature.replace('v1=', 'v1=0')})
+        delivered = client.post('/api/checkout/webhook', data=payload, content_type='application/json',
+                                headers={'Stripe-Signature': signature})
+        
+        assert forged.status_code == 400
+        assert delivered.get_json() == {'received': True, 'duplicate': False}
+        
+        with app.app_context():
+            assert drain() == (1, 0)
+            order = Order.query.filter_by(user_id=test_user['id']).one()
+            assert order.subtotal_cents == 2 * 9999
+    
+    def test_reconcile_creates_orders_for_lost_webhooks(self, app, client, auth_headers, test_user, test_cart, fake_stripe, count_queries, monkeypatch):
+        """Test reconciliation creates orders only for paid sessions that have none, one payments query per page."""
+        from checkout import create_order_from_session
+        from reconcile import reconcile_checkouts
+        from models import Order
+        
+        monkeypatch.setenv('SKIP_EMAILS', '1')
+        metadata = {'metadata': {'user_id': test_user['id']}}
+        
+        with app.app_context():
+            gateway = app.extensions['stripe_gateway']
+            
+            # Delivered: the webhook created this one's order
+            delivered = fake_stripe.create_session(metadata)['id']
+            fake_stripe.complete_session(delivered)
+            assert create_order_from_session(gateway.retrieve_checkout_session(delivered), test_user['id'])[1]
+            
+            # Lost: paid, but its webhook never arrived
+            client.post('/api/cart/add', json={'product_id': test_cart['product_ids'][0], 'quantity': 1}, headers=auth_headers)
+            fake_stripe.complete_session(fake_stripe.create_session(metadata)['id'])
+            fake_stripe.create_session(metadata)  # Abandoned, still open
+            
+            assert reconcile_checkouts(hours=1, workers=2, dry_run=True)['missing'] == 1
+            with count_queries() as statements:
+                totals = reconcile_checkouts(hours=1, workers=2, page_size=1)
+            
+            assert totals == {'sessions': 2, 'paid': 2, 'missing': 1, 'created': 1, 'failed': 0}
+            assert len([s for s in statements if 'provider_payment_id IN' in s]) == 2
+            assert Order.query.filter_by(user_id=test_user['id']).count() == 2
+            assert reconcile_checkouts(hours=1, workers=2)['created'] == 0
+
+    
+    def test_reconcile_orders_what_was_paid_for(self, app, client, auth_headers, test_user, test_cart, fake_stripe, monkeypatch):
+        """Test an order reconciled after the cart and prices changed has the paid lines and leaves the new cart alone."""
+        from reconcile import reconcile_checkouts
+        from models import Order, Product
+        
+        monkeypatch.setenv('SKIP_EMAILS', '1')
+        first, second = test_cart['product_ids'][:2]
+        paid_cart = client.get('/api/cart', headers=auth_headers).get_json()
+        
+        session_id = client.post('/api/checkout/create-session', json={}, headers=auth_headers).get_json()['session_id']
+        fake_stripe.complete_session(session_id)
+        
+        # Before the webhook-less session is reconciled: a new cart, and a price change
+        client.delete('/api/cart/clear', headers=auth_headers)
+        client.post('/api/cart/add', json={'product_id': first, 'quantity': 3}, headers=auth_headers)
+        with app.app_context():
+            db.session.get(Product, second).price_cents += 1000
+            db.session.commit()
+            
+            totals = reconcile_checkouts(hours=1, workers=1)
+            assert totals['created'] == 1
+            assert totals['failed'] == 0
+            
+            order = Order.query.filter_by(user_id=test_user['id']).one()
+            assert {(item.product_id, item.quantity, item.unit_price_cents) for item in order.items} == {
+                (item['product_id'], item['quantity'], item['unit_price_cents']) for item in paid_cart['items']
+            }
+            assert order.subtotal_cents == paid_cart['subtotal_cents']
+        
+        cart = client.get('/api/cart', headers=auth_headers).get_json()
+        assert [(item['product_id'], item['quantity']) for item in cart['items']] == [(first, 3)]
+
+
 class TestOrdersAPI:
     """Integration tests for orders API endpoints."""
     
@@ -337,7 +1434,176 @@ class TestOrdersAPI:
         response = client.get('/api/orders/99999', headers=auth_headers)
         
         assert response.status_code == 404
-
+    
+    def test_order_history_is_keyset_paginated(self, app, client, auth_headers, test_user, test_products, count_queries):
+        """Test order pages read only orders, in a fixed number of queries, and cursors walk every order once."""
+        from datetime import datetime
+        from models import Order, OrderItem
+        from orders import backfill_order_summaries
+        
+        with app.app_context():
+            # Two orders share a timestamp, so the id has to break the tie
+            for index, day in enumerate([1, 2, 2, 3, 4, 5, 6]):
+                order = Order(user_id=test_user['id'], subtotal_cents=1000, total_cents=1000,
+                              placed_at=datetime(2025, 1, day, 12, 0))
+                db.session.add(order)
+                db.session.flush()
+                for product_id in test_products[index % 3:]:
+                    db.session.add(OrderItem(order_id=order.id, product_id=product_id, title_snapshot=f'Item {product_id}',
+                                             unit_price_cents=1000, quantity=1, line_total_cents=1000))
+            db.session.commit()
+            expected = [o.id for o in Order.query.order_by(Order.placed_at.desc(), Order.id.desc())]
+            
+            assert backfill_order_summaries(batch_size=3) == 7
+            assert backfill_order_summaries() == 0
+        
+        query_counts = []
+        seen = []
+        previews = set()
+        cursor = ''
+        while True:
+            with count_queries() as statements:
+                response = client.get(f'/api/orders?limit=3&cursor={cursor}', headers=auth_headers)
+            query_counts.append(len(statements))
+            assert not any('order_items' in s or 'product_images' in s for s in statements)
+            data = response.get_json()
+            seen.extend(order['id'] for order in data['orders'])
+            previews.update(order['preview_image'] for order in data['orders'])
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+        
+        assert seen == expected
+        assert len(set(query_counts)) == 1
+        
+        oldest = data['orders'][-1]
+        assert (oldest['item_count'], oldest['first_item_name']) == (len(test_products), f'Item {test_products[0]}')
+        assert oldest['preview_image'] == 'https://img.test/0-a.jpg'  # The primary image
+        assert previews == {f'https://img.test/{i}-a.jpg' for i in range(3)}
+        assert client.get('/api/orders?cursor=bogus', headers=auth_headers).status_code == 400
+    
+    def test_order_history_summarises_orders_placed_before_summaries(self, app, client, auth_headers, test_user, test_products):
+        """Test an order without a stored summary is listed with one computed from its items."""
+        from models import Order, OrderItem
+        
+        with app.app_context():
+            order = Order(user_id=test_user['id'], subtotal_cents=2000, total_cents=2000)
+            db.session.add(order)
+            db.session.flush()
+            for product_id in test_products[:2]:
+                db.session.add(OrderItem(order_id=order.id, product_id=product_id, title_snapshot=f'Item {product_id}',
+                                         unit_price_cents=1000, quantity=1, line_total_cents=1000))
+            db.session.commit()
+        
+        listed = client.get('/api/orders', headers=auth_headers).get_json()['orders']
+        
+        assert len(listed) == 1
+        assert (listed[0]['item_count'], listed[0]['first_item_name']) == (2, f'Item {test_products[0]}')
+        assert listed[0]['preview_image'] == 'https://img.test/0-a.jpg'
+        assert client.get('/api/orders?limit=0', headers=auth_headers).status_code == 400
+    
+    def test_order_export_streams_rows_in_date_range(self, app, client, auth_headers, admin_auth_headers, test_user, test_products):
+        """Test order exports stream one row per item, filtered by placed_at, as CSV or NDJSON."""
+        import csv
+        import io
+        from datetime import datetime
+        from models import Order, OrderItem
+        
+        with app.app_context():
+            for day in (1, 15, 31):
+                order = Order(user_id=test_user['id'], subtotal_cents=2000, total_cents=2000,
+                              placed_at=datetime(2025, 1, day, 12, 0))
+                db.session.add(order)
+                db.session.flush()
+                for product_id in test_products[:2]:
+                    db.session.add(OrderItem(order_id=order.id, product_id=product_id, title_snapshot='Item, "quoted"',
+                                             unit_price_cents=1000, quantity=1, line_total_cents=1000))
+            db.session.commit()
+        
+        response = client.get('/api/orders/export?from=2025-01-10&to=2025-01-31', headers=auth_headers)
+        assert response.status_code == 200
+        assert response.is_streamed
+        assert response.mimetype == 'text/csv'
+        rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+        assert len(rows) == 4  # The orders of the 15th and the 31st, two items each
+        assert rows[0]['placed_at'].startswith('2025-01-15') and rows[-1]['placed_at'].startswith('2025-01-31')
+        assert rows[0]['title'] == 'Item, "quoted"'
+        
+        response = client.get('/api/orders/admin/export?format=ndjson&to=2025-01-14', headers=admin_auth_headers)
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        assert [line['email'] for line in lines] == [test_user['email']] * 2
+        
+        assert client.get('/api/orders/admin/export', headers=auth_headers).status_code == 403
+        assert client.get('/api/orders/export?from=last-week', headers=auth_headers).status_code == 400
+        assert client.get('/api/orders/export?format=xml', headers=auth_headers).status_code == 400
+    
+    def test_cancel_order_is_a_status_change_with_background_follow_up(self, app, client, auth_headers, test_user, test_cart, fake_stripe, monkeypatch):
+        """Test cancelling keeps the order and queues the refund, restock and email for the workers."""
+        from types import SimpleNamespace
+        from checkout import create_order_from_session
+        from models import Order, Payment, Product
+        from webhook_inbox import drain
+        
+        monkeypatch.setenv('SKIP_EMAILS', '1')
+        session = SimpleNamespace(
+            id='cs_cancel', payment_intent='pi_cancel', shipping_cost=None, metadata={'user_id': test_user['id']}
+        )
+        with app.app_context():
+            order_id = create_order_from_session(session, test_user['id'])[0].id
+        
+        response = client.delete(f'/api/orders/{order_id}', headers=auth_headers)
+        
+        assert response.status_code == 200
+        assert response.get_json()['status'] == 'cancelled'
+        assert client.delete(f'/api/orders/{order_id}', headers=auth_headers).status_code == 409
+        assert client.get(f'/api/orders/{order_id}', headers=auth_headers).get_json()['status'] == 'cancelled'
+        
+        with app.app_context():
+            product_ids = test_cart['product_ids']
+            assert {p.stock for p in Product.query.filter(Product.id.in_(product_ids))} == {19}
+            assert fake_stripe.refunds == []
+            
+            assert drain() == (3, 0)
+            assert drain() == (0, 0)
+            
+            assert {p.stock for p in Product.query.filter(Product.id.in_(product_ids))} == {20}
+            assert [r['payment_intent'] for r in fake_stripe.refunds] == ['pi_cancel']
+            assert Payment.query.filter_by(provider_payment_id='pi_cancel').one().status == 'refunded'
+            assert db.session.get(Order, order_id).restocked_at is not None
+    
+    
+    def test_cancelled_oversold_order_restocks_only_what_it_took(self, app, db_session, client, auth_headers, test_user, test_cart, fake_stripe, monkeypatch):
+        """Test an order that took less stock than it sold puts back only what it took."""
+        from types import SimpleNamespace
+        from checkout import create_order_from_session
+        from models import CartItem, OrderItem, Product
+        from webhook_inbox import drain
+        
+        monkeypatch.setenv('SKIP_EMAILS', '1')
+        short, sold_out, *rest = test_cart['product_ids']
+        with app.app_context():
+            CartItem.query.filter_by(cart_id=test_cart['id'], product_id=short).one().quantity = 5
+            db_session.get(Product, short).stock = 2
+            db_session.get(Product, sold_out).stock = 0
+            db_session.commit()
+            
+            session = SimpleNamespace(
+                id='cs_oversold', payment_intent='pi_oversold', shipping_cost=None, metadata={'user_id': test_user['id']}
+            )
+            order_id = create_order_from_session(session, test_user['id'])[0].id
+            
+            taken = dict(db_session.query(OrderItem.product_id, OrderItem.stock_taken).filter_by(order_id=order_id))
+            assert (taken[short], taken[sold_out], taken[rest[0]]) == (2, 0, 1)
+            assert (db_session.get(Product, short).stock, db_session.get(Product, sold_out).stock) == (0, 0)
+        
+        assert client.delete(f'/api/orders/{order_id}', headers=auth_headers).status_code == 200
+        
+        with app.app_context():
+            assert drain() == (3, 0)
+            db_session.expire_all()
+            stocks = {p.id: p.stock for p in Product.query.filter(Product.id.in_(test_cart['product_ids']))}
+            assert (stocks[short], stocks[sold_out]) == (2, 0)
+            assert {stocks[product_id] for product_id in rest} == {20}
 
 class TestSearchAPI:
     """Integration tests for search functionality."""
@@ -13,6 +13,7 @@ import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from models import Product, Category, User
+from pricing import quote_cart, sale_price_cents, percent_of
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
@@ -213,6 +214,219 @@ class TestPriceCalculations:
         assert total_cents == 11800  # $118.00
 
 
+class TestPricingEngine:
+    """Unit tests for the central pricing engine."""
+    
+    def make_product(self, product_id, price_cents, sale_percent=None):
+        return Product(
+            id=product_id,
+            title=f'Product {product_id}',
+            slug=f'product-{product_id}',
+            price_cents=price_cents,
+            stock=10,
+            is_active=True,
+            sale_percent=sale_percent
+        )
+    
+    def test_sale_price_uses_integer_cents(self):
+        """Test sale prices truncate the discount in integer cents."""
+        assert sale_price_cents(9999, 25) == 7500
+        assert sale_price_cents(9999, None) == 9999
+    
+    def test_tax_rounds_half_up(self):
+        """Test percentages round half up to whole cents."""
+        assert percent_of(10000, 13) == 1300
+        assert percent_of(1050, 13) == 137  # 136.5 rounds up
+    
+    def test_quote_taxes_shipping_below_free_threshold(self):
+        """Test HST applies to subtotal plus standard shipping."""
+        quote = quote_cart([(self.make_product(1, 2000), 2)])
+        
+        assert quote.subtotal_cents == 4000
+        assert quote.shipping_cents == 999
+        assert quote.tax_cents == percent_of(4999, 13)
+        assert quote.total_cents == 4999 + quote.tax_cents
+    
+    def test_quote_free_shipping_and_sale_savings(self):
+        """Test free shipping from $100 and savings from sale prices."""
+        quote = quote_cart([
+            (self.make_product(1, 10000, sale_percent=20), 1),
+            (self.make_product(2, 5000), 1)
+        ])
+        
+        assert quote.subtotal_cents == 13000
+        assert quote.sale_savings_cents == 2000
+        assert quote.shipping_cents == 0
+        assert quote.total_items == 2
+    
+    def test_quote_with_explicit_shipping(self):
+        """Test checkout can override shipping with the rate picked on Stripe."""
+        quote = quote_cart([(self.make_product(1, 20000), 1)], shipping_cents=1499)
+        
+        assert quote.shipping_cents == 1499
+        assert quote.tax_cents == percent_of(21499, 13)
+    
+    def test_quote_applies_promo_per_unit(self):
+        """Test a promo discounts each unit and is taxed after the discount."""
+        quote = quote_cart([(self.make_product(1, 2999), 2)], discount_percent=10)
+        line = quote.line_for(1)
+        
+        assert line.unit_discount_cents == 300
+        assert line.charged_unit_price_cents == 2699
+        assert quote.discount_cents == 600
+        assert quote.tax_cents == percent_of(5998 - 600 + 999, 13)
+        assert quote.total_cents == 5998 - 600 + 999 + quote.tax_cents
+    
+    def test_quote_is_memoized_and_immutable(self):
+        """Test identical cart contents reuse the same frozen quote."""
+        first = quote_cart([(self.make_product(1, 2500), 3)])
+        second = quote_cart([(self.make_product(1, 2500), 3)])
+        
+        assert first is second
+        with pytest.raises(Exception):
+            first.total_cents = 0
+        
+        changed = quote_cart([(self.make_product(1, 2500), 4)])
+        assert changed is not first
+
+
+class TestCircuitBreaker:
+    """Unit tests for the Stripe gateway's circuit breaker."""
+    
+    def test_opens_after_consecutive_failures(self):
+        """Test the breaker opens at the threshold and a success resets the count."""
+        from stripe_gateway import CircuitBreaker
+        
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        assert breaker.allow()
+        
+        breaker.record_failure()
+        assert breaker.state == 'open'
+        assert not breaker.allow()
+    
+    def test_half_open_allows_one_trial(self):
+        """Test only one trial call goes out after the reset timeout."""
+        from stripe_gateway import CircuitBreaker
+        
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        
+        assert breaker.state == 'half_open'
+        assert breaker.allow()
+        assert not breaker.allow()
+        
+        breaker.record_success()
+        assert breaker.state == 'closed'
+    
+    def test_unexpected_error_releases_trial(self):
+        """Test a trial call failing with a non-Stripe error re-opens the breaker instead of wedging it."""
+        from stripe_gateway import CircuitBreaker, StripeGateway
+        
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        gateway = StripeGateway(breaker=breaker)
+        breaker.record_failure()
+        breaker.opened_at -= 60
+        
+        def broken(**kwargs):
+            raise ValueError('Unexpected reply')
+        
+        with pytest.raises(ValueError):
+            gateway.call('test.call', broken)
+        
+        assert not breaker.trial_running
+        assert breaker.state == 'open'
+        assert gateway.status()['operations']['test.call']['errors'] == 1
+        
+        breaker.opened_at -= 60
+        assert breaker.allow()
+
+    
+    def test_retried_call_counts_as_one_failure(self, monkeypatch):
+        """Test a call's retries add one breaker failure, and no retry starts past the call's time budget."""
+        import stripe
+        import stripe_gateway
+        from stripe_gateway import CircuitBreaker, StripeGateway
+        
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        gateway = StripeGateway(breaker=breaker, max_retries=2, backoff=0)
+        attempts = []
+        
+        def down(**kwargs):
+            attempts.append(kwargs)
+            raise stripe.error.APIConnectionError('Down')
+        
+        with pytest.raises(stripe.error.APIConnectionError):
+            gateway.call('test.call', down)
+        assert len(attempts) == 3
+        assert breaker.failures == 1
+        assert breaker.state == 'closed'
+        
+        # Each attempt takes 10 seconds of a 15 second budget: the second is the last
+        clock = [0.0]
+        monkeypatch.setattr(stripe_gateway.time, 'monotonic', lambda: clock[0])
+        gateway.call_timeout = 15
+        
+        def slow(**kwargs):
+            clock[0] += 10
+            down(**kwargs)
+        
+        attempts.clear()
+        with pytest.raises(stripe.error.APIConnectionError):
+            gateway.call('test.call', slow)
+        assert len(attempts) == 2
+        assert breaker.state == 'open'
+
+    
+    def test_gateway_built_once_under_concurrent_first_use(self, app, monkeypatch):
+        """Test threads racing to first use the gateway all get the same one."""
+        import threading
+        import time
+        import stripe_gateway
+        
+        built = []
+        
+        def slow_make(config):
+            time.sleep(0.05)
+            built.append(object())
+            return built[-1]
+        
+        monkeypatch.setattr(stripe_gateway, 'make_stripe_gateway', slow_make)
+        app.extensions.pop('stripe_gateway', None)
+        gateways = []
+        
+        def first_use():
+            with app.app_context():
+                gateways.append(stripe_gateway.get_stripe_gateway())
+        
+        threads = [threading.Thread(target=first_use) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        app.extensions.pop('stripe_gateway')
+        
+        assert len(built) == 1
+        assert gateways == built * 4
+
+class TestCartStoreInterface:
+    """Unit tests for the cart store interface."""
+    
+    def test_incomplete_store_fails_when_created(self):
+        """Test a store missing interface methods cannot be instantiated."""
+        from cart_store import CartStore, SqlCartStore
+        
+        class HalfStore(CartStore):
+            def version(self, user_id):
+                return 0
+        
+        with pytest.raises(TypeError):
+            HalfStore()
+        assert isinstance(SqlCartStore(), CartStore)
+
+
 class TestEmailValidation:
     """Unit tests for email validation logic."""
     
@@ -0,0 +1,271 @@
+"""
+Durable inbox for Stripe webhooks, and for background jobs the app queues
+itself (e.g. the refund, restock and email of a cancelled order).
+
+The webhook endpoint only verifies the signature, stores the raw event in
+webhook_events keyed by its Stripe id (so redelivered events are dropped)
+and answers 200. Worker threads then claim due events in small batches,
+run the handler registered for the event type and mark them done. A
+failing event is retried with jittered exponential backoff and parked as
+failed after MAX_ATTEMPTS. A claim is a lease: if a worker dies mid-event,
+the event becomes due again when the lease runs out.
+
+WEBHOOK_WORKERS threads run inside each serving web process, started by
+gunicorn.conf.py (or python app.py), never by create_app, so CLI commands
+importing the app run no workers. Set it to 0 and run
+`flask --app app webhooks work` to process events elsewhere.
+"""
+
+from flask import Blueprint, current_app
+from sqlalchemy import select, update, func
+from datetime import datetime, timedelta, timezone
+from extensions import db
+from models import WebhookEvent
+from dbutils import dialect_insert
+import threading
+import random
+import click
+import time
+import os
+
+
+webhooks_bp = Blueprint('webhooks', __name__, cli_group='webhooks')
+
+MAX_ATTEMPTS = 8
+BACKOFF_SECONDS = 10
+MAX_BACKOFF_SECONDS = 3600
+LEASE_SECONDS = 300
+
+# event type -> handler(event dict); registered with @webhook_handler
+handlers = {}
+
+
+def webhook_handler(event_type):
+    """Register the function that processes one type of event"""
+    def register(fn):
+        handlers[event_type] = fn
+        return fn
+    return register
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+def enqueue_event(event):
+    """
+    Add an event to the inbox in the caller's transaction unless it is
+    already there. Returns True if it was new.
+    """
+    stmt = dialect_insert(WebhookEvent).values(
+        event_id=event['id'],
+        type=event['type'],
+        payload=event,
+        status='pending',
+        attempts=0,
+        next_attempt_at=utcnow()
+    ).on_conflict_do_nothing(index_elements=['event_id'])
+    return db.session.execute(stmt).rowcount == 1
+
+
+def store_event(event):
+    """Insert an event into the inbox unless it is already there, and commit. Returns True if it was new."""
+    stored = enqueue_event(event)
+    db.session.commit()
+    return stored
+
+
+def retry_delay(attempts):
+    """Seconds before the next attempt: exponential, capped, with jitter"""
+    delay = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def claim_events(batch_size=10, lease_seconds=LEASE_SECONDS):
+    """
+    Lease up to batch_size due events to this worker and return their ids.
+    Rows locked by another worker's claim are skipped (SKIP LOCKED).
+    """
+    now = utcnow()
+    event_ids = db.session.execute(
+        select(WebhookEvent.event_id).where(
+            WebhookEvent.status.in_(('pending', 'processing')),
+            WebhookEvent.next_attempt_at <= now
+        ).order_by(WebhookEvent.next_attempt_at).limit(batch_size).with_for_update(skip_locked=True)
+    ).scalars().all()
+    
+    if event_ids:
+        db.session.execute(update(WebhookEvent).where(WebhookEvent.event_id.in_(event_ids)).values(
+            status='processing',
+            next_attempt_at=now + timedelta(seconds=lease_seconds)
+        ))
+    db.session.commit()
+    return event_ids
+
+
+def process_event(event_id):
+    """Run the handler for one claimed event and record the outcome. Returns True on success."""
+    event = db.session.get(WebhookEvent, event_id)
+    handler = handlers.get(event.type)
+    
+    try:
+        if handler:
+            handler(event.payload)
+    except Exception as e:
+        db.session.rollback()
+        event = db.session.get(WebhookEvent, event_id)
+        event.attempts += 1
+        event.last_error = f'{type(e).__name__}: {e}'[:2000]
+        if event.attempts >= MAX_ATTEMPTS:
+            event.status = 'failed'
+        else:
+            event.status = 'pending'
+            event.next_attempt_at = utcnow() + timedelta(seconds=retry_delay(event.attempts))
+        db.session.commit()
+        print(f"Webhook event {event_id} failed (attempt {event.attempts}): {event.last_error}")
+        return False
+    
+    event.attempts += 1
+    event.status = 'done'
+    event.processed_at = utcnow()
+    event.last_error = None
+    db.session.commit()
+    return True
+
+
+def drain(batch_size=10):
+    """Process due events until none are left. Returns (processed, failed)."""
+    processed = failed = 0
+    while True:
+        event_ids = claim_events(batch_size)
+        if not event_ids:
+            return processed, failed
+        for event_id in event_ids:
+            if process_event(event_id):
+                processed += 1
+            else:
+                failed += 1
+
+
+def inbox_stats():
+    """Queue depth by status and the age of the oldest event waiting to be processed"""
+    counts = dict(db.session.query(WebhookEvent.status, func.count()).group_by(WebhookEvent.status).all())
+    oldest = db.session.query(func.min(WebhookEvent.received_at)).filter(
+        WebhookEvent.status.in_(('pending', 'processing'))
+    ).scalar()
+    
+    if oldest is not None and oldest.tzinfo is None:
+        oldest = oldest.replace(tzinfo=timezone.utc)
+    
+    return {
+        'pending': counts.get('pending', 0),
+        'processing': counts.get('processing', 0),
+        'failed': counts.get('failed', 0),
+        'done': counts.get('done', 0),
+        'oldest_waiting_seconds': round((utcnow() - oldest).total_seconds(), 1) if oldest else 0
+    }
+
+
+class WebhookWorkerPool:
+    """Threads that drain the inbox, each polling every poll_interval seconds while idle"""
+    
+    def __init__(self, app, workers=2, batch_size=10, poll_interval=2.0):
+        self.app = app
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._stopping = threading.Event()
+        self._wake = threading.Event()
+        self._threads = []
+    
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'webhook-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+    
+    def wake(self):
+        """Ask idle workers to look for new events now instead of at their next poll"""
+        self._wake.set()
+    
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+    
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                with self.app.app_context():
+                    processed, failed = drain(self.batch_size)
+            except Exception as e:
+                print(f"Webhook worker error: {str(e)}")
+                processed = failed = 0
+            
+            if not processed and not failed:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+
+def start_webhook_workers(app, workers=None):
+    """
+    Start the app's in-process webhook workers, WEBHOOK_WORKERS of them by
+    default. Only call this from a process that serves requests.
+    """
+    if workers is None:
+        workers = int(os.getenv('WEBHOOK_WORKERS', 1))
+    if workers <= 0:
+        return None
+    pool = app.extensions['webhook_workers'] = WebhookWorkerPool(app, workers).start()
+    return pool
+
+
+def wake_webhook_workers():
+    """Nudge this process's webhook workers, if it runs any"""
+    pool = current_app.extensions.get('webhook_workers')
+    if pool:
+        pool.wake()
+
+
+@webhooks_bp.cli.command('work')
+@click.option('--workers', default=int(os.getenv('WEBHOOK_WORKERS') or 2), show_default=True, help='Worker threads.')
+@click.option('--batch-size', default=10, show_default=True, help='Events claimed per worker at a time.')
+@click.option('--poll-interval', default=2.0, show_default=True, help='Seconds between polls while idle.')
+def work_command(workers, batch_size, poll_interval):
+    """Process webhook events until interrupted."""
+    pool = WebhookWorkerPool(current_app._get_current_object(), workers, batch_size, poll_interval).start()
+    click.echo(f'Processing webhook events with {workers} workers (Ctrl+C to stop)')
+    try:
+        while True:
+            time.sleep(60)
+            click.echo(f'Inbox: {inbox_stats()}')
+    except KeyboardInterrupt:
+        pool.stop()
+
+
+@webhooks_bp.cli.command('drain')
+@click.option('--batch-size', default=10, show_default=True, help='Events claimed at a time.')
+def drain_command(batch_size):
+    """Process every due webhook event once and exit."""
+    processed, failed = drain(batch_size)
+    click.echo(f'Processed {processed} events, {failed} failed')
+
+
+@webhooks_bp.cli.command('stats')
+def stats_command():
+    """Show webhook inbox queue depth."""
+    for name, value in inbox_stats().items():
+        click.echo(f'{name}: {value}')
+
+
+@webhooks_bp.cli.command('retry-failed')
+def retry_failed_command():
+    """Queue events that used up their attempts for another round."""
+    retried = db.session.execute(update(WebhookEvent).where(WebhookEvent.status == 'failed').values(
+        status='pending', attempts=0, next_attempt_at=utcnow()
+    )).rowcount
+    db.session.commit()
+    click.echo(f'Requeued {retried} events')
@@ -1,10 +1,23 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, make_response
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from sqlalchemy import select, delete, exists, literal
+from sqlalchemy.exc import SQLAlchemyError
+from array import array
+from bisect import bisect_left
 from extensions import db
 from models import Wishlist, WishlistItem, Product
+from dbutils import dialect_insert, supports_writable_ctes
+from cache import TTLCache
+from cart_store import get_cart_store, load_products, CartStoreError
+import zlib
+import os
 
 wishlist_bp = Blueprint('wishlist', __name__, url_prefix='/api/wishlist')
 
+# Sorted product ids per user, kept current by this process's writes; the
+# TTL bounds how long a write made by another worker can go unseen
+wishlist_ids = TTLCache(maxsize=50000, ttl=int(os.getenv('WISHLIST_IDS_TTL', 30)))
+
 
 def get_or_create_wishlist(user_id):
     """Get user's wishlist or create one if it doesn't exist"""
@@ -16,6 +29,130 @@ def get_or_create_wishlist(user_id):
     return wishlist
 
 
+def upsert_wishlist(user_id):
+    """
+    INSERT of the user's wishlist that returns its id whether the row was
+    just created or already existed (the conflict branch is a no-op update).
+    """
+    stmt = dialect_insert(Wishlist).values(user_id=user_id)
+    return stmt.on_conflict_do_update(
+        index_elements=['user_id'],
+        set_={'user_id': stmt.excluded.user_id}
+    ).returning(Wishlist.id)
+
+
+def wishlist_id_source(user_id):
+    """
+    Where a write gets the user's wishlist id from. On PostgreSQL it is a
+    writable CTE, so the wishlist upsert rides along in the same statement;
+    on SQLite the upsert runs first. Returns (id expression, cte or None).
+    """
+    if supports_writable_ctes():
+        wishlist = upsert_wishlist(user_id).cte('upserted_wishlist')
+        return select(wishlist.c.id).scalar_subquery(), wishlist
+    return literal(db.session.execute(upsert_wishlist(user_id)).scalar()), None
+
+
+def insert_wishlist_item(wishlist_id, product_id, unless=None):
+    """INSERT of an active product into the wishlist that skips duplicates, returning the new id"""
+    source = select(wishlist_id, Product.id).where(Product.id == product_id, Product.is_active == True)
+    if unless is not None:
+        source = source.where(~exists(unless))
+    stmt = dialect_insert(WishlistItem).from_select(['wishlist_id', 'product_id'], source)
+    return stmt.on_conflict_do_nothing(index_elements=['wishlist_id', 'product_id']).returning(WishlistItem.id)
+
+
+def add_wishlist_item(user_id, product_id):
+    """
+    Add a product to the user's wishlist, creating the wishlist if needed,
+    in a single statement on PostgreSQL. Returns the new item id, or None if
+    the product was already wishlisted or is not an active product.
+    """
+    wishlist_id, wishlist = wishlist_id_source(user_id)
+    stmt = insert_wishlist_item(wishlist_id, product_id)
+    if wishlist is not None:
+        stmt = stmt.add_cte(wishlist)
+    return db.session.execute(stmt).scalar()
+
+
+def toggle_wishlist_item(user_id, product_id):
+    """
+    Remove a product from the user's wishlist if present, otherwise add it.
+    On PostgreSQL the wishlist upsert, the delete and the conditional insert
+    are chained as CTEs in one statement; SQLite runs them in sequence.
+    Returns (removed_id, added_id); both are None for an unknown product.
+    """
+    wishlist_id, wishlist = wishlist_id_source(user_id)
+    remove = delete(WishlistItem).where(
+        WishlistItem.wishlist_id == wishlist_id,
+        WishlistItem.product_id == product_id
+    ).returning(WishlistItem.id)
+    
+    if wishlist is None:
+        removed_id = db.session.execute(remove).scalar()
+        if removed_id is not None:
+            return removed_id, None
+        return None, db.session.execute(insert_wishlist_item(wishlist_id, product_id)).scalar()
+    
+    removed = remove.cte('removed_item')
+    added = insert_wishlist_item(wishlist_id, product_id, unless=select(removed.c.id)).cte('added_item')
+    row = db.session.execute(select(
+        select(removed.c.id).scalar_subquery(),
+        select(added.c.id).scalar_subquery()
+    )).one()
+    return row[0], row[1]
+
+
+def wishlisted_product_ids(user_id):
+    """
+    Sorted array of the product ids in the user's wishlist.
+    Served from the per-user cache, otherwise one SELECT that never writes
+    (a user without a wishlist simply has no ids).
+    """
+    ids = wishlist_ids.get(user_id)
+    if ids is None:
+        ids = array('q', db.session.execute(
+            select(WishlistItem.product_id)
+            .join(Wishlist, Wishlist.id == WishlistItem.wishlist_id)
+            .where(Wishlist.user_id == user_id)
+            .order_by(WishlistItem.product_id)
+        ).scalars())
+        wishlist_ids.set(user_id, ids)
+    return ids
+
+
+def update_cached_ids(user_id, product_id, in_wishlist):
+    """Apply a committed add or remove to the user's cached id set, if cached"""
+    ids = wishlist_ids.get(user_id)
+    if ids is None:
+        return
+    
+    product_id = int(product_id)
+    if contains_id(ids, product_id) == in_wishlist:
+        return
+    
+    index = bisect_left(ids, product_id)
+    
+    # Copy on write: other requests may be reading the cached array
+    updated = array('q', ids)
+    if in_wishlist:
+        updated.insert(index, product_id)
+    else:
+        del updated[index]
+    wishlist_ids.set(user_id, updated)
+
+
+def contains_id(ids, product_id):
+    """Membership test on a sorted id array"""
+    index = bisect_left(ids, product_id)
+    return index < len(ids) and ids[index] == product_id
+
+
+def wishlist_etag(ids):
+    """ETag for a wishlist id set, derived from its contents"""
+    return f'{len(ids)}-{zlib.crc32(ids.tobytes()):08x}'
+
+
 def product_to_dict(product):
     """Convert product to dictionary with sale info"""
     primary_image = next((img for img in product.images if img.is_primary), None)
@@ -81,15 +218,24 @@ def get_wishlist():
 @wishlist_bp.route('/ids', methods=['GET'])
 @jwt_required()
 def get_wishlist_product_ids():
-    """Get just the product IDs in user's wishlist (for checking if items are wishlisted)"""
+    """
+    Get just the product IDs in user's wishlist (for checking if items are wishlisted).
+    Read-only and cached per user; a matching If-None-Match gets a 304.
+    """
     user_id = get_jwt_identity()
-    wishlist = get_or_create_wishlist(user_id)
+    ids = wishlisted_product_ids(user_id)
+    etag = wishlist_etag(ids)
     
-    product_ids = [item.product_id for item in wishlist.items]
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
     
-    return jsonify({
-        'product_ids': product_ids
-    }), 200
+    response = jsonify({
+        'product_ids': ids.tolist()
+    })
+    response.set_etag(etag)
+    return response, 200
 
 
 @wishlist_bp.route('/add', methods=['POST'])
@@ -103,37 +249,28 @@ def add_to_wishlist():
     if not product_id:
         return jsonify({'error': 'Product ID is required'}), 400
     
-    # Check if product exists and is active
-    product = Product.query.filter_by(id=product_id, is_active=True).first()
-    if not product:
-        return jsonify({'error': 'Product not found'}), 404
+    item_id = add_wishlist_item(user_id, product_id)
     
-    wishlist = get_or_create_wishlist(user_id)
-    
-    # Check if already in wishlist
-    existing = WishlistItem.query.filter_by(
-        wishlist_id=wishlist.id,
-        product_id=product_id
-    ).first()
-    
-    if existing:
+    if item_id is None:
+        # Nothing inserted: the product is already wishlisted or does not exist
+        if not Product.query.filter_by(id=product_id, is_active=True).first():
+            db.session.rollback()
+            return jsonify({'error': 'Product not found'}), 404
+        
+        db.session.commit()
+        update_cached_ids(user_id, product_id, True)
         return jsonify({
             'message': 'Product already in wishlist',
             'product_id': product_id
         }), 200
     
-    # Add to wishlist
-    item = WishlistItem(
-        wishlist_id=wishlist.id,
-        product_id=product_id
-    )
-    db.session.add(item)
     db.session.commit()
+    update_cached_ids(user_id, product_id, True)
     
     return jsonify({
         'message': 'Added to wishlist',
         'product_id': product_id,
-        'item_id': item.id
+        'item_id': item_id
     }), 201
 
 
@@ -162,6 +299,7 @@ def remove_from_wishlist():
     
     db.session.delete(item)
     db.session.commit()
+    update_cached_ids(user_id, product_id, False)
     
     return jsonify({
         'message': 'Removed from wishlist',
@@ -180,23 +318,16 @@ def toggle_wishlist():
     if not product_id:
         return jsonify({'error': 'Product ID is required'}), 400
     
-    # Check if product exists and is active
-    product = Product.query.filter_by(id=product_id, is_active=True).first()
-    if not product:
-        return jsonify({'error': 'Product not found'}), 404
+    removed_id, added_id = toggle_wishlist_item(user_id, product_id)
     
-    wishlist = get_or_create_wishlist(user_id)
+    if removed_id is None and added_id is None:
+        db.session.rollback()
+        return jsonify({'error': 'Product not found'}), 404
     
-    # Check if in wishlist
-    existing = WishlistItem.query.filter_by(
-        wishlist_id=wishlist.id,
-        product_id=product_id
-    ).first()
+    db.session.commit()
+    update_cached_ids(user_id, product_id, added_id is not None)
     
-    if existing:
-        # Remove from wishlist
-        db.session.delete(existing)
-        db.session.commit()
+    if removed_id is not None:
         return jsonify({
             'message': 'Removed from wishlist',
             'product_id': product_id,
@@ -204,35 +335,132 @@ def toggle_wishlist():
             'in_wishlist': False
         }), 200
     else:
-        # Add to wishlist
-        item = WishlistItem(
-            wishlist_id=wishlist.id,
-            product_id=product_id
-        )
-        db.session.add(item)
-        db.session.commit()
         return jsonify({
             'message': 'Added to wishlist',
             'product_id': product_id,
-            'item_id': item.id,
+            'item_id': added_id,
             'action': 'added',
             'in_wishlist': True
         }), 200
 
 
+MAX_CHECK_IDS = 200
+
+
+@wishlist_bp.route('/check', methods=['GET'])
+@jwt_required()
+def check_many_in_wishlist():
+    """
+    Check which of many products are in the wishlist (for listing pages).
+    Takes ids=1,2,3 (or repeated ids params) and answers from the cached id
+    set, so a whole grid costs at most one query.
+    """
+    user_id = get_jwt_identity()
+    
+    raw_ids = [part for value in request.args.getlist('ids') for part in value.split(',') if part.strip()]
+    if not raw_ids:
+        return jsonify({'error': 'ids is required'}), 400
+    
+    if len(raw_ids) > MAX_CHECK_IDS:
+        return jsonify({'error': f'At most {MAX_CHECK_IDS} ids per request'}), 400
+    
+    try:
+        product_ids = [int(part) for part in raw_ids]
+    except ValueError:
+        return jsonify({'error': 'ids must be integers'}), 400
+    
+    wishlisted = wishlisted_product_ids(user_id)
+    in_wishlist = {str(product_id): contains_id(wishlisted, product_id) for product_id in product_ids}
+    
+    return jsonify({
+        'in_wishlist': in_wishlist,
+        'product_ids': [product_id for product_id in product_ids if in_wishlist[str(product_id)]]
+    }), 200
+
+
 @wishlist_bp.route('/check/<int:product_id>', methods=['GET'])
 @jwt_required()
 def check_in_wishlist(product_id):
     """Check if a specific product is in wishlist"""
     user_id = get_jwt_identity()
     
-    wishlist = Wishlist.query.filter_by(user_id=user_id).first()
-    if not wishlist:
-        return jsonify({'in_wishlist': False}), 200
+    return jsonify({'in_wishlist': contains_id(wishlisted_product_ids(user_id), product_id)}), 200
+
+
+MAX_MOVE_IDS = 200
+
+
+@wishlist_bp.route('/move-to-cart', methods=['POST'])
+@jwt_required()
+def move_to_cart():
+    """
+    Move wishlisted products into the cart, one of each.
+    Takes product_ids as a list or "all". Stock for every product is checked
+    in one query, the cart rows are upserted in one statement and the
+    wishlist rows removed with one DELETE, all committed together. Products
+    that are out of stock or no longer sold stay in the wishlist. Products
+    the cart already holds all the stock of leave the wishlist but are
+    reported as capped, with the quantity that was actually moved.
+    """
+    user_id = get_jwt_identity()
+    data = request.get_json() or {}
     
-    exists = WishlistItem.query.filter_by(
-        wishlist_id=wishlist.id,
-        product_id=product_id
-    ).first() is not None
+    requested = data.get('product_ids')
+    if requested != 'all':
+        if not isinstance(requested, list) or not requested:
+            return jsonify({'error': 'product_ids must be a list of product IDs or "all"'}), 400
+        if len(requested) > MAX_MOVE_IDS:
+            return jsonify({'error': f'At most {MAX_MOVE_IDS} products per request'}), 400
+        if not all(isinstance(product_id, int) for product_id in requested):
+            return jsonify({'error': 'product_ids must be integers'}), 400
+    
+    wishlist_id = db.session.query(Wishlist.id).filter_by(user_id=user_id).scalar()
+    if wishlist_id is None:
+        return jsonify({'error': 'Wishlist not found'}), 404
+    
+    query = db.session.query(WishlistItem.product_id).filter(WishlistItem.wishlist_id == wishlist_id)
+    if requested != 'all':
+        query = query.filter(WishlistItem.product_id.in_(requested))
+    wishlisted = [product_id for (product_id,) in query.all()]
+    
+    products = load_products(wishlisted)
+    in_stock = {product_id: product for product_id, product in products.items() if product.stock > 0}
     
-    return jsonify({'in_wishlist': exists}), 200
+    failed = []
+    for product_id in (wishlisted if requested == 'all' else requested):
+        if product_id not in wishlisted:
+            failed.append({'product_id': product_id, 'error': 'Product not in wishlist'})
+        elif product_id not in products:
+            failed.append({'product_id': product_id, 'error': 'Product not found'})
+        elif product_id not in in_stock:
+            failed.append({'product_id': product_id, 'error': 'Out of stock'})
+    
+    requested_quantities = {product_id: 1 for product_id in in_stock}
+    added = {}
+    if in_stock:
+        try:
+            db.session.execute(delete(WishlistItem).where(
+                WishlistItem.wishlist_id == wishlist_id,
+                WishlistItem.product_id.in_(in_stock)
+            ))
+            added = get_cart_store().merge(user_id, in_stock, requested_quantities)  # Commits the delete too
+        except CartStoreError as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), e.status
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            print(f"Error moving wishlist items to cart: {str(e)}")
+            return jsonify({'error': 'Failed to move items to cart'}), 500
+        
+        wishlist_ids.pop(user_id)  # Reloaded on next read
+    
+    moved = sorted(product_id for product_id, quantity in added.items() if quantity)
+    return jsonify({
+        'message': f'Moved {len(moved)} items to cart',
+        'moved': moved,
+        'capped': [
+            {'product_id': product_id, 'requested': requested_quantities[product_id], 'moved': added[product_id]}
+            for product_id in sorted(added) if added[product_id] < requested_quantities[product_id]
+        ],
+        'failed': failed
+    }), 200
@@ -0,0 +1,242 @@
+"""
+flask --app app wishlist-alerts run: Email wishlist price-drop and back-in-stock digests
+
+Each run copies every active product's effective price and stock into
+product_watch_states' pending columns with one INSERT ... SELECT (the run's
+snapshot), queues notifications with INSERT ... SELECT statements joining
+those states against wishlist_items in wishlist item id ranges, then makes
+the pending values the ones the next run compares with. A change landing
+mid-run is therefore picked up next time. Then it emails one digest per
+user; notifications whose email failed stay pending for the next run, and
+sent ones are deleted after a retention period. Nothing per product or
+wishlist row is loaded into Python; only the users being emailed in the
+current batch are. The first run only records a baseline.
+"""
+
+from flask import Blueprint
+from flask_mail import Message
+from sqlalchemy import select, update, func, case, or_
+from sqlalchemy.orm import joinedload
+from itertools import groupby
+from datetime import datetime, timedelta, timezone
+from extensions import db, mail
+from models import Product, Category, User, Wishlist, WishlistItem, ProductWatchState, WishlistNotification
+from dbutils import dialect_insert, delete_in_batches
+import click
+import time
+import os
+
+
+wishlist_alerts_bp = Blueprint('wishlist_alerts', __name__, cli_group='wishlist-alerts')
+
+
+def current_prices():
+    """SELECT of (product_id, effective price, stock) for active products, mirroring Product.sale_price_cents"""
+    sale_percent = func.coalesce(func.nullif(Product.sale_percent, 0), Category.sale_percent, 0)
+    return select(
+        Product.id.label('product_id'),
+        (Product.price_cents - Product.price_cents * sale_percent // 100).label('price_cents'),
+        Product.stock.label('stock')
+    ).select_from(Product).outerjoin(Category, Category.id == Product.category_id).where(Product.is_active == True)
+
+
+def stage_product_state():
+    """
+    Take the run's snapshot: store every active product's price and stock as
+    its pending state, in one INSERT ... SELECT. A product seen for the first
+    time gets them as its baseline instead, so it is not reported.
+    """
+    stmt = dialect_insert(ProductWatchState).from_select(['product_id', 'price_cents', 'stock'], current_prices())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['product_id'],
+        set_={'pending_price_cents': stmt.excluded.price_cents, 'pending_stock': stmt.excluded.stock}
+    )
+    db.session.execute(stmt)
+    db.session.commit()
+
+
+def queue_notifications(chunk_size=10000):
+    """
+    Queue a pending notification for every wishlist entry of a product whose
+    pending state is in stock and either cheaper than its recorded price or
+    was out of stock. Works through wishlist_items in id ranges of
+    chunk_size, one INSERT ... SELECT and commit per range.
+    Returns the number of notifications queued.
+    """
+    low, high = db.session.query(func.min(WishlistItem.id), func.max(WishlistItem.id)).one()
+    if low is None:
+        return 0
+    
+    state = ProductWatchState
+    back_in_stock = state.stock <= 0
+    kind = case((back_in_stock, 'back_in_stock'), else_='price_drop')
+    
+    queued = 0
+    for start in range(low, high + 1, chunk_size):
+        rows = select(
+            Wishlist.user_id, WishlistItem.product_id, kind, state.price_cents, state.pending_price_cents
+        ).select_from(WishlistItem).join(
+            Wishlist, Wishlist.id == WishlistItem.wishlist_id
+        ).join(
+            state, state.product_id == WishlistItem.product_id
+        ).where(
+            state.pending_stock > 0,
+            or_(back_in_stock, state.pending_price_cents < state.price_cents),
+            WishlistItem.id >= start,
+            WishlistItem.id < start + chunk_size
+        )
+        
+        stmt = dialect_insert(WishlistNotification).from_select(
+            ['user_id', 'product_id', 'kind', 'old_price_cents', 'new_price_cents'], rows
+        ).on_conflict_do_nothing(
+            index_elements=['user_id', 'product_id', 'kind'],
+            index_where=WishlistNotification.sent_at.is_(None)
+        )
+        queued += db.session.execute(stmt).rowcount
+        db.session.commit()
+    
+    return queued
+
+
+def record_product_state():
+    """Make the pending prices and stock the ones the next run compares with"""
+    db.session.execute(
+        update(ProductWatchState).where(ProductWatchState.pending_stock.is_not(None)).values(
+            price_cents=ProductWatchState.pending_price_cents,
+            stock=ProductWatchState.pending_stock,
+            pending_price_cents=None,
+            pending_stock=None,
+            observed_at=func.now()
+        ).execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+def purge_sent_notifications(keep_days=30, batch_size=1000):
+    """Delete notifications sent more than keep_days ago. Returns (rows, seconds)."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=keep_days)
+    return delete_in_batches(WishlistNotification, WishlistNotification.sent_at < cutoff, batch_size=batch_size)
+
+
+def send_digests(batch_size=500):
+    """
+    Email each user with pending notifications a single digest and mark them sent.
+    Users are walked in id order batch_size at a time. A digest that fails to
+    send leaves its notifications pending for the next run. Returns digests sent.
+    """
+    sent = 0
+    last_user_id = None
+    
+    while True:
+        query = select(WishlistNotification.user_id).where(
+            WishlistNotification.sent_at.is_(None)
+        ).distinct().order_by(WishlistNotification.user_id).limit(batch_size)
+        if last_user_id is not None:
+            query = query.where(WishlistNotification.user_id > last_user_id)
+        
+        user_ids = db.session.execute(query).scalars().all()
+        if not user_ids:
+            break
+        
+        users = {user.id: user for user in User.query.filter(User.id.in_(user_ids)).all()}
+        pending = WishlistNotification.query.options(joinedload(WishlistNotification.product)).filter(
+            WishlistNotification.user_id.in_(user_ids),
+            WishlistNotification.sent_at.is_(None)
+        ).order_by(WishlistNotification.user_id, WishlistNotification.id).all()
+        
+        done = []
+        for user_id, notifications in groupby(pending, key=lambda n: n.user_id):
+            notifications = list(notifications)
+            user = users.get(user_id)
+            if user and user.is_active:
+                if not send_wishlist_digest_email(user, notifications):
+                    continue
+                sent += 1
+            done += [n.id for n in notifications]  # Sent, or nobody to send them to
+        
+        if done:
+            WishlistNotification.query.filter(
+                WishlistNotification.id.in_(done)
+            ).update({'sent_at': datetime.now(timezone.utc)}, synchronize_session=False)
+        db.session.commit()
+        last_user_id = user_ids[-1]
+    
+    return sent
+
+
+def send_wishlist_digest_email(user, notifications):
+    """
+    Send one wishlist digest email (skipped in production due to SMTP restrictions).
+    Returns False if sending failed.
+    """
+    # Skip email in production (Railway blocks SMTP)
+    if os.getenv('RAILWAY_ENVIRONMENT') or os.getenv('SKIP_EMAILS'):
+        print(f"[PROD] Skipping wishlist digest ({len(notifications)} updates) to {user.email}")
+        return True
+    
+    try:
+        frontend_url = os.getenv('FRONTEND_URL', 'http://localhost:3000')
+        
+        # Build product rows HTML
+        items_html = ""
+        for notification in notifications:
+            product = notification.product
+            if notification.kind == 'back_in_stock':
+                detail = f"Back in stock at ${notification.new_price_cents / 100:.2f}"
+            else:
+                detail = f"Now ${notification.new_price_cents / 100:.2f} (was ${notification.old_price_cents / 100:.2f})"
+            items_html += f"""
+            <tr>
+                <td style="padding: 12px; border-bottom: 1px solid #e5e7eb;">
+                    <a href="{frontend_url}/product/{product.id}" style="color: #2563eb;">{product.title}</a>
+                </td>
+                <td style="padding: 12px; border-bottom: 1px solid #e5e7eb; text-align: right;">{detail}</td>
+            </tr>
+            """
+        
+        msg = Message(
+            subject='Good news about your MDSRTech wishlist',
+            recipients=[user.email],
+            html=f'''
+            <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
+                <h1 style="color: #2563eb; text-align: center;">MDSRTech</h1>
+                <h2 style="color: #1f2937;">Items on your wishlist changed</h2>
+                
+                <p style="color: #4b5563; font-size: 16px;">
+                    Hi {user.full_name},
+                </p>
+                
+                <table style="width: 100%; border-collapse: collapse; margin: 20px 0;">
+                    <tbody>
+                        {items_html}
+                    </tbody>
+                </table>
+                
+                <hr style="border: none; border-top: 1px solid #e5e7eb; margin: 30px 0;" />
+                <p style="color: #9ca3af; font-size: 12px; text-align: center;">
+                    © 2025 MDSRTech. All rights reserved.
+                </p>
+            </div>
+            '''
+        )
+        mail.send(msg)
+        return True
+    except Exception as e:
+        print(f"Failed to send wishlist digest email: {str(e)}")
+        return False
+
+
+@wishlist_alerts_bp.cli.command('run')
+@click.option('--chunk-size', default=10000, show_default=True, help='Wishlist item ids per INSERT ... SELECT.')
+@click.option('--batch-size', default=500, show_default=True, help='Users emailed per batch.')
+@click.option('--keep-days', default=30, show_default=True, help='Delete notifications sent this many days ago.')
+def run_wishlist_alerts_command(chunk_size, batch_size, keep_days):
+    """Queue and email wishlist price-drop and back-in-stock digests."""
+    started = time.monotonic()
+    stage_product_state()
+    queued = queue_notifications(chunk_size)
+    record_product_state()
+    sent = send_digests(batch_size)
+    purged, _ = purge_sent_notifications(keep_days)
+    click.echo(f'Queued {queued} notifications, sent {sent} digests, '
+               f'purged {purged} old notifications in {time.monotonic() - started:.2f}s')
@@ -48,6 +48,9 @@ interface CartData {
   subtotal_cents: number;
   original_subtotal_cents: number;
   sale_savings_cents: number;
+  promo_code: string | null;
+  discount_percent: number;
+  discount_cents: number;
   tax_cents: number;
   tax_rate: number;
   shipping_cents: number;
@@ -83,6 +86,10 @@ export default function CartPage() {
       if (response.ok) {
         const data = await response.json();
         setCart(data);
+        setAppliedPromo(data.promo_code ? {
+          code: data.promo_code,
+          discount_percent: data.discount_percent,
+        } : null);
       }
     } catch (error) {
       console.error('Failed to fetch cart:', error);
@@ -268,6 +275,7 @@ export default function CartPage() {
           discount_percent: data.discount_percent,
         });
         showToast(`${data.discount_percent}% discount applied!`, 'success');
+        await fetchCart();
       } else {
         showToast(data.error || 'Invalid promo code', 'error');
       }
@@ -278,10 +286,28 @@ export default function CartPage() {
     }
   };
 
-  const handleRemovePromo = () => {
-    setAppliedPromo(null);
-    setPromoCode('');
-    showToast('Promo code removed', 'success');
+  const handleRemovePromo = async () => {
+    try {
+      const token = localStorage.getItem('access_token');
+      const response = await fetch(`${API_URL}/cart/promo`, {
+        method: 'DELETE',
+        headers: {
+          'Authorization': `Bearer ${token}`,
+        },
+      });
+
+      if (response.ok) {
+        setAppliedPromo(null);
+        setPromoCode('');
+        showToast('Promo code removed', 'success');
+        await fetchCart();
+      } else {
+        const data = await response.json();
+        showToast(data.error || 'Failed to remove promo code', 'error');
+      }
+    } catch {
+      showToast('Failed to remove promo code', 'error');
+    }
   };
 
   const handleCheckout = async () => {
@@ -601,18 +627,13 @@ export default function CartPage() {
 
                 {/* Price Breakdown */}
                 {(() => {
+                  // Totals are priced on the server, including the applied promo
                   const subtotal = cart.subtotal_cents / 100;
                   const saleSavings = cart.sale_savings_cents / 100;
-                  let promoDiscount = 0;
+                  const promoDiscount = cart.discount_cents / 100;
                   const shipping = cart.shipping_cents / 100;
-                  
-                  if (appliedPromo) {
-                    promoDiscount = subtotal * (appliedPromo.discount_percent / 100);
-                  }
-                  
-                  const afterDiscount = subtotal - promoDiscount;
-                  const tax = afterDiscount * cart.tax_rate;
-                  const total = afterDiscount + shipping + tax;
+                  const tax = cart.tax_cents / 100;
+                  const total = cart.total_cents / 100;
                   const totalSavings = saleSavings + promoDiscount;
                   
                   return (
@@ -627,7 +648,7 @@ export default function CartPage() {
                         <div className="flex justify-between text-green-600">
                           <span className="flex items-center gap-1">
                             <Sparkles className="w-4 h-4" />
-                            Promo ({appliedPromo?.discount_percent}% off)
+                            Promo ({cart.discount_percent}% off)
                           </span>
                           <span>-${promoDiscount.toFixed(2)}</span>
                         </div>
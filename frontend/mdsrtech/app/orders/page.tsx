@@ -22,6 +22,7 @@ interface OrderSummary {
   item_count: number;
   preview_image: string | null;
   first_item_name: string | null;
+  status: 'placed' | 'cancelled';
 }
 
 interface OrderItem {
@@ -51,7 +52,9 @@ export default function OrdersPage() {
   const { accessToken, isAuthenticated, isLoading: authLoading, user } = useAuth();
   
   const [orders, setOrders] = useState<OrderSummary[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
   const [isLoading, setIsLoading] = useState(true);
+  const [isLoadingMore, setIsLoadingMore] = useState(false);
   const [expandedOrderId, setExpandedOrderId] = useState<number | null>(null);
   const [orderDetails, setOrderDetails] = useState<{ [key: number]: OrderDetails }>({});
   const [loadingDetails, setLoadingDetails] = useState<number | null>(null);
@@ -78,6 +81,7 @@ export default function OrdersPage() {
 
         if (response.ok) {
           setOrders(data.orders || []);
+          setNextCursor(data.next_cursor || null);
         } else {
           setError(data.error || 'Failed to fetch orders');
         }
@@ -91,6 +95,32 @@ export default function OrdersPage() {
     fetchOrders();
   }, [accessToken, isAuthenticated, authLoading]);
 
+  const loadMoreOrders = async () => {
+    if (!nextCursor) return;
+
+    setIsLoadingMore(true);
+    try {
+      const response = await fetch(`${API_URL}/orders?cursor=${encodeURIComponent(nextCursor)}`, {
+        headers: {
+          'Authorization': `Bearer ${accessToken}`,
+        },
+      });
+
+      const data = await response.json();
+
+      if (response.ok) {
+        setOrders(prev => [...prev, ...(data.orders || [])]);
+        setNextCursor(data.next_cursor || null);
+      } else {
+        setError(data.error || 'Failed to fetch orders');
+      }
+    } catch {
+      setError('An error occurred while fetching orders');
+    } finally {
+      setIsLoadingMore(false);
+    }
+  };
+
   const fetchOrderDetails = async (orderId: number) => {
     if (orderDetails[orderId]) {
       return; // Already fetched
@@ -136,7 +166,7 @@ export default function OrdersPage() {
       });
 
       if (response.ok) {
-        setOrders(prev => prev.filter(order => order.id !== orderId));
+        setOrders(prev => prev.map(order => order.id === orderId ? { ...order, status: 'cancelled' } : order));
         setShowCancelModal(null);
         setExpandedOrderId(null);
       } else {
@@ -319,6 +349,11 @@ export default function OrdersPage() {
                         <DollarSign className="w-4 h-4" />
                         {(order.total_cents / 100).toFixed(2)} {order.currency}
                       </span>
+                      {order.status === 'cancelled' && (
+                        <span className="px-2 py-0.5 bg-red-50 text-red-600 rounded-full text-xs font-medium">
+                          Cancelled
+                        </span>
+                      )}
                     </div>
                   </div>
 
@@ -413,14 +448,16 @@ export default function OrdersPage() {
                         </div>
 
                         {/* Cancel Button */}
-                        <div className="mt-6 pt-4 border-t border-gray-200">
-                          <button
-                            onClick={() => setShowCancelModal(order.id)}
-                            className="px-4 py-2 text-red-600 hover:bg-red-50 rounded-lg transition-colors text-sm font-medium cursor-pointer"
-                          >
-                            Cancel Order
-                          </button>
-                        </div>
+                        {order.status !== 'cancelled' && (
+                          <div className="mt-6 pt-4 border-t border-gray-200">
+                            <button
+                              onClick={() => setShowCancelModal(order.id)}
+                              className="px-4 py-2 text-red-600 hover:bg-red-50 rounded-lg transition-colors text-sm font-medium cursor-pointer"
+                            >
+                              Cancel Order
+                            </button>
+                          </div>
+                        )}
                       </div>
                     ) : null}
                   </div>
@@ -428,6 +465,19 @@ export default function OrdersPage() {
               </div>
             ))}
           </div>
+
+          {/* Load More */}
+          {nextCursor && (
+            <div className="mt-6 text-center">
+              <button
+                onClick={loadMoreOrders}
+                disabled={isLoadingMore}
+                className="px-6 py-2 bg-white text-blue-600 border border-blue-200 rounded-lg hover:bg-blue-50 transition-colors text-sm font-medium cursor-pointer disabled:opacity-50"
+              >
+                {isLoadingMore ? <Loader2 className="w-4 h-4 animate-spin inline" /> : 'Load more orders'}
+              </button>
+            </div>
+          )}
         </div>
       </main>
 